@@ -0,0 +1,234 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+from mtix.instrumentation import get_stage_name
+from mtix.local_sagemaker import create_local_sagemaker_backend, LatencyModel
+from mtix.sagemaker_factory import create_indexing_pipeline, create_mesh_heading_prediction_pipeline
+from mtix.synthetic_data import load_input_data
+from mtix.utils import create_input_batches, create_lookup
+import numpy as np
+import os.path
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+
+BASELINE_VERSION = 1
+DEFAULT_BATCH_SIZES = [64, 256, 512]
+DEFAULT_CITATION_COUNT = 2000
+DEFAULT_REPEATS = 3
+DEFAULT_TOLERANCE = 0.1
+ENCODING = "utf-8"
+ENDPOINT_NAMES = ["cnn_endpoint", "pointwise_endpoint", "listwise_endpoint", "subheading_endpoint"]
+GATED_METRICS = ["client_cpu_time_per_citation_ms", "peak_rss_mb"]
+LOOKUP_FILE_NAMES = [
+    "mesh_heading_names_2023.tsv",
+    "mesh_heading_uis_2023.tsv",
+    "mesh_heading_types_2023.tsv",
+    "mesh_heading_names_2023_w_types.tsv",
+    "mesh_heading_names_2023_w_types_max_len_32.tsv",
+    "subheading_names_2023_mesh.tsv",
+]
+PIPELINES = ["mesh_heading", "indexing"]
+REPORTED_METRICS = ["throughput", "latency_p50", "latency_p95", "latency_p99"]
+SYNTHETIC_LABEL_COUNT = 2000
+SYNTHETIC_QUALIFIER_COUNT = 76
+
+
+def create_synthetic_lookups(data_dir):
+    # Lookup files in the same format as the real ones, for label ids
+    # 1..SYNTHETIC_LABEL_COUNT and SYNTHETIC_QUALIFIER_COUNT qualifiers.
+    label_ids = range(1, SYNTHETIC_LABEL_COUNT + 1)
+    types = ["Descriptor", "CheckTag", "PublicationType", "SCR"]
+    lookups = [
+        { label_id: f"Heading {label_id}" for label_id in label_ids },
+        { label_id: f"D{label_id:06d}" for label_id in label_ids },
+        { label_id: types[label_id % len(types)] for label_id in label_ids },
+        { label_id: f"MH: Heading {label_id}" for label_id in label_ids },
+        { label_id: f"MH: Heading {label_id}" for label_id in label_ids },
+        { f"Q{idx:06d}": f"qualifier {idx}" for idx in range(SYNTHETIC_QUALIFIER_COUNT) },
+    ]
+    for file_name, lookup in zip(LOOKUP_FILE_NAMES, lookups):
+        with open(os.path.join(data_dir, file_name), "wt", encoding=ENCODING) as write_file:
+            for key, value in lookup.items():
+                write_file.write(f"{key}\t{value}\n")
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss /= 1024
+    return peak_rss / 1024
+
+
+class StageTimer:
+
+    # Wraps the pipeline stages to add up the client side CPU time of each
+    # stage: the CPU time of the calling thread, less the CPU time spent in
+    # the stand-in endpoints.
+    def __init__(self, predictors):
+        self.predictors = predictors
+        self.cpu_time_lookup = {}
+
+    def wrap(self, stage):
+        name = get_stage_name(stage)
+        self.cpu_time_lookup[name] = 0.
+        def timed_stage(state):
+            start_time = time.thread_time()
+            start_endpoint_time = self._get_endpoint_cpu_time()
+            state = stage(state)
+            endpoint_time = self._get_endpoint_cpu_time() - start_endpoint_time
+            self.cpu_time_lookup[name] += time.thread_time() - start_time - endpoint_time
+            return state
+        return timed_stage
+
+    def _get_endpoint_cpu_time(self):
+        return sum(predictor.cpu_time for predictor in self.predictors)
+
+
+def time_pass(stages, predictors, input_data, batch_size):
+    timer = StageTimer(predictors)
+    timed_stages = [timer.wrap(stage) for stage in stages]
+    batch_latencies = []
+    start_time = time.perf_counter()
+    for batch in create_input_batches(input_data, batch_size):
+        batch_start_time = time.perf_counter()
+        state = { "input_data": batch }
+        for stage in timed_stages:
+            state = stage(state)
+        batch_latencies.append(time.perf_counter() - batch_start_time)
+    elapsed_time = time.perf_counter() - start_time
+    return elapsed_time, batch_latencies, timer.cpu_time_lookup
+
+
+def run_benchmark(pipeline_name, batch_size, input_path, citation_count, data_dir, latency, latency_per_item, jitter, repeats):
+    input_data = load_input_data(input_path, citation_count)
+    lookup_paths = [os.path.join(data_dir, file_name) for file_name in LOOKUP_FILE_NAMES]
+    label_ids = list(create_lookup(lookup_paths[0]).keys())
+    qualifier_uis = list(create_lookup(lookup_paths[-1]).keys())
+    latency_model_lookup = { endpoint_name: LatencyModel(latency, latency_per_item, jitter, seed=idx) for idx, endpoint_name in enumerate(ENDPOINT_NAMES) }
+    backend = create_local_sagemaker_backend(label_ids, qualifier_uis, *ENDPOINT_NAMES, latency_model_lookup=latency_model_lookup)
+    if pipeline_name == "indexing":
+        pipeline = create_indexing_pipeline(*lookup_paths, *ENDPOINT_NAMES, sagemaker_backend=backend)
+    else:
+        pipeline = create_mesh_heading_prediction_pipeline(*lookup_paths[:5], *ENDPOINT_NAMES[:3], sagemaker_backend=backend)
+
+    # The first batch warms up the lookups and the imports, and is not timed.
+    stages = pipeline.create_stages()
+    warm_up_state = { "input_data": input_data[:batch_size] }
+    for stage in stages:
+        warm_up_state = stage(warm_up_state)
+
+    # As for timeit, the best of the repeats is the least disturbed by other 
+    # processes: the fastest for throughput and latency, and the one with 
+    # the least CPU time for the stage CPU times.
+    passes = [time_pass(stages, backend.predictor_lookup.values(), input_data, batch_size) for _ in range(repeats)]
+    elapsed_time, batch_latencies, _ = min(passes, key=lambda x: x[0])
+    _, _, cpu_time_lookup = min(passes, key=lambda x: sum(x[2].values()))
+    result = {
+        "pipeline": pipeline_name,
+        "batch_size": batch_size,
+        "citations": len(input_data),
+        "throughput": len(input_data) / elapsed_time,
+        "latency_p50": float(np.percentile(batch_latencies, 50)),
+        "latency_p95": float(np.percentile(batch_latencies, 95)),
+        "latency_p99": float(np.percentile(batch_latencies, 99)),
+        "peak_rss_mb": get_peak_rss_mb(),
+        "client_cpu_time_per_citation_ms": 1000 * sum(cpu_time_lookup.values()) / len(input_data),
+        "stage_cpu_time": cpu_time_lookup,
+    }
+    return result
+
+
+def run_benchmark_in_process(*args):
+    # Each configuration runs in a fresh process, so that its peak RSS is
+    # not inflated by the previous ones.
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_benchmark, *args).result()
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    # Flags configurations that use more client CPU time or memory than the 
+    # baseline by more than the tolerance. Throughput and latency also 
+    # include the stand-in endpoints, which share the CPU with the client, 
+    # so their changes are only reported.
+    regressions = []
+    changes = []
+    baseline_lookup = { (result["pipeline"], result["batch_size"]): result for result in baseline["results"] }
+    for result in results:
+        baseline_result = baseline_lookup.get((result["pipeline"], result["batch_size"]))
+        if baseline_result is None:
+            continue
+        name = f"{result['pipeline']} (batch size {result['batch_size']})"
+        for key in GATED_METRICS:
+            if result[key] > (1 + tolerance) * baseline_result[key]:
+                regressions.append(f"{name}: {key} {result[key]:.3f}, baseline {baseline_result[key]:.3f}")
+        for key in REPORTED_METRICS:
+            changes.append(f"{name}: {key} {result[key]:.3f}, baseline {baseline_result[key]:.3f} ({result[key] / baseline_result[key] - 1:+.1%})")
+    return regressions, changes
+
+
+def print_result(result):
+    print(f"{result['pipeline']:>12} batch size {result['batch_size']:>4}: {result['throughput']:8.1f} citations/s, "
+          f"batch latency p50/p95/p99 {result['latency_p50']:.3f}/{result['latency_p95']:.3f}/{result['latency_p99']:.3f}s, "
+          f"peak RSS {result['peak_rss_mb']:.0f} MB, client CPU {result['client_cpu_time_per_citation_ms']:.3f} ms/citation")
+    stage_cpu_time = ", ".join(f"{name} {cpu_time:.3f}s" for name, cpu_time in result["stage_cpu_time"].items())
+    print(f"{'':>12} stage CPU time: {stage_cpu_time}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the client side of the mtix pipelines against local stand-in endpoints.")
+    parser.add_argument("--pipelines", nargs="+", choices=PIPELINES, default=PIPELINES)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=DEFAULT_BATCH_SIZES)
+    parser.add_argument("--citations", type=int, default=DEFAULT_CITATION_COUNT)
+    parser.add_argument("--input", help="Test set data (.json.gz). Synthetic citations are used by default.")
+    parser.add_argument("--data-dir", help="Directory with the lookup files. Synthetic lookups are used by default.")
+    parser.add_argument("--latency", type=float, default=0., help="Simulated endpoint latency per request (s).")
+    parser.add_argument("--latency-per-item", type=float, default=0., help="Simulated endpoint latency per item (s).")
+    parser.add_argument("--jitter", type=float, default=0., help="Mean of the simulated extra latency (s).")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--output", help="Writes the results to this JSON file, e.g. to use as a baseline.")
+    parser.add_argument("--baseline", help="Compares the results to this JSON file, and exits with status 1 on a regression.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = temp_dir
+            create_synthetic_lookups(data_dir)
+        results = []
+        for pipeline_name in args.pipelines:
+            for batch_size in args.batch_sizes:
+                result = run_benchmark_in_process(pipeline_name, batch_size, args.input, args.citations, data_dir, args.latency, args.latency_per_item, args.jitter, args.repeats)
+                print_result(result)
+                results.append(result)
+
+    settings = { key: getattr(args, key) for key in ["citations", "input", "data_dir", "latency", "latency_per_item", "jitter", "repeats"] }
+    output = { "version": BASELINE_VERSION, "python": platform.python_version(), "platform": platform.platform(), "settings": settings, "results": results }
+    if args.output is not None:
+        with open(args.output, "wt", encoding=ENCODING) as write_file:
+            json.dump(output, write_file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "rt", encoding=ENCODING) as read_file:
+            baseline = json.load(read_file)
+        regressions, changes = compare_to_baseline(results, baseline, args.tolerance)
+        for change in changes:
+            print(change)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import argparse
+from mtix.synthetic_data import load_input_data
+from mtix.utils import Base64Helper, MedlineDateParser, XML_PARSER_BACKENDS
+import time
+
+
+DEFAULT_CITATION_COUNT = 2000
+NUM_REPEATS = 3
+
+
+def load_citation_xml_list(input_path, citation_count):
+    # Synthetic citations, shared with benchmark_pipelines.py, unless a test 
+    # set data file (.json.gz) is given. The synthetic citations are not the 
+    # validation test set and are simpler than real citations, so timings 
+    # on them are only comparable between backends.
+    base64_helper = Base64Helper()
+    input_data = load_input_data(input_path, citation_count)
+    citation_xml_list = [base64_helper.decode(item["data"]) for item in input_data]
+    return citation_xml_list
+
+
+def benchmark(xml_parser, citation_xml_list):
+    best_time = None
+    for _ in range(NUM_REPEATS):
+        start_time = time.perf_counter()
+        citation_data_list = [xml_parser.parse(citation_xml) for citation_xml in citation_xml_list]
+        elapsed_time = time.perf_counter() - start_time
+        if best_time is None or elapsed_time < best_time:
+            best_time = elapsed_time
+    return best_time, citation_data_list
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the citation XML parser backends.")
+    parser.add_argument("--input", help="Test set data (.json.gz), e.g. the validation test set. Synthetic citations, which are not drawn from the test set, are used by default.")
+    parser.add_argument("--citations", type=int, default=DEFAULT_CITATION_COUNT)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    citation_xml_list = load_citation_xml_list(args.input, args.citations)
+    print(f"Citations: {len(citation_xml_list)}")
+
+    baseline_citation_data_list = None
+    for backend, xml_parser_class in XML_PARSER_BACKENDS.items():
+        try:
+            xml_parser = xml_parser_class(MedlineDateParser())
+        except ImportError:
+            print(f"{backend:>12}: skipped (not installed)")
+            continue
+        best_time, citation_data_list = benchmark(xml_parser, citation_xml_list)
+        if baseline_citation_data_list is None:
+            baseline_citation_data_list = citation_data_list
+        identical = citation_data_list == baseline_citation_data_list
+        print(f"{backend:>12}: {best_time:.3f}s ({len(citation_xml_list) / best_time:.0f} citations/s), identical output: {identical}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+from mtix.utils import build_compact_lookup, create_lookup
+import os.path
+import sys
+
+
+LOOKUP_FILE_EXTENSION = ".lkp"
+LOOKUP_FILE_NAMES = [
+    "mesh_heading_names_2023.tsv",
+    "mesh_heading_uis_2023.tsv",
+    "mesh_heading_types_2023.tsv",
+    "mesh_heading_names_2023_w_types.tsv",
+    "mesh_heading_names_2023_w_types_max_len_32.tsv",
+    "subheading_names_2023_mesh.tsv",
+]
+
+
+def main():
+    data_dir = sys.argv[1]
+    for file_name in LOOKUP_FILE_NAMES:
+        tsv_path = os.path.join(data_dir, file_name)
+        if not os.path.isfile(tsv_path):
+            print(f"Skipped {tsv_path} (not found)")
+            continue
+        lookup_path = os.path.splitext(tsv_path)[0] + LOOKUP_FILE_EXTENSION
+        build_compact_lookup(create_lookup(tsv_path), lookup_path)
+        print(f"Built {lookup_path}")
+
+
+if __name__ == "__main__":
+    main()
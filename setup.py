@@ -16,6 +16,7 @@ setup(name="mtix",
       package_dir={"":"src"},
       python_requires=">=3.9",
       install_requires=[
+          "numpy==1.22.3",
           "pandas==1.4.1",
           "python-dateutil==2.8.2",
           "pytrec-eval==0.5",
@@ -1 +1,11 @@
-from .sagemaker_factory import create_indexing_pipeline
\ No newline at end of file
+# The factory pulls in boto3 and sagemaker, so it is only imported when 
+# create_indexing_pipeline is first accessed.
+def __getattr__(name):
+    if name == "create_indexing_pipeline":
+        from .sagemaker_factory import create_indexing_pipeline
+        globals()[name] = create_indexing_pipeline
+        return create_indexing_pipeline
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ["create_indexing_pipeline"]
@@ -0,0 +1,97 @@
+from collections import deque
+import gzip
+from .utils import Base64Helper, create_process_pool, ENCODING, MedlineDateParser, XML_PARSER_BACKENDS
+import xml.etree.ElementTree as ET
+
+
+OUTPUT_TYPES = ["records", "citation_data"]
+
+
+class MedlineXmlFileReader:
+
+    # Streams the citations in a PubMed baseline or update file (optionally
+    # gzipped) using iterparse. Each top level element (PubmedArticle,
+    # DeleteCitation, ...) is cleared once it has been read, so memory use
+    # does not grow with the size of the file.
+    #
+    # Yields { "uid": pmid, "data": base64 encoded MedlineCitation xml }
+    # records, which can be passed directly to the pipelines, or parsed
+    # citation data.
+    def __init__(self, pmids=None, output="records", xml_parser_backend="elementtree"):
+        if output not in OUTPUT_TYPES:
+            raise ValueError(f"Output must be one of {OUTPUT_TYPES}.")
+        if xml_parser_backend not in XML_PARSER_BACKENDS:
+            raise ValueError(f"XML parser backend must be one of {list(XML_PARSER_BACKENDS)}.")
+        self.pmids = set(int(pmid) for pmid in pmids) if pmids is not None else None
+        self.output = output
+        self.base64_helper = Base64Helper()
+        self.xml_parser = XML_PARSER_BACKENDS[xml_parser_backend](MedlineDateParser())
+
+    def read(self, path):
+        with self._open(path) as file:
+            root_node = None
+            depth = 0
+            for event, node in ET.iterparse(file, events=("start", "end")):
+                if event == "start":
+                    if root_node is None:
+                        root_node = node
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 1:
+                    # Citations are read once their PubmedArticle has ended, 
+                    # so that their tail text is complete. Only MedlineCitation 
+                    # elements directly under a PubmedArticle are read.
+                    if node.tag == "PubmedArticle":
+                        for medline_citation_node in node.findall("MedlineCitation"):
+                            item = self._create_item(medline_citation_node)
+                            if item is not None:
+                                yield item
+                    root_node.clear()
+
+    def read_all(self, path):
+        return list(self.read(path))
+
+    def _create_item(self, medline_citation_node):
+        pmid = int(medline_citation_node.find("PMID").text.strip())
+        if self.pmids is not None and pmid not in self.pmids:
+            return None
+
+        if self.output == "citation_data":
+            return self.xml_parser.parse_node(medline_citation_node)
+
+        citation_xml = ET.tostring(medline_citation_node, encoding=ENCODING, method="xml").decode(ENCODING)
+        return { "uid": pmid, "data": self.base64_helper.encode(citation_xml) }
+
+    def _open(self, path):
+        if str(path).endswith(".gz"):
+            return gzip.open(path, "rb")
+        return open(path, "rb")
+
+
+class MedlineXmlFileSetReader:
+
+    # Reads a sequence of baseline or update files, fanning the files out
+    # across worker processes. Items are yielded in file order, and at most
+    # max_workers + 1 files are read ahead of the consumer.
+    def __init__(self, file_reader, max_workers=1):
+        self.file_reader = file_reader
+        self.max_workers = max_workers
+
+    def read(self, paths):
+        if self.max_workers <= 1:
+            for path in paths:
+                yield from self.file_reader.read(path)
+            return
+
+        executor = create_process_pool(self.max_workers)
+        try:
+            pending = deque()
+            for path in paths:
+                pending.append(executor.submit(self.file_reader.read_all, path))
+                if len(pending) > self.max_workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            executor.shutdown(cancel_futures=True)
@@ -0,0 +1,184 @@
+from collections import OrderedDict
+import hashlib
+import json
+import numpy as np
+import sqlite3
+import threading
+import time
+from .utils import ENCODING, PAD_LABEL_ID, TopNResults
+
+
+CNN_SCORE_DTYPES = ["float16", "float32"]
+SQLITE_MAX_VARIABLES = 999
+
+
+class PredictionCache:
+
+    # Caches per citation predictions (the MTI JSON "Indexing" list) keyed by
+    # a hash of the sanitized citation data and a model version string, so
+    # that a change to the citation or to any of the models is a miss.
+    def __init__(self, backend, model_version):
+        self.backend = backend
+        self.model_version = model_version
+
+    def create_key(self, citation_data):
+        text = json.dumps([self.model_version, citation_data], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(text.encode(ENCODING)).hexdigest()
+
+    def get_many(self, citation_data_lookup):
+        key_lookup = { pmid: self.create_key(citation_data) for pmid, citation_data in citation_data_lookup.items() }
+        values = self.backend.get_many(list(key_lookup.values()))
+        hits = { pmid: json.loads(values[key]) for pmid, key in key_lookup.items() if key in values }
+        return hits
+
+    def set_many(self, citation_data_lookup, indexing_lookup):
+        items = { self.create_key(citation_data_lookup[pmid]): json.dumps(indexing, ensure_ascii=False) for pmid, indexing in indexing_lookup.items() }
+        self.backend.set_many(items)
+
+
+class CnnResultsCache:
+
+    # Caches CNN top-N results per citation, keyed by pmid and a hash of the 
+    # citation fields sent to the CNN model and the model version, so that it 
+    # survives reranker upgrades. Each row is stored as int32 label ids 
+    # followed by float16 or float32 scores, without padding. It can be 
+    # filled from historical CNN results with set_many.
+    def __init__(self, backend, model_version, score_dtype="float32"):
+        if score_dtype not in CNN_SCORE_DTYPES:
+            raise ValueError(f"Score dtype must be one of {CNN_SCORE_DTYPES}.")
+        self.backend = backend
+        self.model_version = model_version
+        self.score_dtype = np.dtype(score_dtype)
+
+    def create_key(self, citation_data):
+        cnn_input = { key: value for key, value in citation_data.items() if key not in ["pmid", "journal_title"] }
+        text = json.dumps([self.model_version, cnn_input], sort_keys=True, ensure_ascii=False)
+        return f"{citation_data['pmid']}:{hashlib.sha256(text.encode(ENCODING)).hexdigest()}"
+
+    def get_many(self, citation_data_lookup):
+        # Returns the cached rows, in citation data lookup order.
+        key_lookup = { pmid: self.create_key(citation_data) for pmid, citation_data in citation_data_lookup.items() }
+        values = self.backend.get_many(list(key_lookup.values()))
+        rows = [(pmid, self._decode(values[key])) for pmid, key in key_lookup.items() if key in values]
+        n = max([len(label_ids) for _, (label_ids, _) in rows], default=0)
+        label_ids = np.full((len(rows), n), PAD_LABEL_ID, dtype=np.int32)
+        scores = np.full((len(rows), n), -np.inf, dtype=np.float64)
+        for row, (_, (row_label_ids, row_scores)) in enumerate(rows):
+            label_ids[row, :len(row_label_ids)] = row_label_ids
+            scores[row, :len(row_scores)] = row_scores
+        return TopNResults([pmid for pmid, _ in rows], label_ids, scores)
+
+    def set_many(self, citation_data_lookup, top_results):
+        items = {}
+        for pmid, label_ids, scores in zip(top_results.pmids.tolist(), top_results.label_ids, top_results.scores):
+            mask = label_ids != PAD_LABEL_ID
+            items[self.create_key(citation_data_lookup[pmid])] = self._encode(label_ids[mask], scores[mask])
+        self.backend.set_many(items)
+
+    def _encode(self, label_ids, scores):
+        return label_ids.astype(np.int32).tobytes() + scores.astype(self.score_dtype).tobytes()
+
+    def _decode(self, value):
+        count = len(value) // (4 + self.score_dtype.itemsize)
+        label_ids = np.frombuffer(value, dtype=np.int32, count=count)
+        scores = np.frombuffer(value, dtype=self.score_dtype, count=count, offset=4 * count)
+        return label_ids, scores
+
+
+class LruCacheBackend:
+
+    # In-memory backend for str or bytes values. Entries older than ttl 
+    # seconds are expired, and the least recently used entries are evicted 
+    # beyond max_size entries.
+    def __init__(self, max_size=100000, ttl=None, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        values = {}
+        now = self.clock()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                created, value = entry
+                if self.ttl is not None and now - created > self.ttl:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                values[key] = value
+        return values
+
+    def set_many(self, items):
+        now = self.clock()
+        with self._lock:
+            for key, value in items.items():
+                self._entries[key] = (now, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteCacheBackend:
+
+    # Local file backend, which persists between runs and can be shared by
+    # processes on the same host. Same expiry and eviction policy as the LRU
+    # backend, with max_size=None meaning no size limit. Expired entries are 
+    # skipped on lookup and deleted when entries are added.
+    def __init__(self, path, max_size=None, ttl=None, clock=time.time):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+
+    def get_many(self, keys):
+        values = {}
+        now = self.clock()
+        with self._lock:
+            for start in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                chunk = keys[start:start + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._connection.execute(f"SELECT key, value, created FROM cache WHERE key IN ({placeholders})", chunk).fetchall()
+                values.update((key, value) for key, value, created in rows if not self._is_expired(created, now))
+            if len(values) > 0:
+                with self._connection:
+                    self._connection.execute("BEGIN")
+                    self._connection.executemany("UPDATE cache SET accessed = ? WHERE key = ?", [(now, key) for key in values])
+        return values
+
+    def set_many(self, items):
+        now = self.clock()
+        with self._lock:
+            with self._connection:
+                self._connection.execute("BEGIN")
+                if self.ttl is not None:
+                    self._connection.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+                self._connection.executemany("INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)", [(key, value, now, now) for key, value in items.items()])
+                if self.max_size is not None:
+                    self._connection.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_size,))
+
+    def _is_expired(self, created, now):
+        return self.ttl is not None and created < now - self.ttl
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            # Expired entries that have not been deleted yet are not counted.
+            if self.ttl is not None:
+                return self._connection.execute("SELECT COUNT(*) FROM cache WHERE created >= ?", (self.clock() - self.ttl,)).fetchone()[0]
+            return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
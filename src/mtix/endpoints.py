@@ -1,8 +1,206 @@
-import boto3
+import asyncio
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import logging
 import math
 import os.path
-from sagemaker.async_inference.waiter_config import WaiterConfig
+import random
+import threading
+import time
 import uuid
+from .instrumentation import get_payload_size
+
+
+CHARS_PER_TOKEN = 4
+DELETE_OBJECTS_MAX_KEYS = 1000
+FAILED_CLEAN_UP_KEYS_MAX_LEN = 10000
+RETRYABLE_ERROR_CODES = { "InternalFailure", "ModelNotReadyException", "RequestTimeout", "ServiceUnavailable", "Throttling", "ThrottlingException", "TooManyRequestsException" }
+THROTTLING_ERROR_CODES = { "Throttling", "ThrottlingException", "TooManyRequestsException" }
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_batch_index_list(inputs, parameters, endpoint_helper, batch_size, token_budget=None):
+    input_count = len(inputs)
+    if token_budget is None:
+        batch_index_list = [list(range(batch_start, min(batch_start + batch_size, input_count))) for batch_start in range(0, input_count, batch_size)]
+        return batch_index_list
+
+    # Inputs are sorted by estimated length so that each batch holds inputs of 
+    # similar length, and a batch is cut when its padded size (item count x 
+    # longest item) would exceed the token budget. An input that is longer 
+    # than the budget is sent in a batch on its own.
+    token_count_list = [endpoint_helper.estimate_token_count(item, parameters) for item in inputs]
+    sorted_index_list = sorted(range(input_count), key=lambda idx: token_count_list[idx])
+
+    batch_index_list = []
+    batch_indices = []
+    for idx in sorted_index_list:
+        padded_token_count = (len(batch_indices) + 1) * token_count_list[idx]
+        if len(batch_indices) > 0 and (len(batch_indices) == batch_size or padded_token_count > token_budget):
+            batch_index_list.append(batch_indices)
+            batch_indices = []
+        batch_indices.append(idx)
+    if len(batch_indices) > 0:
+        batch_index_list.append(batch_indices)
+    return batch_index_list
+
+
+def reorder_batch_results(batch_index_list, batch_result_list, token_budget=None):
+    # Without a token budget the batches are in input order and are 
+    # concatenated, so a batch may return more results than inputs (e.g. one 
+    # subheading row per qualifier). With a token budget the inputs were 
+    # sorted by length, and each result is put back at the index of its 
+    # input, so there must be one result per input.
+    if token_budget is None:
+        return [result for batch_result in batch_result_list for result in batch_result]
+    result_list = [None] * sum(len(batch_indices) for batch_indices in batch_index_list)
+    for batch_indices, batch_result in zip(batch_index_list, batch_result_list):
+        for idx, result in zip(batch_indices, batch_result):
+            result_list[idx] = result
+    return result_list
+
+
+def is_retryable_error(error):
+    # Throttling, 429 and 5xx responses, and connection errors and timeouts 
+    # are transient. Other errors (e.g. a ModelError for a malformed input) 
+    # would fail again.
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        error_code = response.get("Error", {}).get("Code")
+        status_code = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        return error_code in RETRYABLE_ERROR_CODES or (status_code is not None and (status_code == 429 or status_code >= 500))
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    from botocore.exceptions import ConnectionError as BotocoreConnectionError, HTTPClientError
+    return isinstance(error, (BotocoreConnectionError, HTTPClientError))
+
+
+def is_throttling_error(error):
+    # Only throttling responses mean the endpoint is overloaded. 5xx responses 
+    # and connection errors are left to the retry policy.
+    response = getattr(error, "response", None)
+    if not isinstance(response, dict):
+        return False
+    error_code = response.get("Error", {}).get("Code")
+    status_code = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return error_code in THROTTLING_ERROR_CODES or status_code == 429
+
+
+class RetryPolicy:
+
+    # A batch that fails with a retryable error is resent, up to max_attempts 
+    # attempts in total. The delay before retry k is drawn uniformly from 
+    # [0, min(max_delay, base_delay * backoff_factor ** (k - 1))] (full 
+    # jitter), so that batches throttled together do not retry together.
+    def __init__(self, max_attempts=3, base_delay=0.1, max_delay=5., backoff_factor=2., is_retryable=is_retryable_error, seed=None):
+        if max_attempts < 1:
+            raise ValueError("Max attempts must be at least 1.")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.is_retryable = is_retryable
+        self._rng = random.Random(seed)
+
+    def get_retry_delay(self, error, attempt_count):
+        # The delay before the next attempt, or None if the error should be 
+        # raised.
+        if attempt_count >= self.max_attempts or not self.is_retryable(error):
+            return None
+        max_delay = min(self.max_delay, self.base_delay * self.backoff_factor ** (attempt_count - 1))
+        return self._rng.uniform(0, max_delay)
+
+
+class AdaptiveBatchController:
+
+    # AIMD tuning of the batch size and the number of batches in flight of 
+    # a real-time endpoint, within the bounds set by the operator. Batch 
+    # outcomes are collected over windows of window_size batches, then:
+    # - if a batch was throttled, the number in flight is multiplied by 
+    #   decrease_factor,
+    # - else if the mean batch latency is above target_latency, the batch 
+    #   size is multiplied by decrease_factor,
+    # - else the batch size grows by batch_size_step, and the number in 
+    #   flight grows by one if the estimated throughput (items per second 
+    #   of endpoint time, times the number in flight) grew by at least 
+    #   min_throughput_gain over the previous window.
+    # Both start at their lower bounds unless initial values are given.
+    def __init__(self, min_batch_size, max_batch_size, min_in_flight=1, max_in_flight=1, target_latency=1., initial_batch_size=None, initial_in_flight=None, batch_size_step=16, decrease_factor=0.5, window_size=8, min_throughput_gain=0.05, is_throttling=is_throttling_error):
+        if not 1 <= min_batch_size <= max_batch_size:
+            raise ValueError("Batch size bounds must satisfy 1 <= min <= max.")
+        if not 1 <= min_in_flight <= max_in_flight:
+            raise ValueError("In flight bounds must satisfy 1 <= min <= max.")
+        if not 0 < decrease_factor < 1:
+            raise ValueError("Decrease factor must be between 0 and 1.")
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.min_in_flight = min_in_flight
+        self.max_in_flight = max_in_flight
+        self.target_latency = target_latency
+        self.batch_size_step = batch_size_step
+        self.decrease_factor = decrease_factor
+        self.window_size = window_size
+        self.min_throughput_gain = min_throughput_gain
+        self.is_throttling = is_throttling
+        self.batch_size = self._clip(initial_batch_size if initial_batch_size is not None else min_batch_size, min_batch_size, max_batch_size)
+        self.in_flight = self._clip(initial_in_flight if initial_in_flight is not None else min_in_flight, min_in_flight, max_in_flight)
+        self._lock = threading.Lock()
+        self._previous_throughput = None
+        self._reset_window()
+
+    def get_limits(self):
+        with self._lock:
+            return self.batch_size, self.in_flight
+
+    def record_batch(self, item_count, latency):
+        with self._lock:
+            self._window_success_count += 1
+            self._window_item_count += item_count
+            self._window_latency += latency
+            self._update()
+
+    def record_error(self, error):
+        with self._lock:
+            self._window_error_count += 1
+            if self.is_throttling(error):
+                self._window_throttled = True
+            self._update()
+
+    def _update(self):
+        if self._window_success_count + self._window_error_count < self.window_size:
+            return
+        if self._window_throttled:
+            self.in_flight = self._clip(int(self.in_flight * self.decrease_factor), self.min_in_flight, self.max_in_flight)
+            self._previous_throughput = None
+        elif self._window_success_count > 0 and self._window_latency / self._window_success_count > self.target_latency:
+            self.batch_size = self._clip(int(self.batch_size * self.decrease_factor), self.min_batch_size, self.max_batch_size)
+            self._previous_throughput = None
+        elif self._window_latency > 0:
+            throughput = self.in_flight * self._window_item_count / self._window_latency
+            if self._previous_throughput is None or throughput >= self._previous_throughput * (1 + self.min_throughput_gain):
+                self.in_flight = self._clip(self.in_flight + 1, self.min_in_flight, self.max_in_flight)
+            self.batch_size = self._clip(self.batch_size + self.batch_size_step, self.min_batch_size, self.max_batch_size)
+            self._previous_throughput = throughput
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_success_count = 0
+        self._window_error_count = 0
+        self._window_item_count = 0
+        self._window_latency = 0.
+        self._window_throttled = False
+
+    def _clip(self, value, min_value, max_value):
+        return max(min_value, min(max_value, value))
+
+
+def get_retry_delay(retry_policy, error, attempt_count, endpoint_name):
+    delay = retry_policy.get_retry_delay(error, attempt_count) if retry_policy is not None else None
+    if delay is not None:
+        logger.warning("Batch for %s failed on attempt %d (%s), retrying in %.3fs.", endpoint_name, attempt_count, error, delay)
+    return delay
 
 
 class HuggingFaceEndpointHelper:
@@ -22,6 +220,22 @@ class HuggingFaceEndpointHelper:
     def construct_output(self, result_list):
         return result_list
 
+    def estimate_token_count(self, item, parameters):
+        # Character length proxy: about CHARS_PER_TOKEN characters per token 
+        # plus one special token per text and one for the sequence start. 
+        # Inputs are truncated to max_length by the endpoint.
+        text_list = self._flatten_texts(item)
+        token_count = sum(int(math.ceil(len(text) / CHARS_PER_TOKEN)) for text in text_list) + len(text_list) + 1
+        max_length = parameters.get("max_length") if parameters else None
+        if max_length is not None:
+            token_count = min(token_count, max_length)
+        return token_count
+
+    def _flatten_texts(self, item):
+        if isinstance(item, str):
+            return [item]
+        return [text for sub_item in item for text in self._flatten_texts(sub_item)]
+
 
 class TensorflowEndpointHelper:
 
@@ -45,107 +259,492 @@ class TensorflowEndpointHelper:
 
 class RealTimeEndpoint:
 
-    def __init__(self, endpoint_helper, sagemaker_rt_endpoint, batch_size):
+    def __init__(self, endpoint_helper, sagemaker_rt_endpoint, batch_size, max_in_flight=1, token_budget=None, observer=None, endpoint_name=None, retry_policy=None, batch_controller=None):
         self.helper = endpoint_helper
         self.sagemaker_rt_endpoint = sagemaker_rt_endpoint
         self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.token_budget = token_budget
+        self.observer = observer
+        self.endpoint_name = endpoint_name
+        self.retry_policy = retry_policy
+        self.batch_controller = batch_controller
     
     def predict(self, request):
         inputs, parameters = self.helper.process_request(request)
+        if self.batch_controller is not None and self.token_budget is None:
+            batch_index_list, batch_result_list = self._predict_adaptive(inputs, parameters)
+            predictions = self._create_predictions(batch_index_list, batch_result_list)
+            return predictions
+
+        batch_size, max_in_flight = self._get_limits()
+        batch_index_list, batch_inputs_list = self._create_batches(inputs, parameters, batch_size)
+
+        if max_in_flight > 1 and len(batch_inputs_list) > 1:
+            batch_result_list = self._predict_concurrent(batch_inputs_list, parameters, max_in_flight)
+        else:
+            batch_result_list = [self._predict_batch(batch_inputs, parameters) for batch_inputs in batch_inputs_list]
+
+        predictions = self._create_predictions(batch_index_list, batch_result_list)
+        return predictions
+
+    async def apredict(self, request):
+        inputs, parameters = self.helper.process_request(request)
+        if self.batch_controller is not None and self.token_budget is None:
+            batch_index_list, batch_result_list = await self._apredict_adaptive(inputs, parameters)
+            predictions = self._create_predictions(batch_index_list, batch_result_list)
+            return predictions
+
+        batch_size, max_in_flight = self._get_limits()
+        batch_index_list, batch_inputs_list = self._create_batches(inputs, parameters, batch_size)
+
+        semaphore = asyncio.Semaphore(max_in_flight)
+        async def _apredict_bounded(batch_inputs):
+            submit_time = time.perf_counter()
+            async with semaphore:
+                return await self._apredict_batch(batch_inputs, parameters, submit_time)
+        batch_result_list = await asyncio.gather(*[_apredict_bounded(batch_inputs) for batch_inputs in batch_inputs_list])
+
+        predictions = self._create_predictions(batch_index_list, batch_result_list)
+        return predictions
+
+    def _get_limits(self):
+        # With a batch controller and a token budget, the batch size and the 
+        # number of batches in flight are read at the start of each request.
+        if self.batch_controller is None:
+            return self.batch_size, self.max_in_flight
+        return self.batch_controller.get_limits()
 
-        input_count = len(inputs)
-        num_batches = int(math.ceil(input_count/self.batch_size))
-
-        result_list = []
-        for idx in range(num_batches):
-            batch_start = idx * self.batch_size
-            batch_end = (idx + 1) * self.batch_size
-            batch_inputs = inputs[batch_start:batch_end]
-            batch_data = self.helper.construct_batch_data(batch_inputs, parameters)
-            response = self.sagemaker_rt_endpoint.predict(batch_data)
-            result = self.helper.process_response(response)
-            result_list.extend(result)
-        
+    def _create_batches(self, inputs, parameters, batch_size):
+        batch_index_list = create_batch_index_list(inputs, parameters, self.helper, batch_size, self.token_budget)
+        batch_inputs_list = [[inputs[idx] for idx in batch_indices] for batch_indices in batch_index_list]
+        return batch_index_list, batch_inputs_list
+
+    def _create_predictions(self, batch_index_list, batch_result_list):
+        result_list = reorder_batch_results(batch_index_list, batch_result_list, self.token_budget)
         predictions = self.helper.construct_output(result_list)
         return predictions
 
+    def _predict_batch(self, batch_inputs, parameters, submit_time=None):
+        # Only this batch is resent on a retryable error.
+        start_time = time.perf_counter()
+        batch_data = self.helper.construct_batch_data(batch_inputs, parameters)
+        request_end_time = time.perf_counter()
+        retry_count = 0
+        while True:
+            call_start_time = time.perf_counter()
+            try:
+                response = self.sagemaker_rt_endpoint.predict(batch_data)
+                break
+            except Exception as error:
+                if self.batch_controller is not None:
+                    self.batch_controller.record_error(error)
+                delay = get_retry_delay(self.retry_policy, error, retry_count + 1, self.endpoint_name)
+                if delay is None:
+                    raise
+            retry_count += 1
+            time.sleep(delay)
+        call_end_time = time.perf_counter()
+        if self.batch_controller is not None:
+            self.batch_controller.record_batch(len(batch_inputs), call_end_time - call_start_time)
+        result = self.helper.process_response(response)
+        if self.observer is not None:
+            self._observe_batch(batch_data, response, len(batch_inputs), submit_time, start_time, request_end_time, call_start_time, call_end_time, retry_count)
+        return result
+
+    async def _apredict_batch(self, batch_inputs, parameters, submit_time=None):
+        start_time = time.perf_counter()
+        batch_data = self.helper.construct_batch_data(batch_inputs, parameters)
+        request_end_time = time.perf_counter()
+        retry_count = 0
+        while True:
+            call_start_time = time.perf_counter()
+            try:
+                # Wrapped mtix endpoints (e.g. AsyncEndpoint) are awaited 
+                # directly, blocking SageMaker predictors are run in a worker 
+                # thread.
+                if isinstance(self.sagemaker_rt_endpoint, AsyncEndpoint):
+                    response = await self.sagemaker_rt_endpoint.apredict(batch_data)
+                else:
+                    response = await asyncio.to_thread(self.sagemaker_rt_endpoint.predict, batch_data)
+                break
+            except Exception as error:
+                if self.batch_controller is not None:
+                    self.batch_controller.record_error(error)
+                delay = get_retry_delay(self.retry_policy, error, retry_count + 1, self.endpoint_name)
+                if delay is None:
+                    raise
+            retry_count += 1
+            await asyncio.sleep(delay)
+        call_end_time = time.perf_counter()
+        if self.batch_controller is not None:
+            self.batch_controller.record_batch(len(batch_inputs), call_end_time - call_start_time)
+        result = self.helper.process_response(response)
+        if self.observer is not None:
+            self._observe_batch(batch_data, response, len(batch_inputs), submit_time, start_time, request_end_time, call_start_time, call_end_time, retry_count)
+        return result
+
+    def _observe_batch(self, batch_data, response, item_count, submit_time, start_time, request_end_time, call_start_time, call_end_time, retry_count):
+        # submit_time is when the batch started to wait for a free slot (a 
+        # worker thread or the semaphore), if it had to. The call time is 
+        # that of the last attempt, while the wall time includes failed 
+        # attempts and retry delays.
+        end_time = time.perf_counter()
+        queue_wait = start_time - submit_time if submit_time is not None else 0.
+        request_bytes, response_bytes = None, None
+        if self.observer.measure_payload_size:
+            request_bytes, response_bytes = get_payload_size(batch_data), get_payload_size(response)
+        self.observer.on_endpoint_batch(self.endpoint_name, end_time - start_time, item_count, request_bytes, response_bytes, request_end_time - start_time, call_end_time - call_start_time, end_time - call_end_time, queue_wait, retry_count)
+
+    def _predict_adaptive(self, inputs, parameters):
+        # Batches are cut from the inputs as they are sent, so the batch size 
+        # and the number of batches in flight follow the batch controller 
+        # within a request.
+        executor = ThreadPoolExecutor(max_workers=self.batch_controller.max_in_flight)
+        batch_index_list = []
+        future_list = []
+        pending = set()
+        try:
+            while len(pending) > 0 or self._get_next_batch_start(batch_index_list) < len(inputs):
+                batch_size, in_flight = self.batch_controller.get_limits()
+                while len(pending) < in_flight and self._get_next_batch_start(batch_index_list) < len(inputs):
+                    batch_indices = self._cut_batch(inputs, batch_index_list, batch_size)
+                    future = executor.submit(self._predict_batch, [inputs[idx] for idx in batch_indices], parameters)
+                    future_list.append(future)
+                    pending.add(future)
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        batch_result_list = [future.result() for future in future_list]
+        return batch_index_list, batch_result_list
+
+    async def _apredict_adaptive(self, inputs, parameters):
+        batch_index_list = []
+        task_list = []
+        pending = set()
+        try:
+            while len(pending) > 0 or self._get_next_batch_start(batch_index_list) < len(inputs):
+                batch_size, in_flight = self.batch_controller.get_limits()
+                while len(pending) < in_flight and self._get_next_batch_start(batch_index_list) < len(inputs):
+                    batch_indices = self._cut_batch(inputs, batch_index_list, batch_size)
+                    task = asyncio.ensure_future(self._apredict_batch([inputs[idx] for idx in batch_indices], parameters))
+                    task_list.append(task)
+                    pending.add(task)
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        batch_result_list = [task.result() for task in task_list]
+        return batch_index_list, batch_result_list
+
+    def _get_next_batch_start(self, batch_index_list):
+        return batch_index_list[-1][-1] + 1 if len(batch_index_list) > 0 else 0
+
+    def _cut_batch(self, inputs, batch_index_list, batch_size):
+        batch_start = self._get_next_batch_start(batch_index_list)
+        batch_indices = list(range(batch_start, min(batch_start + batch_size, len(inputs))))
+        batch_index_list.append(batch_indices)
+        return batch_indices
+
+    def _predict_concurrent(self, batch_inputs_list, parameters, max_in_flight):
+        # At most max_in_flight batches are sent at once. Executor.map returns
+        # the batch results in submission order.
+        max_workers = min(max_in_flight, len(batch_inputs_list))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        submit_time = time.perf_counter()
+        try:
+            batch_result_list = list(executor.map(lambda batch_inputs: self._predict_batch(batch_inputs, parameters, submit_time), batch_inputs_list))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        return batch_result_list
+
+
+class AsyncResultTracker:
+
+    def __init__(self, s3, min_delay, max_delay, timeout, backoff_factor=2):
+        self.s3 = s3
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.backoff_factor = backoff_factor
+
+    def wait(self, response_list, process_result=None, observe_result=None):
+        # All outstanding batches are checked together: each polling round 
+        # queries the S3 output (and failure) key of every outstanding batch, 
+        # and only the batches whose objects have landed are fetched. The delay is reset when a 
+        # batch lands and backs off while nothing does. observe_result is 
+        # called with the batch index, the time the batch was found to have 
+        # landed and its unprocessed result.
+        outstanding = dict(enumerate(response_list))
+        result_list = [None] * len(response_list)
+        delay = self.min_delay
+        start = time.monotonic()
+        while True:
+            landed = self._collect_landed(outstanding, result_list, process_result, observe_result)
+            if len(outstanding) == 0:
+                break
+            delay, sleep_time = self._get_next_delay(outstanding, landed, delay, start)
+            time.sleep(sleep_time)
+        return result_list
+
+    async def await_results(self, response_list, process_result=None, observe_result=None):
+        # Same as wait, but only each polling round runs in a worker thread, 
+        # and the delay between rounds is awaited, so a long wait does not 
+        # hold a thread of the default executor.
+        outstanding = dict(enumerate(response_list))
+        result_list = [None] * len(response_list)
+        delay = self.min_delay
+        start = time.monotonic()
+        while True:
+            landed = await asyncio.to_thread(self._collect_landed, outstanding, result_list, process_result, observe_result)
+            if len(outstanding) == 0:
+                break
+            delay, sleep_time = self._get_next_delay(outstanding, landed, delay, start)
+            await asyncio.sleep(sleep_time)
+        return result_list
+
+    def _collect_landed(self, outstanding, result_list, process_result, observe_result):
+        landed = self._find_landed(outstanding)
+        landed_time = time.perf_counter()
+        for idx in landed:
+            batch_response = outstanding.pop(idx)
+            response = batch_response.get_result()
+            result = process_result(response) if process_result is not None else response
+            if observe_result is not None:
+                observe_result(idx, landed_time, response)
+            result_list[idx] = result
+        return landed
+
+    def _get_next_delay(self, outstanding, landed, delay, start):
+        elapsed = time.monotonic() - start
+        if elapsed >= self.timeout:
+            from sagemaker.exceptions import PollingTimeoutError
+            first_outstanding = outstanding[min(outstanding)]
+            raise PollingTimeoutError(message="Inference could still be running", output_path=first_outstanding.output_path, seconds=self.timeout)
+        if len(landed) > 0:
+            delay = self.min_delay
+        else:
+            delay = min(self.max_delay, delay * self.backoff_factor)
+        return delay, min(delay, self.timeout - elapsed)
+
+    def _find_landed(self, outstanding):
+        # Only the keys of the outstanding batches are queried, each with a 
+        # listing that has the key as its prefix. The output folders are 
+        # shared by all requests to an endpoint, so listing them would cost 
+        # more as objects from other requests and past runs accumulate. The 
+        # failure key is only queried while the output key is missing.
+        from sagemaker.s3 import parse_s3_url
+        landed = []
+        for idx, batch_response in outstanding.items():
+            paths = [batch_response.output_path, getattr(batch_response, "failure_path", None)]
+            if any(self._exists(*parse_s3_url(path)) for path in paths if path is not None):
+                landed.append(idx)
+        return landed
+
+    def _exists(self, bucket, key):
+        # Keys are listed in order, so the key itself would be the first 
+        # match of its prefix.
+        response = self.s3.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+        return any(item["Key"] == key for item in response.get("Contents", []))
+
 
 class AsyncEndpoint:
 
-    def __init__(self, endpoint_helper, sagemaker_async_endpoint, endpoint_name, bucket_name, prefix, batch_size, wait_delay, wait_max_attempts):
+    def __init__(self, endpoint_helper, sagemaker_async_endpoint, endpoint_name, bucket_name, prefix, batch_size, wait_delay, wait_max_attempts, min_wait_delay=0.1, background_clean_up=True, token_budget=None, s3=None, observer=None, retry_policy=None):
         self.helper = endpoint_helper
         self.sagemaker_async_endpoint = sagemaker_async_endpoint
         self.endpoint_name = endpoint_name
         self.bucket_name = bucket_name
         self.prefix = prefix
         self.batch_size = batch_size
-        self.wait_config = WaiterConfig(delay=wait_delay, max_attempts=wait_max_attempts)
-        self.s3 = boto3.client("s3")
+        self.token_budget = token_budget
+        self.observer = observer
+        self.retry_policy = retry_policy
+        if s3 is None:
+            # boto3 is imported on first use to keep importing mtix fast.
+            import boto3
+            s3 = boto3.client("s3")
+        self.s3 = s3
+        self.tracker = AsyncResultTracker(self.s3, min(min_wait_delay, wait_delay), wait_delay, wait_delay * wait_max_attempts)
+        self.clean_up_executor = ThreadPoolExecutor(max_workers=1) if background_clean_up else None
+        # Only the most recent failed keys are kept, so a long running 
+        # process does not accumulate them without bound.
+        self.failed_clean_up_keys = deque(maxlen=FAILED_CLEAN_UP_KEYS_MAX_LEN)
 
     def predict(self, request):
         inputs, parameters = self.helper.process_request(request)
-
-        input_count = len(inputs)
-        num_batches = int(math.ceil(input_count/self.batch_size))
+        batch_index_list = create_batch_index_list(inputs, parameters, self.helper, self.batch_size, self.token_budget)
 
         response_list = []
         input_key_list = []
         output_key_list = []
+        submission_list = [None] * len(batch_index_list)
         try: 
-            for idx in range(num_batches):
-                batch_start = idx * self.batch_size
-                batch_end = (idx + 1) * self.batch_size
-                batch_inputs = inputs[batch_start:batch_end]
-                batch_data = self.helper.construct_batch_data(batch_inputs, parameters)
-                batch_uuid = str(uuid.uuid4())
-                batch_input_file = batch_uuid + ".in"
-                batch_input_key = os.path.join(self.prefix, self.endpoint_name, "inputs", batch_input_file)
-                input_key_list.append(batch_input_key)
-                batch_input_path = os.path.join(f"s3://{self.bucket_name}", batch_input_key)
-                batch_response = self.sagemaker_async_endpoint.predict_async(data=batch_data, input_path=batch_input_path)
+            for batch_idx, batch_indices in enumerate(batch_index_list):
+                batch_inputs = [inputs[idx] for idx in batch_indices]
+                batch_response = self._submit_batch(batch_inputs, parameters, input_key_list, output_key_list, submission_list, batch_idx)
                 response_list.append(batch_response)
-                batch_output_file = os.path.basename(batch_response.output_path)
-                batch_output_key = os.path.join(self.prefix, self.endpoint_name, "outputs", batch_output_file)
-                output_key_list.append(batch_output_key)
-
-            result_list = []
-            for batch_response, batch_input_key, batch_output_key in zip(response_list, input_key_list, output_key_list):
-                batch_result = batch_response.get_result(self.wait_config)
-                batch_result = self.helper.process_response(batch_result)
-                result_list.extend(batch_result)
+
+            observe_result = self._create_result_observer(batch_index_list, submission_list)
+            batch_result_list = self.tracker.wait(response_list, self.helper.process_response, observe_result)
+            result_list = reorder_batch_results(batch_index_list, batch_result_list, self.token_budget)
         finally:
-            self.clean_up(input_key_list, output_key_list)
+            self._schedule_clean_up(input_key_list, output_key_list)
 
         predictions = self.helper.construct_output(result_list)
         return predictions
 
-    def clean_up(self, input_key_list, output_key_list):
-        for batch_input_key, batch_output_key in zip(input_key_list, output_key_list):
-            self.try_delete(batch_input_key)
-            self.try_delete(batch_output_key)
+    async def apredict(self, request):
+        inputs, parameters = self.helper.process_request(request)
+        batch_index_list = create_batch_index_list(inputs, parameters, self.helper, self.batch_size, self.token_budget)
+
+        input_key_list = []
+        output_key_list = []
+        submission_list = [None] * len(batch_index_list)
+        submission_futures = []
+        try:
+            loop = asyncio.get_running_loop()
+            for batch_idx, batch_indices in enumerate(batch_index_list):
+                batch_inputs = [inputs[idx] for idx in batch_indices]
+                submission_future = Future()
+                loop.run_in_executor(None, self._run_submission, submission_future, batch_inputs, parameters, input_key_list, output_key_list, submission_list, batch_idx)
+                submission_futures.append(submission_future)
+            # Every submission is allowed to finish so that all of their keys 
+            # are recorded before clean up.
+            response_list = await asyncio.gather(*[asyncio.wrap_future(submission_future) for submission_future in submission_futures], return_exceptions=True)
+            for batch_response in response_list:
+                if isinstance(batch_response, BaseException):
+                    raise batch_response
+
+            observe_result = self._create_result_observer(batch_index_list, submission_list)
+            batch_result_list = await self.tracker.await_results(response_list, self.helper.process_response, observe_result)
+            result_list = reorder_batch_results(batch_index_list, batch_result_list, self.token_budget)
+        finally:
+            # If apredict is cancelled, the submissions that have not started 
+            # are cancelled with it, and clean up waits for the running ones.
+            self._schedule_clean_up(input_key_list, output_key_list, submission_futures)
 
-    def try_delete(self, key):
+        predictions = self.helper.construct_output(result_list)
+        return predictions
+
+    def _run_submission(self, submission_future, *args):
+        if not submission_future.set_running_or_notify_cancel():
+            return
+        try:
+            submission_future.set_result(self._submit_batch(*args))
+        except BaseException as error:
+            submission_future.set_exception(error)
+
+    def _submit_batch(self, batch_inputs, parameters, input_key_list, output_key_list, submission_list=None, batch_idx=None):
+        # The input key is recorded before submission so that it is cleaned up 
+        # even if the submission fails.
+        start_time = time.perf_counter()
+        batch_data = self.helper.construct_batch_data(batch_inputs, parameters)
+        batch_uuid = str(uuid.uuid4())
+        batch_input_file = batch_uuid + ".in"
+        batch_input_key = os.path.join(self.prefix, self.endpoint_name, "inputs", batch_input_file)
+        input_key_list.append(batch_input_key)
+        batch_input_path = os.path.join(f"s3://{self.bucket_name}", batch_input_key)
+        # A throttled submission is resent. Failed inferences are raised 
+        # when their results are fetched and are not retried.
+        retry_count = 0
+        while True:
+            try:
+                batch_response = self.sagemaker_async_endpoint.predict_async(data=batch_data, input_path=batch_input_path)
+                break
+            except Exception as error:
+                delay = get_retry_delay(self.retry_policy, error, retry_count + 1, self.endpoint_name)
+                if delay is None:
+                    raise
+            retry_count += 1
+            time.sleep(delay)
+        batch_output_file = os.path.basename(batch_response.output_path)
+        batch_output_key = os.path.join(self.prefix, self.endpoint_name, "outputs", batch_output_file)
+        output_key_list.append(batch_output_key)
+        if submission_list is not None:
+            # The request size is measured from the batch data already built 
+            # for the submission.
+            request_bytes = get_payload_size(batch_data) if self.observer is not None and self.observer.measure_payload_size else None
+            submission_list[batch_idx] = (start_time, time.perf_counter(), retry_count, request_bytes)
+        return batch_response
+
+    def _create_result_observer(self, batch_index_list, submission_list):
+        # Reports each batch when its result is processed. The call time runs 
+        # from submission to the result landing in S3, so it includes the 
+        # time in the async inference queue, and the queue wait is the time 
+        # spent waiting for earlier batches to be submitted.
+        if self.observer is None or len(submission_list) == 0:
+            return None
+        predict_start_time = min(start_time for start_time, _, _, _ in submission_list)
+        def observe_result(batch_idx, landed_time, response):
+            end_time = time.perf_counter()
+            start_time, submitted_time, retry_count, request_bytes = submission_list[batch_idx]
+            response_bytes = get_payload_size(response) if request_bytes is not None else None
+            self.observer.on_endpoint_batch(self.endpoint_name, end_time - start_time, len(batch_index_list[batch_idx]), request_bytes, response_bytes, submitted_time - start_time, landed_time - submitted_time, end_time - landed_time, start_time - predict_start_time, retry_count)
+        return observe_result
+
+    def clean_up(self, input_key_list, output_key_list):
+        key_list = input_key_list + output_key_list
+        failed_key_list = []
+        for idx in range(0, len(key_list), DELETE_OBJECTS_MAX_KEYS):
+            chunk_key_list = key_list[idx:idx + DELETE_OBJECTS_MAX_KEYS]
+            failed_key_list.extend(self._delete_keys(chunk_key_list))
+
+        if len(failed_key_list) > 0:
+            self.failed_clean_up_keys.extend(failed_key_list)
+            logger.warning("Failed to delete %d temporary object(s) from s3://%s: %s", len(failed_key_list), self.bucket_name, ", ".join(failed_key_list))
+        return failed_key_list
+
+    def wait_for_clean_up(self):
+        # The executor has a single worker, so once this no-op has run every 
+        # clean up scheduled before it has finished, including the 
+        # submissions each clean up waited for.
+        if self.clean_up_executor is not None:
+            self.clean_up_executor.submit(lambda: None).result()
+
+    def _delete_keys(self, key_list):
         try:
-            self.s3.delete_object(Bucket=self.bucket_name, Key=key)
-        except:
-            pass
+            response = self.s3.delete_objects(Bucket=self.bucket_name, Delete={ "Objects": [{ "Key": key } for key in key_list], "Quiet": True })
+        except Exception:
+            logger.exception("delete_objects request to s3://%s failed.", self.bucket_name)
+            return key_list
+        failed_key_list = [error["Key"] for error in response.get("Errors", [])]
+        return failed_key_list
+
+    def _schedule_clean_up(self, input_key_list, output_key_list, submission_futures=()):
+        # Temporary objects are deleted off the critical path of predict.
+        if self.clean_up_executor is None:
+            self._clean_up_after_submissions(input_key_list, output_key_list, submission_futures)
+        else:
+            self.clean_up_executor.submit(self._clean_up_after_submissions, input_key_list, output_key_list, submission_futures)
+
+    def _clean_up_after_submissions(self, input_key_list, output_key_list, submission_futures):
+        # The key lists are only complete once every submission still 
+        # running has finished.
+        wait(submission_futures)
+        return self.clean_up(list(input_key_list), list(output_key_list))
 
 
 class HuggingFaceRealTimeEndpoint(RealTimeEndpoint):
-    def __init__(self, sagemaker_rt_hf_endpoint, batch_size=128):
-        super().__init__(HuggingFaceEndpointHelper(), sagemaker_rt_hf_endpoint, batch_size)
+    def __init__(self, sagemaker_rt_hf_endpoint, batch_size=128, max_in_flight=1, token_budget=None, observer=None, endpoint_name=None, retry_policy=None, batch_controller=None):
+        super().__init__(HuggingFaceEndpointHelper(), sagemaker_rt_hf_endpoint, batch_size, max_in_flight, token_budget, observer, endpoint_name, retry_policy, batch_controller)
 
 
 class TensorflowRealTimeEndpoint(RealTimeEndpoint):
-    def __init__(self, sagemaker_rt_tf_endpoint, batch_size=128):
-        super().__init__(TensorflowEndpointHelper(), sagemaker_rt_tf_endpoint, batch_size)
+    def __init__(self, sagemaker_rt_tf_endpoint, batch_size=128, max_in_flight=1, observer=None, endpoint_name=None, retry_policy=None, batch_controller=None):
+        super().__init__(TensorflowEndpointHelper(), sagemaker_rt_tf_endpoint, batch_size, max_in_flight, observer=observer, endpoint_name=endpoint_name, retry_policy=retry_policy, batch_controller=batch_controller)
 
 
 class HuggingFaceAsyncEndpoint(AsyncEndpoint):
-    def __init__(self, sagemaker_hf_async_endpoint, endpoint_name, bucket_name, prefix, batch_size, wait_delay, wait_max_attempts):
-        super().__init__(HuggingFaceEndpointHelper(), sagemaker_hf_async_endpoint, endpoint_name, bucket_name, prefix, batch_size, wait_delay, wait_max_attempts)
+    def __init__(self, sagemaker_hf_async_endpoint, endpoint_name, bucket_name, prefix, batch_size, wait_delay, wait_max_attempts, token_budget=None, s3=None, observer=None, retry_policy=None):
+        super().__init__(HuggingFaceEndpointHelper(), sagemaker_hf_async_endpoint, endpoint_name, bucket_name, prefix, batch_size, wait_delay, wait_max_attempts, token_budget=token_budget, s3=s3, observer=observer, retry_policy=retry_policy)
 
 
 class TensorflowAsyncEndpoint(AsyncEndpoint):
-    def __init__(self, sagemaker_tf_async_endpoint, endpoint_name, bucket_name, prefix, batch_size, wait_delay, wait_max_attempts):
-        super().__init__(TensorflowEndpointHelper(), sagemaker_tf_async_endpoint, endpoint_name, bucket_name, prefix, batch_size, wait_delay, wait_max_attempts)
\ No newline at end of file
+    def __init__(self, sagemaker_tf_async_endpoint, endpoint_name, bucket_name, prefix, batch_size, wait_delay, wait_max_attempts, s3=None, observer=None, retry_policy=None):
+        super().__init__(TensorflowEndpointHelper(), sagemaker_tf_async_endpoint, endpoint_name, bucket_name, prefix, batch_size, wait_delay, wait_max_attempts, s3=s3, observer=observer, retry_policy=retry_policy)
\ No newline at end of file
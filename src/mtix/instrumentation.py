@@ -0,0 +1,196 @@
+import asyncio
+import json
+import threading
+import time
+
+
+class Observer:
+
+    # Receives timings from the pipelines and endpoints. All hooks are no-ops,
+    # so an observer only overrides the ones it needs. Hooks can be called
+    # from several threads at once.
+    #
+    # on_stage: a pipeline stage processed a batch of item_count citations.
+    # on_queue_wait: a batch waited wait_time seconds in the queue in front
+    # of a stage (predict_batches and predict_stream only).
+    # on_endpoint_batch: an endpoint batch of item_count inputs took
+    # wall_time seconds: request_time to construct the request, call_time in
+    # the SageMaker call (the network and inference, including the async
+    # inference queue), and response_time to process the response.
+    # queue_wait is the time the batch waited for a free slot before it was
+    # sent, and retries the number of times it was resent. request_bytes and 
+    # response_bytes are the JSON payload sizes if measure_payload_size is 
+    # set, and None otherwise, as measuring them serializes every payload 
+    # again.
+    measure_payload_size = False
+
+    def on_stage(self, stage_name, wall_time, item_count):
+        pass
+
+    def on_queue_wait(self, stage_name, wait_time):
+        pass
+
+    def on_endpoint_batch(self, endpoint_name, wall_time, item_count, request_bytes, response_bytes, request_time, call_time, response_time, queue_wait=0., retries=0):
+        pass
+
+
+class SummaryObserver(Observer):
+
+    # Adds up the timings per stage and per endpoint.
+    def __init__(self, measure_payload_size=False):
+        self.measure_payload_size = measure_payload_size
+        self.stages = {}
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def on_stage(self, stage_name, wall_time, item_count):
+        with self._lock:
+            summary = self._get_summary(self.stages, stage_name)
+            summary["batches"] += 1
+            summary["items"] += item_count
+            summary["wall_time"] += wall_time
+
+    def on_queue_wait(self, stage_name, wait_time):
+        with self._lock:
+            self._get_summary(self.stages, stage_name)["queue_wait"] += wait_time
+
+    def on_endpoint_batch(self, endpoint_name, wall_time, item_count, request_bytes, response_bytes, request_time, call_time, response_time, queue_wait=0., retries=0):
+        with self._lock:
+            summary = self._get_summary(self.endpoints, endpoint_name)
+            summary["batches"] += 1
+            summary["items"] += item_count
+            summary["wall_time"] += wall_time
+            summary["queue_wait"] += queue_wait
+            for key, value in [("request_bytes", request_bytes), ("response_bytes", response_bytes), ("request_time", request_time), ("call_time", call_time), ("response_time", response_time), ("retries", retries)]:
+                if value is not None:
+                    summary[key] = summary.get(key, 0) + value
+
+    def _get_summary(self, summary_lookup, name):
+        if name not in summary_lookup:
+            summary_lookup[name] = { "batches": 0, "items": 0, "wall_time": 0., "queue_wait": 0. }
+        return summary_lookup[name]
+
+
+class OpenTelemetryObserver(Observer):
+
+    # Records the timings as OpenTelemetry histograms and counters, with the
+    # stage or endpoint name as an attribute. opentelemetry-api is an
+    # optional dependency.
+    def __init__(self, meter=None, measure_payload_size=False):
+        self.measure_payload_size = measure_payload_size
+        if meter is None:
+            # Fails on construction if opentelemetry-api is not installed.
+            from opentelemetry import metrics
+            meter = metrics.get_meter("mtix")
+        self.stage_duration = meter.create_histogram("mtix.stage.duration", unit="s")
+        self.stage_items = meter.create_counter("mtix.stage.items")
+        self.stage_queue_wait = meter.create_histogram("mtix.stage.queue_wait", unit="s")
+        self.endpoint_duration = meter.create_histogram("mtix.endpoint.batch.duration", unit="s")
+        self.endpoint_phase_duration = meter.create_histogram("mtix.endpoint.batch.phase.duration", unit="s")
+        self.endpoint_queue_wait = meter.create_histogram("mtix.endpoint.batch.queue_wait", unit="s")
+        self.endpoint_items = meter.create_counter("mtix.endpoint.items")
+        self.endpoint_bytes = meter.create_counter("mtix.endpoint.bytes", unit="By")
+        self.endpoint_retries = meter.create_counter("mtix.endpoint.retries")
+
+    def on_stage(self, stage_name, wall_time, item_count):
+        attributes = { "stage": stage_name }
+        self.stage_duration.record(wall_time, attributes)
+        self.stage_items.add(item_count, attributes)
+
+    def on_queue_wait(self, stage_name, wait_time):
+        self.stage_queue_wait.record(wait_time, { "stage": stage_name })
+
+    def on_endpoint_batch(self, endpoint_name, wall_time, item_count, request_bytes, response_bytes, request_time, call_time, response_time, queue_wait=0., retries=0):
+        attributes = { "endpoint": endpoint_name }
+        self.endpoint_duration.record(wall_time, attributes)
+        for phase, phase_time in [("request", request_time), ("call", call_time), ("response", response_time)]:
+            self.endpoint_phase_duration.record(phase_time, { "endpoint": endpoint_name, "phase": phase })
+        self.endpoint_queue_wait.record(queue_wait, attributes)
+        self.endpoint_items.add(item_count, attributes)
+        if request_bytes is not None:
+            self.endpoint_bytes.add(request_bytes, { "endpoint": endpoint_name, "direction": "request" })
+            self.endpoint_bytes.add(response_bytes, { "endpoint": endpoint_name, "direction": "response" })
+        if retries > 0:
+            self.endpoint_retries.add(retries, attributes)
+
+
+class PrometheusObserver(Observer):
+
+    # Records the timings as Prometheus histograms and counters, labelled by
+    # stage or endpoint name. prometheus_client is an optional dependency.
+    def __init__(self, registry=None, namespace="mtix", measure_payload_size=False):
+        self.measure_payload_size = measure_payload_size
+        # Fails on construction if prometheus_client is not installed.
+        from prometheus_client import Counter, Histogram, REGISTRY
+        registry = registry if registry is not None else REGISTRY
+        self.stage_duration = Histogram("stage_duration_seconds", "Pipeline stage wall time per batch.", ["stage"], namespace=namespace, registry=registry)
+        self.stage_items = Counter("stage_items", "Citations processed by a pipeline stage.", ["stage"], namespace=namespace, registry=registry)
+        self.stage_queue_wait = Histogram("stage_queue_wait_seconds", "Time a batch waited in front of a pipeline stage.", ["stage"], namespace=namespace, registry=registry)
+        self.endpoint_duration = Histogram("endpoint_batch_duration_seconds", "Endpoint batch wall time.", ["endpoint"], namespace=namespace, registry=registry)
+        self.endpoint_phase_duration = Histogram("endpoint_batch_phase_duration_seconds", "Endpoint batch request, call and response time.", ["endpoint", "phase"], namespace=namespace, registry=registry)
+        self.endpoint_queue_wait = Histogram("endpoint_batch_queue_wait_seconds", "Time an endpoint batch waited before it was sent.", ["endpoint"], namespace=namespace, registry=registry)
+        self.endpoint_items = Counter("endpoint_items", "Inputs sent to an endpoint.", ["endpoint"], namespace=namespace, registry=registry)
+        self.endpoint_bytes = Counter("endpoint_bytes", "Endpoint request and response payload bytes.", ["endpoint", "direction"], namespace=namespace, registry=registry)
+        self.endpoint_retries = Counter("endpoint_retries", "Endpoint batch retries.", ["endpoint"], namespace=namespace, registry=registry)
+
+    def on_stage(self, stage_name, wall_time, item_count):
+        self.stage_duration.labels(stage_name).observe(wall_time)
+        self.stage_items.labels(stage_name).inc(item_count)
+
+    def on_queue_wait(self, stage_name, wait_time):
+        self.stage_queue_wait.labels(stage_name).observe(wait_time)
+
+    def on_endpoint_batch(self, endpoint_name, wall_time, item_count, request_bytes, response_bytes, request_time, call_time, response_time, queue_wait=0., retries=0):
+        self.endpoint_duration.labels(endpoint_name).observe(wall_time)
+        for phase, phase_time in [("request", request_time), ("call", call_time), ("response", response_time)]:
+            self.endpoint_phase_duration.labels(endpoint_name, phase).observe(phase_time)
+        self.endpoint_queue_wait.labels(endpoint_name).observe(queue_wait)
+        self.endpoint_items.labels(endpoint_name).inc(item_count)
+        if request_bytes is not None:
+            self.endpoint_bytes.labels(endpoint_name, "request").inc(request_bytes)
+            self.endpoint_bytes.labels(endpoint_name, "response").inc(response_bytes)
+        self.endpoint_retries.labels(endpoint_name).inc(retries)
+
+
+def get_payload_size(payload):
+    # Size of the JSON body, as sent to or received from SageMaker.
+    return len(json.dumps(payload).encode("utf-8"))
+
+
+def get_stage_name(stage):
+    # "_cnn_stage" and "_cnn_astage" -> "cnn", 
+    # partial(lookup_cached_predictions, ...) -> "lookup_cached_predictions".
+    if hasattr(stage, "stage_name"):
+        return stage.stage_name
+    name = stage.func.__name__ if hasattr(stage, "func") else stage.__name__
+    return name.strip("_").replace("_astage", "").replace("_stage", "")
+
+
+def observe_stage(stage, observer):
+    # Reports the wall time and citation count of each call to a stage. A 
+    # coroutine stage is wrapped in a coroutine, which includes the time 
+    # spent awaiting.
+    stage_name = get_stage_name(stage)
+    if asyncio.iscoroutinefunction(stage):
+        async def observed_astage(state):
+            start_time = time.perf_counter()
+            output_state = await stage(state)
+            observer.on_stage(stage_name, time.perf_counter() - start_time, len(state["input_data"]))
+            return output_state
+        observed_astage.stage_name = stage_name
+        return observed_astage
+
+    def observed_stage(state):
+        start_time = time.perf_counter()
+        output_state = stage(state)
+        observer.on_stage(stage_name, time.perf_counter() - start_time, len(state["input_data"]))
+        return output_state
+    observed_stage.stage_name = stage_name
+    return observed_stage
+
+
+def observe_stages(stages, observer):
+    # Stages are returned as they are when there is no observer.
+    if observer is None:
+        return stages
+    return [observe_stage(stage, observer) for stage in stages]
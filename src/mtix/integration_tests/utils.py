@@ -1,4 +1,3 @@
-import math
 from unittest import TestCase
 
 
@@ -47,14 +46,5 @@ class TestCaseBase(TestCase):
 
     def _predict(self, limit, batch_size=512):
         test_data = self.test_set_data[:limit]
-        citation_count = len(test_data)
-        num_batches = int(math.ceil(citation_count / batch_size))
-
-        predictions = []
-        for idx in range(num_batches):
-            batch_start = idx * batch_size
-            batch_end = (idx + 1) * batch_size
-            batch_inputs = test_data[batch_start:batch_end]
-            batch_predictions = self.pipeline.predict(batch_inputs)
-            predictions.extend(batch_predictions)
+        predictions = list(self.pipeline.predict_stream(test_data, batch_size=batch_size))
         return predictions
\ No newline at end of file
@@ -0,0 +1,321 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import json
+import os.path
+import random
+import threading
+import time
+import uuid
+from .utils import ENCODING
+
+
+LIST_OBJECTS_MAX_KEYS = 1000
+
+
+class LocalEndpointError(Exception):
+
+    # Carries a botocore style error response, like the throttling and 5xx 
+    # errors of real endpoints, so that it is retried by a RetryPolicy.
+    def __init__(self, message, error_code="ServiceUnavailable", status_code=503):
+        super().__init__(message)
+        self.response = { "Error": { "Code": error_code, "Message": message }, "ResponseMetadata": { "HTTPStatusCode": status_code } }
+
+
+def create_rng(*items):
+    # Seeded from the content, so the same input always gets the same scores.
+    text = json.dumps(items, sort_keys=True, ensure_ascii=False)
+    seed = int.from_bytes(hashlib.sha256(text.encode(ENCODING)).digest()[:8], "big")
+    return random.Random(seed)
+
+
+def split_s3_url(url):
+    bucket, _, key = url[len("s3://"):].partition("/")
+    return bucket, key
+
+
+class LatencyModel:
+
+    # Each request takes latency + latency_per_item x item count seconds,
+    # plus an exponentially distributed extra delay with mean jitter, which
+    # gives the long tail of real endpoints. A request fails with probability
+    # failure_rate. Draws are seeded, so a run can be repeated.
+    def __init__(self, latency=0., latency_per_item=0., jitter=0., failure_rate=0., seed=0, sleep=time.sleep):
+        self.latency = latency
+        self.latency_per_item = latency_per_item
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.sleep = sleep
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self, item_count):
+        with self._lock:
+            extra_delay = self._rng.expovariate(1 / self.jitter) if self.jitter > 0 else 0.
+            failed = self._rng.random() < self.failure_rate
+        delay = self.latency + self.latency_per_item * item_count + extra_delay
+        return delay, failed
+
+    def wait(self, item_count):
+        delay, failed = self.sample(item_count)
+        if delay > 0:
+            self.sleep(delay)
+        if failed:
+            raise LocalEndpointError("Simulated endpoint failure.")
+
+
+class SyntheticCnnModel:
+
+    # Returns top_n [label_id, score] pairs per instance, with the label ids
+    # drawn from label_ids and the scores sorted in descending order.
+    def __init__(self, label_ids, top_n=100):
+        self.label_ids = sorted(label_ids)
+        self.top_n = min(top_n, len(self.label_ids))
+
+    def __call__(self, data):
+        predictions = []
+        for instance in data["instances"]:
+            rng = create_rng("cnn", instance)
+            label_ids = rng.sample(self.label_ids, self.top_n)
+            scores = sorted((rng.random() ** 3 for _ in label_ids), reverse=True)
+            predictions.append([[float(label_id), score] for label_id, score in zip(label_ids, scores)])
+        return { "predictions": predictions }
+
+    def count_items(self, data):
+        return len(data["instances"])
+
+
+class SyntheticPointwiseModel:
+
+    # Returns LABEL_0 and LABEL_1 scores for each [[query, passage]] input.
+    def __call__(self, data):
+        response = []
+        for item in data["inputs"]:
+            score = create_rng("pointwise", item).random()
+            response.append([{ "label": "LABEL_0", "score": 1 - score }, { "label": "LABEL_1", "score": score }])
+        return response
+
+    def count_items(self, data):
+        return len(data["inputs"])
+
+
+class SyntheticListwiseModel:
+
+    # Returns an indexed score for each passage of each [[query, passages]]
+    # input, where the passages are "|" separated.
+    def __call__(self, data):
+        response = []
+        for item in data["inputs"]:
+            rng = create_rng("listwise", item)
+            passage_count = item[0][1].count("|")
+            response.append([{ "index": idx, "score": rng.random() } for idx in range(passage_count)])
+        return response
+
+    def count_items(self, data):
+        return len(data["inputs"])
+
+
+class SyntheticSubheadingModel:
+
+    # Returns up to max_subheadings [pmid, dui, qui, score] rows per main
+    # heading instance, with the quis drawn from qualifier_uis, or a single
+    # row with an empty qui when there are none.
+    def __init__(self, qualifier_uis, max_subheadings=3):
+        self.qualifier_uis = sorted(qualifier_uis)
+        self.max_subheadings = min(max_subheadings, len(self.qualifier_uis))
+
+    def __call__(self, data):
+        predictions = []
+        for instance in data["instances"]:
+            rng = create_rng("subheading", instance)
+            pmid, dui = str(instance["pmid"]), instance["main_heading_ui"]
+            quis = rng.sample(self.qualifier_uis, rng.randint(0, self.max_subheadings))
+            if len(quis) == 0:
+                predictions.append([pmid, dui, "", "0.000000000"])
+            for qui in quis:
+                predictions.append([pmid, dui, qui, f"{rng.random():.9f}"])
+        return { "predictions": predictions }
+
+    def count_items(self, data):
+        return len(data["instances"])
+
+
+class LocalPredictor:
+
+    # Stand-in for a real-time TensorFlowPredictor or HuggingFacePredictor.
+    # Requests and responses go through JSON, as they would over the wire.
+    # cpu_time is the CPU time spent on the endpoint side (decoding the 
+    # request, the synthetic model and encoding the response), which is not 
+    # part of the client side overhead.
+    def __init__(self, model, latency_model=None):
+        self.model = model
+        self.latency_model = latency_model if latency_model is not None else LatencyModel()
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.item_count = 0
+        self.cpu_time = 0.
+
+    def predict(self, data):
+        body = json.dumps(data)
+        start_time = time.thread_time()
+        data = json.loads(body)
+        item_count = self.model.count_items(data)
+        body = json.dumps(self.model(data))
+        elapsed_time = time.thread_time() - start_time
+        with self._lock:
+            self.request_count += 1
+            self.item_count += item_count
+            self.cpu_time += elapsed_time
+        self.latency_model.wait(item_count)
+        return json.loads(body)
+
+
+class LocalAsyncInferenceResponse:
+
+    def __init__(self, s3, output_path, failure_path):
+        self.s3 = s3
+        self.output_path = output_path
+        self.failure_path = failure_path
+
+    def get_result(self):
+        bucket, key = split_s3_url(self.failure_path)
+        if self.s3.exists(bucket, key):
+            message = self.s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode(ENCODING)
+            raise LocalEndpointError(message)
+        bucket, key = split_s3_url(self.output_path)
+        body = self.s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+        return json.loads(body.decode(ENCODING))
+
+
+class LocalAsyncPredictor:
+
+    # Stand-in for AsyncPredictor. The request is uploaded to input_path,
+    # and a worker thread runs the real-time predictor on it and writes the
+    # response (or the error) under output_path (or failure_path).
+    def __init__(self, predictor, s3, output_path, failure_path, max_workers=4):
+        self.predictor = predictor
+        self.s3 = s3
+        self.output_path = output_path.rstrip("/")
+        self.failure_path = failure_path.rstrip("/")
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def predict_async(self, data=None, input_path=None):
+        bucket, key = split_s3_url(input_path)
+        self.s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(data).encode(ENCODING))
+        inference_id = str(uuid.uuid4())
+        response = LocalAsyncInferenceResponse(self.s3, f"{self.output_path}/{inference_id}.out", f"{self.failure_path}/{inference_id}-error.out")
+        self.executor.submit(self._run, input_path, response)
+        return response
+
+    def _run(self, input_path, response):
+        bucket, key = split_s3_url(input_path)
+        data = json.loads(self.s3.get_object(Bucket=bucket, Key=key)["Body"].read().decode(ENCODING))
+        try:
+            result = self.predictor.predict(data)
+        except Exception as error:
+            bucket, key = split_s3_url(response.failure_path)
+            self.s3.put_object(Bucket=bucket, Key=key, Body=str(error).encode(ENCODING))
+            return
+        bucket, key = split_s3_url(response.output_path)
+        self.s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(result).encode(ENCODING))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class LocalS3Client:
+
+    # In-process emulator of the boto3 S3 client calls made by mtix.
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        if isinstance(Body, str):
+            Body = Body.encode(ENCODING)
+        with self._lock:
+            self._objects[(Bucket, Key)] = bytes(Body)
+        return {}
+
+    def get_object(self, Bucket, Key):
+        with self._lock:
+            if (Bucket, Key) not in self._objects:
+                # Raised as by boto3, so callers can handle a missing key in 
+                # the same way for both clients.
+                from botocore.exceptions import ClientError
+                raise ClientError({ "Error": { "Code": "NoSuchKey", "Message": "The specified key does not exist.", "Key": Key }, "ResponseMetadata": { "HTTPStatusCode": 404 } }, "GetObject")
+            return { "Body": io.BytesIO(self._objects[(Bucket, Key)]) }
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=LIST_OBJECTS_MAX_KEYS, ContinuationToken=None):
+        with self._lock:
+            keys = sorted(key for bucket, key in self._objects if bucket == Bucket and key.startswith(Prefix))
+        if ContinuationToken is not None:
+            keys = [key for key in keys if key > ContinuationToken]
+        response = { "KeyCount": min(len(keys), MaxKeys), "IsTruncated": len(keys) > MaxKeys }
+        if len(keys) > 0:
+            response["Contents"] = [{ "Key": key } for key in keys[:MaxKeys]]
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = keys[MaxKeys - 1]
+        return response
+
+    def delete_objects(self, Bucket, Delete):
+        with self._lock:
+            for item in Delete["Objects"]:
+                self._objects.pop((Bucket, item["Key"]), None)
+        return {}
+
+    def exists(self, bucket, key):
+        with self._lock:
+            return (bucket, key) in self._objects
+
+    def __len__(self):
+        return len(self._objects)
+
+
+class LocalSageMakerBackend:
+
+    # Stand-in for sagemaker_factory.SageMakerBackend. Models and latency
+    # models are looked up by endpoint name, and endpoints without a latency
+    # model respond immediately.
+    def __init__(self, model_lookup, latency_model_lookup=None, s3=None, async_max_workers=4):
+        self.model_lookup = model_lookup
+        self.latency_model_lookup = latency_model_lookup if latency_model_lookup is not None else {}
+        self.s3 = s3 if s3 is not None else LocalS3Client()
+        self.async_max_workers = async_max_workers
+        self.predictor_lookup = {}
+        self.async_predictors = []
+
+    def create_tensorflow_predictor(self, endpoint_name):
+        return self._create_predictor(endpoint_name)
+
+    def create_huggingface_predictor(self, endpoint_name):
+        return self._create_predictor(endpoint_name)
+
+    def create_async_predictor(self, predictor, bucket_name, prefix, endpoint_name):
+        folder = os.path.join(f"s3://{bucket_name}", prefix, endpoint_name)
+        async_predictor = LocalAsyncPredictor(predictor, self.s3, f"{folder}/outputs", f"{folder}/failures", self.async_max_workers)
+        self.async_predictors.append(async_predictor)
+        return async_predictor
+
+    def shutdown(self):
+        for async_predictor in self.async_predictors:
+            async_predictor.shutdown()
+
+    def _create_predictor(self, endpoint_name):
+        predictor = LocalPredictor(self.model_lookup[endpoint_name], self.latency_model_lookup.get(endpoint_name))
+        self.predictor_lookup[endpoint_name] = predictor
+        return predictor
+
+
+def create_local_sagemaker_backend(label_ids, qualifier_uis, cnn_endpoint_name, pointwise_endpoint_name, listwise_endpoint_name, subheading_endpoint_name=None, latency_model_lookup=None, s3=None):
+    # Synthetic models for the endpoints of the indexing pipeline. label_ids
+    # and qualifier_uis should be the keys of the name and subheading name
+    # lookups.
+    model_lookup = {
+        cnn_endpoint_name: SyntheticCnnModel(label_ids),
+        pointwise_endpoint_name: SyntheticPointwiseModel(),
+        listwise_endpoint_name: SyntheticListwiseModel(),
+    }
+    if subheading_endpoint_name is not None:
+        model_lookup[subheading_endpoint_name] = SyntheticSubheadingModel(qualifier_uis)
+    return LocalSageMakerBackend(model_lookup, latency_model_lookup, s3)
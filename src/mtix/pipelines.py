@@ -1,42 +1,353 @@
-from .utils import average_top_results
+import asyncio
+from functools import partial
+import queue
+import threading
+import time
+from .instrumentation import get_stage_name, observe_stages
+from .utils import average_top_results, create_input_batches, PAD_LABEL_ID
+
+
+QUEUE_POLL_INTERVAL = 0.1
 
 
 # Note: top results are not always sorted
 class MeshHeadingPredictionPipeline:
 
-    def __init__(self, input_data_parser, citation_data_sanitizer, cnn_model_top_n_predictor, pointwise_model_top_n_predictor, listwise_model_top_n_predictor, results_formatter):
+    def __init__(self, input_data_parser, citation_data_sanitizer, cnn_model_top_n_predictor, pointwise_model_top_n_predictor, listwise_model_top_n_predictor, results_formatter, prediction_cache=None, observer=None):
         self.input_data_parser = input_data_parser
         self.citation_data_sanitizer = citation_data_sanitizer
         self.cnn_model_top_n_predictor = cnn_model_top_n_predictor
         self.pointwise_model_top_n_predictor = pointwise_model_top_n_predictor
         self.listwise_model_top_n_predictor = listwise_model_top_n_predictor
         self.results_formatter = results_formatter
+        self.prediction_cache = prediction_cache
+        self.observer = observer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # Shuts down the parser worker processes, if any.
+        self.input_data_parser.close()
 
     def predict(self, input_data):
+        predictions, _ = self.predict_with_citation_data(input_data)
+        return predictions
+
+    async def apredict(self, input_data):
+        predictions, _ = await self.apredict_with_citation_data(input_data)
+        return predictions
+
+    def predict_with_citation_data(self, input_data):
+        # Also returns the parsed and sanitized citation data (keyed by pmid) 
+        # so that later stages do not need to decode the input again.
+        state = { "input_data": input_data }
+        for stage in observe_stages(self.create_stages(self.prediction_cache), self.observer):
+            state = stage(state)
+        return state["predictions"], state["citation_data_lookup"]
+
+    async def apredict_with_citation_data(self, input_data):
+        state = await arun_stages(observe_stages(self.create_astages(self.prediction_cache), self.observer), { "input_data": input_data })
+        return state["predictions"], state["citation_data_lookup"]
+
+    def predict_batches(self, input_batches, max_queue_size=1):
+        # Overlaps the stages of consecutive batches, e.g. the CNN endpoint 
+        # predicts batch i + 1 while the pointwise endpoint predicts batch i. 
+        # Yields the predictions for each batch in input order.
+        executor = PipelinedExecutor(observe_stages(self.create_stages(self.prediction_cache), self.observer), max_queue_size, self.observer)
+        for state in executor.run({ "input_data": input_data } for input_data in input_batches):
+            yield state["predictions"]
+
+    def predict_stream(self, input_data, batch_size=512, max_queue_size=1):
+        # Consumes the input lazily and yields MTI JSON records as their 
+        # batches finish. At most a few batches are held in memory at a time, 
+        # regardless of the input size.
+        for predictions in self.predict_batches(create_input_batches(input_data, batch_size), max_queue_size):
+            yield from predictions
+
+    def create_stages(self, prediction_cache=None, extra_stages=()):
+        # Each stage takes and returns a state dict. The model stages only 
+        # predict the citations in state["predict_lookup"], which are the 
+        # cache misses when a prediction cache is used.
+        return self._create_stages([self._cnn_stage, self._pointwise_stage, self._listwise_stage], prediction_cache, extra_stages)
+
+    def create_astages(self, prediction_cache=None, extra_stages=()):
+        # Same as create_stages, but the model stages are coroutines that 
+        # await the endpoints. Run them with arun_stages.
+        return self._create_stages([self._cnn_astage, self._pointwise_astage, self._listwise_astage], prediction_cache, extra_stages)
+
+    def _create_stages(self, model_stages, prediction_cache, extra_stages):
+        stages = [self._parse_stage]
+        if prediction_cache is not None:
+            stages.append(partial(lookup_cached_predictions, prediction_cache))
+        stages.extend(model_stages)
+        stages.append(self._format_stage)
+        stages.extend(extra_stages)
+        if prediction_cache is not None:
+            stages.append(partial(store_cached_predictions, prediction_cache))
+        return stages
+
+    def _parse_stage(self, state):
+        citation_data_lookup = self._create_citation_data_lookup(state["input_data"])
+        return dict(state, citation_data_lookup=citation_data_lookup, predict_lookup=citation_data_lookup)
+
+    def _cnn_stage(self, state):
+        if len(state["predict_lookup"]) == 0:
+            return state
+        cnn_results = self.cnn_model_top_n_predictor.predict(state["predict_lookup"])
+        return dict(state, cnn_results=cnn_results)
+
+    def _pointwise_stage(self, state):
+        if len(state["predict_lookup"]) == 0:
+            return state
+        pointwise_results = self.pointwise_model_top_n_predictor.predict(state["predict_lookup"], state["cnn_results"])
+        pointwsie_avg_results = average_top_results(state["cnn_results"], pointwise_results)
+        return dict(state, pointwise_avg_results=pointwsie_avg_results)
+
+    def _listwise_stage(self, state):
+        if len(state["predict_lookup"]) == 0:
+            return state
+        listwise_results = self.listwise_model_top_n_predictor.predict(state["predict_lookup"], state["pointwise_avg_results"])
+        listwise_avg_results = average_top_results(state["pointwise_avg_results"], listwise_results)
+        return dict(state, listwise_avg_results=listwise_avg_results)
+
+    async def _cnn_astage(self, state):
+        if len(state["predict_lookup"]) == 0:
+            return state
+        cnn_results = await self.cnn_model_top_n_predictor.apredict(state["predict_lookup"])
+        return dict(state, cnn_results=cnn_results)
+
+    async def _pointwise_astage(self, state):
+        if len(state["predict_lookup"]) == 0:
+            return state
+        pointwise_results = await self.pointwise_model_top_n_predictor.apredict(state["predict_lookup"], state["cnn_results"])
+        pointwsie_avg_results = average_top_results(state["cnn_results"], pointwise_results)
+        return dict(state, pointwise_avg_results=pointwsie_avg_results)
+
+    async def _listwise_astage(self, state):
+        if len(state["predict_lookup"]) == 0:
+            return state
+        listwise_results = await self.listwise_model_top_n_predictor.apredict(state["predict_lookup"], state["pointwise_avg_results"])
+        listwise_avg_results = average_top_results(state["pointwise_avg_results"], listwise_results)
+        return dict(state, listwise_avg_results=listwise_avg_results)
+
+    def _format_stage(self, state):
+        if len(state["predict_lookup"]) == 0:
+            return self._create_output_state(state, [])
+        predictions = self._format_results(state["input_data"], state["listwise_avg_results"])
+        return self._create_output_state(state, predictions)
+
+    def _create_output_state(self, state, predictions):
+        # Drops the intermediate results.
+        output_state = { key: state[key] for key in ["input_data", "citation_data_lookup", "cached_indexing_lookup"] if key in state }
+        output_state["predictions"] = predictions
+        return output_state
+
+    def _create_citation_data_lookup(self, input_data):
         citation_data_list = self.input_data_parser.parse(input_data)
         self.citation_data_sanitizer.sanitize_list(citation_data_list)
         citation_data_lookup = {citation_data["pmid"]: citation_data for citation_data in citation_data_list}
-        cnn_results = self.cnn_model_top_n_predictor.predict(citation_data_lookup)
-        pointwise_results = self.pointwise_model_top_n_predictor.predict(citation_data_lookup, cnn_results)
-        pointwsie_avg_results = average_top_results(cnn_results, pointwise_results)
-        listwise_results = self.listwise_model_top_n_predictor.predict(citation_data_lookup, pointwsie_avg_results)
-        listwise_avg_results = average_top_results(pointwsie_avg_results, listwise_results)
+        return citation_data_lookup
+
+    def _format_results(self, input_data, top_results):
         input_data_lookup = { item["uid"]: item["data"] for item in input_data}
-        predictions = self.results_formatter.format(input_data_lookup, listwise_avg_results)
+        predictions = self.results_formatter.format(input_data_lookup, top_results)
         return predictions
 
             
 class IndexingPipeline:
 
-    def __init__(self, mesh_heading_prediction_pipeline, subheading_predictor):
+    def __init__(self, mesh_heading_prediction_pipeline, subheading_predictor, prediction_cache=None, observer=None):
         self.mesh_heading_prediction_pipeline = mesh_heading_prediction_pipeline
         self.subheading_predictor = subheading_predictor
+        self.prediction_cache = prediction_cache
+        self.observer = observer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.mesh_heading_prediction_pipeline.close()
 
     def predict(self, input_data):
-        mesh_heading_prediction_result = self.mesh_heading_prediction_pipeline.predict(input_data)
-        predictions = self.subheading_predictor.predict(mesh_heading_prediction_result)
+        if self.prediction_cache is not None or self.observer is not None:
+            state = { "input_data": input_data }
+            for stage in observe_stages(self.create_stages(), self.observer):
+                state = stage(state)
+            return state["predictions"]
+        mesh_heading_prediction_result, citation_data_lookup = self.mesh_heading_prediction_pipeline.predict_with_citation_data(input_data)
+        predictions = self.subheading_predictor.predict(mesh_heading_prediction_result, citation_data_lookup)
+        return predictions
+
+    async def apredict(self, input_data):
+        if self.prediction_cache is not None or self.observer is not None:
+            state = await arun_stages(observe_stages(self.create_astages(), self.observer), { "input_data": input_data })
+            return state["predictions"]
+        mesh_heading_prediction_result, citation_data_lookup = await self.mesh_heading_prediction_pipeline.apredict_with_citation_data(input_data)
+        predictions = await self.subheading_predictor.apredict(mesh_heading_prediction_result, citation_data_lookup)
         return predictions
 
+    def predict_batches(self, input_batches, max_queue_size=1):
+        executor = PipelinedExecutor(observe_stages(self.create_stages(), self.observer), max_queue_size, self.observer)
+        for state in executor.run({ "input_data": input_data } for input_data in input_batches):
+            yield state["predictions"]
+
+    def predict_stream(self, input_data, batch_size=512, max_queue_size=1):
+        for predictions in self.predict_batches(create_input_batches(input_data, batch_size), max_queue_size):
+            yield from predictions
+
+    def create_stages(self):
+        # The indexing cache replaces the mesh heading pipeline cache, so that 
+        # hits skip the subheading endpoint as well.
+        return self.mesh_heading_prediction_pipeline.create_stages(self.prediction_cache, [self._subheading_stage])
+
+    def create_astages(self):
+        return self.mesh_heading_prediction_pipeline.create_astages(self.prediction_cache, [self._subheading_astage])
+
+    def _subheading_stage(self, state):
+        if len(state["predictions"]) == 0:
+            return state
+        predictions = self.subheading_predictor.predict(state["predictions"], state["citation_data_lookup"])
+        return dict(state, predictions=predictions)
+
+    async def _subheading_astage(self, state):
+        if len(state["predictions"]) == 0:
+            return state
+        predictions = await self.subheading_predictor.apredict(state["predictions"], state["citation_data_lookup"])
+        return dict(state, predictions=predictions)
+
+
+async def arun_stages(stages, state):
+    # Runs the stages in order, awaiting the ones that are coroutines.
+    for stage in stages:
+        if asyncio.iscoroutinefunction(stage):
+            state = await stage(state)
+        else:
+            state = stage(state)
+    return state
+
+
+def lookup_cached_predictions(prediction_cache, state):
+    # Only the cache misses are left to predict.
+    citation_data_lookup = state["citation_data_lookup"]
+    cached_indexing_lookup = prediction_cache.get_many(citation_data_lookup)
+    predict_lookup = { pmid: citation_data for pmid, citation_data in citation_data_lookup.items() if pmid not in cached_indexing_lookup }
+    return dict(state, predict_lookup=predict_lookup, cached_indexing_lookup=cached_indexing_lookup)
+
+
+def store_cached_predictions(prediction_cache, state):
+    # Caches the new predictions and merges them with the cached ones in 
+    # input order.
+    indexing_lookup = { prediction["PMID"]: prediction["Indexing"] for prediction in state["predictions"] }
+    if len(indexing_lookup) > 0:
+        prediction_cache.set_many(state["citation_data_lookup"], indexing_lookup)
+    prediction_lookup = { prediction["PMID"]: prediction for prediction in state["predictions"] }
+    cached_indexing_lookup = state["cached_indexing_lookup"]
+    predictions = []
+    for item in state["input_data"]:
+        pmid = item["uid"]
+        if pmid in prediction_lookup:
+            predictions.append(prediction_lookup[pmid])
+        elif pmid in cached_indexing_lookup:
+            predictions.append({ "PMID": pmid, "text-gz-64": item["data"], "Indexing": cached_indexing_lookup[pmid] })
+    output_state = { key: value for key, value in state.items() if key != "cached_indexing_lookup" }
+    output_state["predictions"] = predictions
+    return output_state
+
+
+class _StageError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_END_OF_STREAM = object()
+
+
+class PipelinedExecutor:
+
+    # Runs a list of stages over a stream of items with one thread per stage. 
+    # Stages are connected by bounded queues, so stage k of item i + 1 runs 
+    # concurrently with stage k + 1 of item i while at most max_queue_size 
+    # items wait between two stages. Results are yielded in input order. An 
+    # exception in any stage (or in the input iterable) is raised to the 
+    # consumer, and the remaining threads stop once the consumer is done. 
+    # With an observer, the time each item waits in the queue in front of a 
+    # stage is reported.
+    def __init__(self, stages, max_queue_size=1, observer=None):
+        self.stages = stages
+        self.max_queue_size = max_queue_size
+        self.observer = observer
+
+    def run(self, items):
+        stop_event = threading.Event()
+        queues = [queue.Queue(maxsize=self.max_queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], stop_event), daemon=True)]
+        for idx, stage in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._run_stage, args=(stage, queues[idx], queues[idx + 1], stop_event), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                _, item = queues[-1].get()
+                if item is _END_OF_STREAM:
+                    break
+                if isinstance(item, _StageError):
+                    raise item.exception
+                yield item
+        finally:
+            stop_event.set()
+
+    def _feed(self, items, output_queue, stop_event):
+        try:
+            for item in items:
+                if not self._put(output_queue, item, stop_event):
+                    return
+        except Exception as exception:
+            self._put(output_queue, _StageError(exception), stop_event)
+            return
+        self._put(output_queue, _END_OF_STREAM, stop_event)
+
+    def _run_stage(self, stage, input_queue, output_queue, stop_event):
+        stage_name = get_stage_name(stage) if self.observer is not None else None
+        while True:
+            put_time, item = self._get(input_queue, stop_event)
+            if item is not _END_OF_STREAM and not isinstance(item, _StageError):
+                if self.observer is not None:
+                    self.observer.on_queue_wait(stage_name, time.perf_counter() - put_time)
+                try:
+                    item = stage(item)
+                except Exception as exception:
+                    item = _StageError(exception)
+            if not self._put(output_queue, item, stop_event):
+                return
+            if item is _END_OF_STREAM or isinstance(item, _StageError):
+                return
+
+    def _get(self, input_queue, stop_event):
+        while not stop_event.is_set():
+            try:
+                return input_queue.get(timeout=QUEUE_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return None, _END_OF_STREAM
+
+    def _put(self, output_queue, item, stop_event):
+        # Items are queued with the time they were put.
+        while not stop_event.is_set():
+            try:
+                output_queue.put((time.perf_counter(), item), timeout=QUEUE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
 
 class MtiJsonResultsFormatter:
     def __init__(self, name_lookup, type_lookup, ui_lookup, threshold):
@@ -47,23 +358,22 @@ class MtiJsonResultsFormatter:
 
     def format(self, input_data_lookup, results):
         mti_json = []
-        for q_id in results:
-            pmid = int(q_id)
+        results = results.threshold(self.threshold)
+        result_counts = (results.label_ids != PAD_LABEL_ID).sum(axis=1).tolist()
+        for pmid, label_ids, scores, result_count in zip(results.pmids.tolist(), results.label_ids.tolist(), results.scores.tolist(), result_counts):
             citation_predictions = { "PMID": pmid, "text-gz-64": input_data_lookup[pmid], "Indexing": [] }
             mti_json.append(citation_predictions)
-            for p_id, score in sorted(results[q_id].items(), key=lambda x: x[1], reverse=True):
-                if score >= self.threshold:
-                    label_id = int(p_id)
-                    name = self.name_lookup[label_id]
-                    _type = self.type_lookup[label_id]
-                    ui = self.ui_lookup[label_id]
-                    citation_predictions["Indexing"].append({
-                        "Term": name, 
-                        "Type": _type, 
-                        "ID": ui, 
-                        "IM": "NO", 
-                        "Reasons": [{
-                            "Kind": "MTIX",
-                            "Score": round(score, 3) }]
-                        })
-        return mti_json
\ No newline at end of file
+            for label_id, score in zip(label_ids[:result_count], scores[:result_count]):
+                name = self.name_lookup[label_id]
+                _type = self.type_lookup[label_id]
+                ui = self.ui_lookup[label_id]
+                citation_predictions["Indexing"].append({
+                    "Term": name, 
+                    "Type": _type, 
+                    "ID": ui, 
+                    "IM": "NO", 
+                    "Reasons": [{
+                        "Kind": "MTIX",
+                        "Score": round(score, 3) }]
+                    })
+        return mti_json
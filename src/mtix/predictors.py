@@ -1,5 +1,6 @@
-import copy
+import numpy as np
 import re
+from .utils import create_input_batches, PAD_LABEL_ID, TopNResults
 
 
 QUERY_TEMPLATE = "Journal: {journal_title} | Title: {title} | Abstract: {abstract}"
@@ -24,73 +25,129 @@ class CnnModelTop100Predictor:
         self.tensorflow_endpoint = tensorflow_endpoint
 
     def predict(self, citation_data_lookup):
-        citation_data_list = list(citation_data_lookup.values())
-        instances = [{ key: value for key, value in citation_data.items() if key not in ["pmid", "journal_title"] } for citation_data in citation_data_list]
+        data = self._create_input_data(citation_data_lookup)
+        response = self.tensorflow_endpoint.predict(data)
+        top_results = self._create_top_results(citation_data_lookup, response)
+        return top_results
+
+    async def apredict(self, citation_data_lookup):
+        data = self._create_input_data(citation_data_lookup)
+        response = await self.tensorflow_endpoint.apredict(data)
+        top_results = self._create_top_results(citation_data_lookup, response)
+        return top_results
+
+    def _create_input_data(self, citation_data_lookup):
+        instances = [{ key: value for key, value in citation_data.items() if key not in ["pmid", "journal_title"] } for citation_data in citation_data_lookup.values()]
         instances = replace_brackets(instances)
         data = { "instances": instances }
-        response = self.tensorflow_endpoint.predict(data)
+        return data
+
+    def _create_top_results(self, citation_data_lookup, response):
+        # Each citation prediction is a list of [label_id, score] pairs.
         predictions = response["predictions"]
-        pmids = [citation_data["pmid"] for citation_data in citation_data_list]
-        top_results = { str(pmid): { str(int(label_id)): float(score) for label_id, score in citation_top_results} for pmid, citation_top_results in zip(pmids, predictions)}
+        pmids = [citation_data["pmid"] for citation_data in citation_data_lookup.values()]
+        if len(pmids) > 0:
+            predictions = np.asarray(predictions, dtype=np.float64).reshape(len(pmids), -1, 2)
+        else:
+            predictions = np.zeros((0, 0, 2))
+        top_results = TopNResults(pmids, predictions[:, :, 0].astype(np.int32), predictions[:, :, 1])
         return top_results
 
 
+class CachedCnnModelTop100Predictor:
+
+    # Wraps a CNN predictor with a CnnResultsCache. Only the cache misses are 
+    # sent to the endpoint, and their results are cached.
+    def __init__(self, cnn_model_top_n_predictor, cnn_results_cache):
+        self.cnn_model_top_n_predictor = cnn_model_top_n_predictor
+        self.cnn_results_cache = cnn_results_cache
+
+    def predict(self, citation_data_lookup):
+        cached_results, miss_lookup = self._lookup(citation_data_lookup)
+        if len(miss_lookup) == 0:
+            return cached_results
+        miss_results = self.cnn_model_top_n_predictor.predict(miss_lookup)
+        return self._combine(citation_data_lookup, miss_lookup, cached_results, miss_results)
+
+    async def apredict(self, citation_data_lookup):
+        cached_results, miss_lookup = self._lookup(citation_data_lookup)
+        if len(miss_lookup) == 0:
+            return cached_results
+        miss_results = await self.cnn_model_top_n_predictor.apredict(miss_lookup)
+        return self._combine(citation_data_lookup, miss_lookup, cached_results, miss_results)
+
+    def _lookup(self, citation_data_lookup):
+        cached_results = self.cnn_results_cache.get_many(citation_data_lookup)
+        cached_pmids = set(cached_results.pmids.tolist())
+        miss_lookup = { pmid: citation_data for pmid, citation_data in citation_data_lookup.items() if pmid not in cached_pmids }
+        return cached_results, miss_lookup
+
+    def _combine(self, citation_data_lookup, miss_lookup, cached_results, miss_results):
+        self.cnn_results_cache.set_many(miss_lookup, miss_results)
+        pmids = [citation_data["pmid"] for citation_data in citation_data_lookup.values()]
+        return TopNResults.concatenate([cached_results, miss_results]).align(pmids)
+
+
 class PointwiseModelTopNPredictor:
 
-    def __init__(self, huggingface_endpoint, passage_lookup, top_n):
+    def __init__(self, huggingface_endpoint, passage_lookup, top_n, padding="max_length"):
         self.huggingface_endpoint = huggingface_endpoint
         self.passage_lookup = passage_lookup
         self.top_n = top_n
+        self.padding = padding
  
     def predict(self, citation_data_lookup, input_top_results):
-        pmid_list, label_id_list, input_list = self._create_inputs(citation_data_lookup, input_top_results)
+        top_label_results, input_list = self._create_inputs(citation_data_lookup, input_top_results)
         score_list = self._predict_internal(input_list)
-        output_top_results = self._create_top_results(pmid_list, label_id_list, score_list)
+        output_top_results = self._create_top_results(top_label_results, score_list)
         return output_top_results
 
-    def _create_citation_inputs(self, citation_data, citation_top_results):
-        input_list = []
-        label_id_list = []
-        for p_id, _ in sorted(citation_top_results.items(), key=lambda x: x[1], reverse=True)[:self.top_n]:
-            label_id = int(p_id)
-            query = QUERY_TEMPLATE.format(journal_title=citation_data["journal_title"], title=citation_data["title"], abstract=citation_data["abstract"])
-            passage = self.passage_lookup[label_id]
-            input_list.append([[query, passage]])
-            label_id_list.append(label_id)
-        return input_list, label_id_list
+    async def apredict(self, citation_data_lookup, input_top_results):
+        top_label_results, input_list = self._create_inputs(citation_data_lookup, input_top_results)
+        score_list = await self._apredict_internal(input_list)
+        output_top_results = self._create_top_results(top_label_results, score_list)
+        return output_top_results
+
+    def _create_citation_inputs(self, citation_data, citation_label_ids):
+        # The query is built once per citation and the same string object is 
+        # shared by all of the citation's inputs.
+        query = QUERY_TEMPLATE.format(journal_title=citation_data["journal_title"], title=citation_data["title"], abstract=citation_data["abstract"])
+        input_list = [[[query, self.passage_lookup[label_id]]] for label_id in citation_label_ids if label_id != PAD_LABEL_ID]
+        return input_list
 
     def _create_inputs(self, citation_data_lookup, input_top_results):
-        pmid_list = []
-        label_id_list = []
+        top_label_results = input_top_results.top_k(self.top_n)
         input_list = []
-        for q_id in input_top_results:
-            pmid = int(q_id)
+        for pmid, citation_label_ids in zip(top_label_results.pmids.tolist(), top_label_results.label_ids.tolist()):
             citation_data = citation_data_lookup[pmid]
-            citation_top_results = input_top_results[q_id]
-            citation_input_list, citation_label_id_list = self._create_citation_inputs(citation_data, citation_top_results)
-            pmid_list.extend([pmid]*self.top_n)
-            label_id_list.extend(citation_label_id_list)
-            input_list.extend(citation_input_list)
-        return pmid_list, label_id_list, input_list
-
-    def _create_top_results(self, pmid_list, label_id_list, score_list):
-        top_results = {}
-        result_count = len(score_list)
-        for idx in range(result_count):
-            pmid = pmid_list[idx]
-            label_id = label_id_list[idx]
-            score = score_list[idx]
-            q_id = str(pmid)
-            p_id = str(label_id)
-            if q_id not in top_results:
-                top_results[q_id] = {}
-            top_results[q_id][p_id] = score
+            input_list.extend(self._create_citation_inputs(citation_data, citation_label_ids))
+        return top_label_results, input_list
+
+    def _create_top_results(self, top_label_results, score_list):
+        label_ids = top_label_results.label_ids
+        scores = np.full(label_ids.shape, -np.inf)
+        scores[label_ids != PAD_LABEL_ID] = score_list
+        top_results = TopNResults(top_label_results.pmids, label_ids, scores)
         return top_results
 
     def _predict_internal(self, input_list):
-        input_data = { "inputs": input_list, "parameters": { "max_length": 512, "padding": "max_length", "truncation": "longest_first", "return_all_scores": True }, }
-        score_list = self.huggingface_endpoint.predict(input_data)
-        score_list = [float(label_score["score"]) for label_score_list in score_list for label_score in label_score_list if label_score["label"] == "LABEL_1"]
+        input_data = self._create_input_data(input_list)
+        response = self.huggingface_endpoint.predict(input_data)
+        score_list = self._create_score_list(response)
+        return score_list
+
+    async def _apredict_internal(self, input_list):
+        input_data = self._create_input_data(input_list)
+        response = await self.huggingface_endpoint.apredict(input_data)
+        score_list = self._create_score_list(response)
+        return score_list
+
+    def _create_input_data(self, input_list):
+        input_data = { "inputs": input_list, "parameters": { "max_length": 512, "padding": self.padding, "truncation": "longest_first", "return_all_scores": True }, }
+        return input_data
+
+    def _create_score_list(self, response):
+        score_list = [float(label_score["score"]) for label_score_list in response for label_score in label_score_list if label_score["label"] == "LABEL_1"]
         return score_list
 
 
@@ -102,60 +159,98 @@ class ListwiseModelTopNPredictor:
         self.top_n = top_n
 
     def predict(self, citation_data_lookup, input_top_results):
-        input_data, pmid_list, top_label_ids = self._create_input_data(citation_data_lookup, input_top_results)
-        score_lookup = self._predict_internal(input_data)
-        output_top_results = self._create_top_results(pmid_list, top_label_ids, score_lookup)
+        input_data, top_label_results = self._create_input_data(citation_data_lookup, input_top_results)
+        predictions = self.huggingface_endpoint.predict(input_data)
+        output_top_results = self._create_top_results(top_label_results, predictions)
+        return output_top_results
+
+    async def apredict(self, citation_data_lookup, input_top_results):
+        input_data, top_label_results = self._create_input_data(citation_data_lookup, input_top_results)
+        predictions = await self.huggingface_endpoint.apredict(input_data)
+        output_top_results = self._create_top_results(top_label_results, predictions)
         return output_top_results
 
     def _create_input_data(self, citation_data_lookup, input_top_results):
         input_data = { "inputs": [], "parameters": {} }
-        pmid_list = []
-        top_label_ids = []
-        for q_id in input_top_results:
-            pmid = int(q_id)
-            pmid_list.append(pmid)
-
-            citation_top_label_ids = [int(p_id) for p_id, _ in sorted(input_top_results[q_id].items(), key=lambda x: x[1], reverse=True)[:self.top_n]]
-            top_label_ids.append(citation_top_label_ids)
-
+        top_label_results = input_top_results.top_k(self.top_n)
+        for pmid, citation_top_label_ids in zip(top_label_results.pmids.tolist(), top_label_results.label_ids.tolist()):
             citation_data = citation_data_lookup[pmid]
             query = "|" + QUERY_TEMPLATE.format(journal_title=citation_data["journal_title"], title=citation_data["title"], abstract=citation_data["abstract"])
          
             combined_passages = ""
             for label_id in citation_top_label_ids:
+                if label_id == PAD_LABEL_ID:
+                    continue
                 passage = self.passage_lookup[label_id]
                 combined_passages += "|"
                 combined_passages += passage
 
             input_data["inputs"].append([[query, combined_passages]])
         
-        return input_data, pmid_list, top_label_ids
-
-    def _create_top_results(self, pmid_list, top_label_ids, score_lookup):
-        top_results = {}
-        citation_count = len(pmid_list)
-        for citation_idx in range(citation_count):
-            pmid = pmid_list[citation_idx]
-            q_id = str(pmid)
-            top_results[q_id] = {}
-            for label_idx in range(self.top_n):
-                label_id = top_label_ids[citation_idx][label_idx]
-                score = score_lookup[citation_idx][label_idx]
-                p_id = str(label_id) 
-                top_results[q_id][p_id] = score
+        return input_data, top_label_results
+
+    def _create_top_results(self, top_label_results, predictions):
+        # Listwise predictions give a score for each index into the citation's 
+        # top label ids.
+        label_ids = top_label_results.label_ids
+        scores = np.full(label_ids.shape, -np.inf)
+        for citation_idx, citation_predictions in enumerate(predictions):
+            for label_prediction in citation_predictions:
+                label_idx = label_prediction["index"]
+                if label_idx < scores.shape[1]:
+                    scores[citation_idx, label_idx] = label_prediction["score"]
+        top_results = TopNResults(top_label_results.pmids, label_ids, scores)
         return top_results
 
-    def _predict_internal(self, input_data):
-        predictions = self.huggingface_endpoint.predict(input_data)
-        prediction_count = len(predictions)
-        score_lookup = {}
-        for citation_idx in range(prediction_count):
-            score_lookup[citation_idx] = {}
-            for citation_predictions in predictions[citation_idx]:
-                label_idx = citation_predictions["index"]
-                score = citation_predictions["score"]
-                score_lookup[citation_idx][label_idx] = score
-        return score_lookup
+
+class CascadeListwiseModelTopNPredictor:
+
+    # Skips the listwise endpoint for citations where no candidate can reach 
+    # the threshold, whatever its listwise score. The pipeline averages the 
+    # pointwise averaged and listwise scores with equal weights, so a 
+    # candidate stays below the threshold if (score + max_listwise_score) / 2 
+    # is below it. Candidates above the threshold keep their listwise score in 
+    # the output, and the listwise model scores each candidate in the context 
+    # of the whole list, so a citation is either sent with all of its 
+    # candidates or skipped. Skipped candidates are given min_listwise_score.
+    def __init__(self, listwise_model_top_n_predictor, threshold, max_listwise_score=1., min_listwise_score=0.):
+        self.listwise_model_top_n_predictor = listwise_model_top_n_predictor
+        self.threshold = threshold
+        self.max_listwise_score = max_listwise_score
+        self.min_listwise_score = min_listwise_score
+
+    def predict(self, citation_data_lookup, input_top_results):
+        top_label_results, send_lookup, send_results = self._select(citation_data_lookup, input_top_results)
+        if len(send_lookup) == 0:
+            return self._create_skipped_results(top_label_results)
+        listwise_results = self.listwise_model_top_n_predictor.predict(send_lookup, send_results)
+        return self._combine(top_label_results, listwise_results)
+
+    async def apredict(self, citation_data_lookup, input_top_results):
+        top_label_results, send_lookup, send_results = self._select(citation_data_lookup, input_top_results)
+        if len(send_lookup) == 0:
+            return self._create_skipped_results(top_label_results)
+        listwise_results = await self.listwise_model_top_n_predictor.apredict(send_lookup, send_results)
+        return self._combine(top_label_results, listwise_results)
+
+    def _select(self, citation_data_lookup, input_top_results):
+        top_label_results = input_top_results.top_k(self.listwise_model_top_n_predictor.top_n)
+        valid = top_label_results.label_ids != PAD_LABEL_ID
+        undecided = valid & ((top_label_results.scores + self.max_listwise_score) / 2 >= self.threshold)
+        send_pmids = top_label_results.pmids[undecided.any(axis=1)].tolist()
+        send_lookup = { pmid: citation_data_lookup[pmid] for pmid in send_pmids }
+        return top_label_results, send_lookup, top_label_results.align(send_pmids)
+
+    def _create_skipped_results(self, top_label_results):
+        valid = top_label_results.label_ids != PAD_LABEL_ID
+        scores = np.where(valid, self.min_listwise_score, -np.inf)
+        return TopNResults(top_label_results.pmids, top_label_results.label_ids, scores)
+
+    def _combine(self, top_label_results, listwise_results):
+        send_pmids = set(listwise_results.pmids.tolist())
+        skipped_pmids = [pmid for pmid in top_label_results.pmids.tolist() if pmid not in send_pmids]
+        skipped_results = self._create_skipped_results(top_label_results.align(skipped_pmids))
+        return TopNResults.concatenate([listwise_results, skipped_results]).align(top_label_results.pmids)
 
 
 class SubheadingPredictor:
@@ -165,17 +260,35 @@ class SubheadingPredictor:
         self.subheading_endpoint = subheading_endpoint
         self.subheading_name_lookup = subheading_name_lookup
 
-    def predict(self, mesh_heading_predictions):
-        data = self._create_input_data(mesh_heading_predictions)
+    def predict(self, mesh_heading_predictions, citation_data_lookup=None):
+        data = self._create_input_data(mesh_heading_predictions, citation_data_lookup)
         response = self.subheading_endpoint.predict(data)
         result_lookup = self._create_result_lookup(response)
         predictions = self._attach_subheadings(result_lookup, mesh_heading_predictions)
         return predictions
 
+    async def apredict(self, mesh_heading_predictions, citation_data_lookup=None):
+        data = self._create_input_data(mesh_heading_predictions, citation_data_lookup)
+        response = await self.subheading_endpoint.apredict(data)
+        result_lookup = self._create_result_lookup(response)
+        predictions = self._attach_subheadings(result_lookup, mesh_heading_predictions)
+        return predictions
+
+    def predict_stream(self, mesh_heading_predictions, batch_size=512):
+        # Consumes the mesh heading predictions lazily, batch_size at a time.
+        for batch in create_input_batches(mesh_heading_predictions, batch_size):
+            yield from self.predict(batch)
+
     def _attach_subheadings(self, result_lookup, mesh_heading_predictions):
-        mesh_heading_predictions = copy.deepcopy(mesh_heading_predictions)
+        # The input predictions are not modified. The output is built from new 
+        # shallow copies of the citation and indexing dicts, which share their 
+        # unchanged values (e.g. the text-gz-64 data) with the input.
+        output_predictions = []
         for citation_prediction in mesh_heading_predictions:
             pmid = citation_prediction["PMID"]
+            citation_prediction = dict(citation_prediction)
+            citation_prediction["Indexing"] = [dict(mesh_heading_prediction) for mesh_heading_prediction in citation_prediction["Indexing"]]
+            output_predictions.append(citation_prediction)
             for mesh_heading_prediction in citation_prediction["Indexing"]:
                 if self._subheadings_allowed(mesh_heading_prediction):
                     dui = mesh_heading_prediction["ID"]
@@ -190,22 +303,29 @@ class SubheadingPredictor:
                                 "Kind": "MTIX",
                                 "Score": round(score, 3) }]
                             })
-        return mesh_heading_predictions
+        return output_predictions
 
-    def _create_input_data(self, mesh_heading_predictions):
+    def _create_input_data(self, mesh_heading_predictions, citation_data_lookup=None):
+        # Citation data that has already been parsed and sanitized (keyed by 
+        # pmid) is reused, otherwise it is decoded from the MTI JSON.
         instances = []
         for citation_prediction in mesh_heading_predictions:
-            encoded_citation_xml = citation_prediction["text-gz-64"]
-            citation_data = self.parser.parse_data(encoded_citation_xml)
-            self.santizer.sanitize(citation_data)
+            if citation_data_lookup is not None and citation_prediction["PMID"] in citation_data_lookup:
+                citation_data = citation_data_lookup[citation_prediction["PMID"]]
+            else:
+                encoded_citation_xml = citation_prediction["text-gz-64"]
+                citation_data = self.parser.parse_data(encoded_citation_xml)
+                self.santizer.sanitize(citation_data)
             citation_data = { key: value for key, value in citation_data.items() if key not in ["journal_title"] }
             citation_data["pmid"] = str(citation_data["pmid"])
+            replace_brackets([citation_data])
+            # Citation data values are immutable, so each instance is a shallow 
+            # copy that shares them and only adds the main heading.
             for mesh_heading_prediction in citation_prediction["Indexing"]:
                 if self._subheadings_allowed(mesh_heading_prediction):
-                    citation_data_copy = copy.deepcopy(citation_data)
-                    citation_data_copy["main_heading_ui"] = mesh_heading_prediction["ID"]
-                    instances.append(citation_data_copy)
-        instances = replace_brackets(instances)
+                    instance = dict(citation_data)
+                    instance["main_heading_ui"] = mesh_heading_prediction["ID"]
+                    instances.append(instance)
         data = { "instances": instances }
         return data
 
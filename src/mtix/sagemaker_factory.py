@@ -1,8 +1,10 @@
 import boto3
+from .cache import CnnResultsCache, PredictionCache
+import os.path
 import sagemaker.session
 from .endpoints import HuggingFaceAsyncEndpoint, HuggingFaceRealTimeEndpoint, TensorflowAsyncEndpoint, TensorflowRealTimeEndpoint
 from .pipelines import IndexingPipeline, MeshHeadingPredictionPipeline, MtiJsonResultsFormatter
-from .predictors import CnnModelTop100Predictor, ListwiseModelTopNPredictor, PointwiseModelTopNPredictor, SubheadingPredictor
+from .predictors import CachedCnnModelTop100Predictor, CascadeListwiseModelTopNPredictor, CnnModelTop100Predictor, ListwiseModelTopNPredictor, PointwiseModelTopNPredictor, SubheadingPredictor
 from sagemaker.huggingface import HuggingFacePredictor
 from sagemaker.predictor_async import AsyncPredictor
 from sagemaker.tensorflow import TensorFlowPredictor
@@ -10,74 +12,95 @@ from .utils import CitationDataSanitizer, create_lookup, PubMedXmlInputDataParse
 
 
 CONCURRENT_BATCHES = 100
+LISTWISE_TOP_N = 40
 MAX_YEAR = 2023
+POINTWISE_TOP_N = 100
+THRESHOLD = 0.49
 WAIT_DELAY = 1
 WAIT_MAX_ATTEMPTS = 1800
 
 
-def create_mesh_heading_prediction_pipeline(name_lookup_path, ui_lookup_path, type_lookup_path, pointwise_passage_lookup_path, listwise_passage_lookup_path, cnn_endpoint_name, pointwise_endpoint_name, listwise_endpoint_name, async_bucket_name=None, async_prefix=None, cnn_batch_size=128, pointwise_batch_size=128, listwise_batch_size=128, vpc_endpoint=None):
+def create_mesh_heading_prediction_pipeline(name_lookup_path, ui_lookup_path, type_lookup_path, pointwise_passage_lookup_path, listwise_passage_lookup_path, cnn_endpoint_name, pointwise_endpoint_name, listwise_endpoint_name, async_bucket_name=None, async_prefix=None, cnn_batch_size=128, pointwise_batch_size=128, listwise_batch_size=128, vpc_endpoint=None, max_in_flight=1, pointwise_token_budget=None, listwise_token_budget=None, parser_max_workers=1, xml_parser_backend="elementtree", prediction_cache_backend=None, cnn_cache_backend=None, listwise_cascade_max_score=None, sagemaker_backend=None, observer=None, retry_policy=None, batch_controller_lookup=None):
     is_async = (async_bucket_name is not None) and (async_prefix is not None)
+    batch_controller_lookup = check_batch_controller_lookup(batch_controller_lookup, is_async)
     
     concurrent_batches = CONCURRENT_BATCHES
     max_year = MAX_YEAR
     wait_delay = WAIT_DELAY
     wait_max_attempts = WAIT_MAX_ATTEMPTS
 
-    listwise_top_n = 40
-    pointwise_top_n = 100
-    threshold = 0.49
+    listwise_top_n = LISTWISE_TOP_N
+    pointwise_top_n = POINTWISE_TOP_N
+    threshold = THRESHOLD
+    pointwise_padding = get_pointwise_padding(pointwise_token_budget)
 
-    input_data_parser = PubMedXmlInputDataParser()
+    input_data_parser = PubMedXmlInputDataParser(max_workers=parser_max_workers, xml_parser_backend=xml_parser_backend)
     sanitizer = CitationDataSanitizer(max_year)
 
-    sagemaker_session = create_sagemaker_session(vpc_endpoint)
-    sagemaker_cnn_endpoint = TensorFlowPredictor(cnn_endpoint_name, sagemaker_session=sagemaker_session)
+    if sagemaker_backend is None:
+        sagemaker_backend = SageMakerBackend(vpc_endpoint)
+    sagemaker_cnn_endpoint = sagemaker_backend.create_tensorflow_predictor(cnn_endpoint_name)
     if is_async:
-        sagemaker_async_cnn_endpoint = AsyncPredictor(sagemaker_cnn_endpoint)
-        async_cnn_endpoint = TensorflowAsyncEndpoint(sagemaker_async_cnn_endpoint, "cnn_endpoint", async_bucket_name, async_prefix, cnn_batch_size, wait_delay=wait_delay, wait_max_attempts=wait_max_attempts)
-        cnn_endpoint = TensorflowRealTimeEndpoint(async_cnn_endpoint, batch_size=concurrent_batches*cnn_batch_size)
+        sagemaker_async_cnn_endpoint = sagemaker_backend.create_async_predictor(sagemaker_cnn_endpoint, async_bucket_name, async_prefix, "cnn_endpoint")
+        async_cnn_endpoint = TensorflowAsyncEndpoint(sagemaker_async_cnn_endpoint, "cnn_endpoint", async_bucket_name, async_prefix, cnn_batch_size, wait_delay=wait_delay, wait_max_attempts=wait_max_attempts, s3=sagemaker_backend.s3, observer=observer, retry_policy=retry_policy)
+        cnn_endpoint = TensorflowRealTimeEndpoint(async_cnn_endpoint, batch_size=concurrent_batches*cnn_batch_size, max_in_flight=max_in_flight)
     else:
-        cnn_endpoint = TensorflowRealTimeEndpoint(sagemaker_cnn_endpoint, batch_size=cnn_batch_size)
+        cnn_endpoint = TensorflowRealTimeEndpoint(sagemaker_cnn_endpoint, batch_size=cnn_batch_size, max_in_flight=max_in_flight, observer=observer, endpoint_name="cnn_endpoint", retry_policy=retry_policy, batch_controller=batch_controller_lookup.get("cnn_endpoint"))
     cnn_model_top_100_predictor = CnnModelTop100Predictor(cnn_endpoint)
+    if cnn_cache_backend is not None:
+        cnn_results_cache = CnnResultsCache(cnn_cache_backend, f"cnn:{cnn_endpoint_name}")
+        cnn_model_top_100_predictor = CachedCnnModelTop100Predictor(cnn_model_top_100_predictor, cnn_results_cache)
 
     pointwise_passage_lookup = create_lookup(pointwise_passage_lookup_path)
-    sagemaker_pointwise_endpoint = HuggingFacePredictor(pointwise_endpoint_name, sagemaker_session=sagemaker_session)
+    sagemaker_pointwise_endpoint = sagemaker_backend.create_huggingface_predictor(pointwise_endpoint_name)
     if is_async:
-        sagemaker_async_pointwise_endpoint = AsyncPredictor(sagemaker_pointwise_endpoint)
-        async_pointwise_endpoint = HuggingFaceAsyncEndpoint(sagemaker_async_pointwise_endpoint, "pointwise_endpoint", async_bucket_name, async_prefix, pointwise_batch_size, wait_delay=wait_delay, wait_max_attempts=wait_max_attempts)
-        pointwise_endpoint = HuggingFaceRealTimeEndpoint(async_pointwise_endpoint, batch_size=concurrent_batches*pointwise_batch_size)
+        sagemaker_async_pointwise_endpoint = sagemaker_backend.create_async_predictor(sagemaker_pointwise_endpoint, async_bucket_name, async_prefix, "pointwise_endpoint")
+        async_pointwise_endpoint = HuggingFaceAsyncEndpoint(sagemaker_async_pointwise_endpoint, "pointwise_endpoint", async_bucket_name, async_prefix, pointwise_batch_size, wait_delay=wait_delay, wait_max_attempts=wait_max_attempts, s3=sagemaker_backend.s3, token_budget=pointwise_token_budget, observer=observer, retry_policy=retry_policy)
+        pointwise_endpoint = HuggingFaceRealTimeEndpoint(async_pointwise_endpoint, batch_size=concurrent_batches*pointwise_batch_size, max_in_flight=max_in_flight)
     else:
-        pointwise_endpoint = HuggingFaceRealTimeEndpoint(sagemaker_pointwise_endpoint, batch_size=pointwise_batch_size)
-    pointwise_model_top100_predictor = PointwiseModelTopNPredictor(pointwise_endpoint, pointwise_passage_lookup, pointwise_top_n)
+        pointwise_endpoint = HuggingFaceRealTimeEndpoint(sagemaker_pointwise_endpoint, batch_size=pointwise_batch_size, max_in_flight=max_in_flight, token_budget=pointwise_token_budget, observer=observer, endpoint_name="pointwise_endpoint", retry_policy=retry_policy, batch_controller=batch_controller_lookup.get("pointwise_endpoint"))
+    pointwise_model_top100_predictor = PointwiseModelTopNPredictor(pointwise_endpoint, pointwise_passage_lookup, pointwise_top_n, padding=pointwise_padding)
 
     listwise_passage_lookup = create_lookup(listwise_passage_lookup_path)
-    sagemaker_listwise_endpoint = HuggingFacePredictor(listwise_endpoint_name, sagemaker_session=sagemaker_session)
+    sagemaker_listwise_endpoint = sagemaker_backend.create_huggingface_predictor(listwise_endpoint_name)
     if is_async:
-        sagemaker_async_listwise_endpoint = AsyncPredictor(sagemaker_listwise_endpoint)
-        async_listwise_endpoint = HuggingFaceAsyncEndpoint(sagemaker_async_listwise_endpoint, "listwise_endpoint", async_bucket_name, async_prefix, listwise_batch_size, wait_delay=wait_delay, wait_max_attempts=wait_max_attempts)
-        listwise_endpoint = HuggingFaceRealTimeEndpoint(async_listwise_endpoint, batch_size=concurrent_batches*listwise_batch_size)
+        sagemaker_async_listwise_endpoint = sagemaker_backend.create_async_predictor(sagemaker_listwise_endpoint, async_bucket_name, async_prefix, "listwise_endpoint")
+        async_listwise_endpoint = HuggingFaceAsyncEndpoint(sagemaker_async_listwise_endpoint, "listwise_endpoint", async_bucket_name, async_prefix, listwise_batch_size, wait_delay=wait_delay, wait_max_attempts=wait_max_attempts, s3=sagemaker_backend.s3, token_budget=listwise_token_budget, observer=observer, retry_policy=retry_policy)
+        listwise_endpoint = HuggingFaceRealTimeEndpoint(async_listwise_endpoint, batch_size=concurrent_batches*listwise_batch_size, max_in_flight=max_in_flight)
     else:
-        listwise_endpoint = HuggingFaceRealTimeEndpoint(sagemaker_listwise_endpoint, batch_size=listwise_batch_size)
+        listwise_endpoint = HuggingFaceRealTimeEndpoint(sagemaker_listwise_endpoint, batch_size=listwise_batch_size, max_in_flight=max_in_flight, token_budget=listwise_token_budget, observer=observer, endpoint_name="listwise_endpoint", retry_policy=retry_policy, batch_controller=batch_controller_lookup.get("listwise_endpoint"))
     listwise_model_topN_predictor = ListwiseModelTopNPredictor(listwise_endpoint, listwise_passage_lookup, listwise_top_n)
+    if listwise_cascade_max_score is not None:
+        listwise_model_topN_predictor = CascadeListwiseModelTopNPredictor(listwise_model_topN_predictor, threshold, max_listwise_score=listwise_cascade_max_score)
 
     name_lookup = create_lookup(name_lookup_path)
     type_lookup = create_lookup(type_lookup_path)
     ui_lookup = create_lookup(ui_lookup_path)
     results_formatter = MtiJsonResultsFormatter(name_lookup, type_lookup, ui_lookup, threshold)
 
-    pipeline = MeshHeadingPredictionPipeline(input_data_parser, sanitizer, cnn_model_top_100_predictor, pointwise_model_top100_predictor, listwise_model_topN_predictor, results_formatter)
+    prediction_cache = None
+    if prediction_cache_backend is not None:
+        model_version = create_model_version("mesh_heading", name_lookup_path, ui_lookup_path, type_lookup_path, pointwise_passage_lookup_path, listwise_passage_lookup_path, cnn_endpoint_name, pointwise_endpoint_name, listwise_endpoint_name, *get_prediction_settings(pointwise_token_budget, listwise_token_budget, listwise_cascade_max_score))
+        prediction_cache = PredictionCache(prediction_cache_backend, model_version)
+
+    pipeline = MeshHeadingPredictionPipeline(input_data_parser, sanitizer, cnn_model_top_100_predictor, pointwise_model_top100_predictor, listwise_model_topN_predictor, results_formatter, prediction_cache, observer)
     return pipeline
 
 
-def create_indexing_pipeline(name_lookup_path, ui_lookup_path, type_lookup_path, pointwise_passage_lookup_path, listwise_passage_lookup_path, subheading_name_lookup_path, cnn_endpoint_name, pointwise_endpoint_name, listwise_endpoint_name, subheading_endpoint_name, async_bucket_name=None, async_prefix=None, cnn_batch_size=128, pointwise_batch_size=128, listwise_batch_size=128, subheading_batch_size=128, vpc_endpoint=None):
-    mesh_heading_prediction_pipeline = create_mesh_heading_prediction_pipeline(name_lookup_path, ui_lookup_path, type_lookup_path, pointwise_passage_lookup_path, listwise_passage_lookup_path, cnn_endpoint_name, pointwise_endpoint_name, listwise_endpoint_name, async_bucket_name, async_prefix, cnn_batch_size, pointwise_batch_size, listwise_batch_size, vpc_endpoint)
-    subheading_predictor = create_subheading_predictor(subheading_name_lookup_path, subheading_endpoint_name, async_bucket_name, async_prefix, subheading_batch_size, vpc_endpoint=vpc_endpoint)
-    indexing_pipeline = IndexingPipeline(mesh_heading_prediction_pipeline, subheading_predictor)
+def create_indexing_pipeline(name_lookup_path, ui_lookup_path, type_lookup_path, pointwise_passage_lookup_path, listwise_passage_lookup_path, subheading_name_lookup_path, cnn_endpoint_name, pointwise_endpoint_name, listwise_endpoint_name, subheading_endpoint_name, async_bucket_name=None, async_prefix=None, cnn_batch_size=128, pointwise_batch_size=128, listwise_batch_size=128, subheading_batch_size=128, vpc_endpoint=None, max_in_flight=1, pointwise_token_budget=None, listwise_token_budget=None, parser_max_workers=1, xml_parser_backend="elementtree", prediction_cache_backend=None, cnn_cache_backend=None, listwise_cascade_max_score=None, sagemaker_backend=None, observer=None, retry_policy=None, batch_controller_lookup=None):
+    mesh_heading_prediction_pipeline = create_mesh_heading_prediction_pipeline(name_lookup_path, ui_lookup_path, type_lookup_path, pointwise_passage_lookup_path, listwise_passage_lookup_path, cnn_endpoint_name, pointwise_endpoint_name, listwise_endpoint_name, async_bucket_name, async_prefix, cnn_batch_size, pointwise_batch_size, listwise_batch_size, vpc_endpoint, max_in_flight, pointwise_token_budget, listwise_token_budget, parser_max_workers, xml_parser_backend, cnn_cache_backend=cnn_cache_backend, listwise_cascade_max_score=listwise_cascade_max_score, sagemaker_backend=sagemaker_backend, observer=observer, retry_policy=retry_policy, batch_controller_lookup=batch_controller_lookup)
+    subheading_predictor = create_subheading_predictor(subheading_name_lookup_path, subheading_endpoint_name, async_bucket_name, async_prefix, subheading_batch_size, vpc_endpoint=vpc_endpoint, max_in_flight=max_in_flight, sagemaker_backend=sagemaker_backend, observer=observer, retry_policy=retry_policy, batch_controller_lookup=batch_controller_lookup)
+    prediction_cache = None
+    if prediction_cache_backend is not None:
+        model_version = create_model_version("indexing", name_lookup_path, ui_lookup_path, type_lookup_path, pointwise_passage_lookup_path, listwise_passage_lookup_path, subheading_name_lookup_path, cnn_endpoint_name, pointwise_endpoint_name, listwise_endpoint_name, subheading_endpoint_name, *get_prediction_settings(pointwise_token_budget, listwise_token_budget, listwise_cascade_max_score))
+        prediction_cache = PredictionCache(prediction_cache_backend, model_version)
+    indexing_pipeline = IndexingPipeline(mesh_heading_prediction_pipeline, subheading_predictor, prediction_cache, observer)
     return indexing_pipeline
 
 
-def create_subheading_predictor(subheading_name_lookup_path, subheading_endpoint_name, async_bucket_name=None, async_prefix=None, batch_size=128, vpc_endpoint=None):
+def create_subheading_predictor(subheading_name_lookup_path, subheading_endpoint_name, async_bucket_name=None, async_prefix=None, batch_size=128, vpc_endpoint=None, max_in_flight=1, sagemaker_backend=None, observer=None, retry_policy=None, batch_controller_lookup=None):
     is_async = (async_bucket_name is not None) and (async_prefix is not None)
+    batch_controller_lookup = check_batch_controller_lookup(batch_controller_lookup, is_async)
 
     concurrent_batches = CONCURRENT_BATCHES
     max_year = MAX_YEAR
@@ -87,20 +110,73 @@ def create_subheading_predictor(subheading_name_lookup_path, subheading_endpoint
     input_data_parser = PubMedXmlInputDataParser()
     sanitizer = CitationDataSanitizer(max_year)
 
-    sagemaker_session = create_sagemaker_session(vpc_endpoint)
-    sagemaker_subheading_endpoint = TensorFlowPredictor(subheading_endpoint_name, sagemaker_session=sagemaker_session)
+    if sagemaker_backend is None:
+        sagemaker_backend = SageMakerBackend(vpc_endpoint)
+    sagemaker_subheading_endpoint = sagemaker_backend.create_tensorflow_predictor(subheading_endpoint_name)
     if is_async:
-        sagemaker_async_subheading_endpoint = AsyncPredictor(sagemaker_subheading_endpoint)
-        async_subheading_endpoint = TensorflowAsyncEndpoint(sagemaker_async_subheading_endpoint, "subheading_endpoint", async_bucket_name, async_prefix, batch_size, wait_delay=wait_delay, wait_max_attempts=wait_max_attempts)
-        subheading_endpoint = TensorflowRealTimeEndpoint(async_subheading_endpoint, batch_size=concurrent_batches*batch_size)
+        sagemaker_async_subheading_endpoint = sagemaker_backend.create_async_predictor(sagemaker_subheading_endpoint, async_bucket_name, async_prefix, "subheading_endpoint")
+        async_subheading_endpoint = TensorflowAsyncEndpoint(sagemaker_async_subheading_endpoint, "subheading_endpoint", async_bucket_name, async_prefix, batch_size, wait_delay=wait_delay, wait_max_attempts=wait_max_attempts, s3=sagemaker_backend.s3, observer=observer, retry_policy=retry_policy)
+        subheading_endpoint = TensorflowRealTimeEndpoint(async_subheading_endpoint, batch_size=concurrent_batches*batch_size, max_in_flight=max_in_flight)
     else:
-        subheading_endpoint = TensorflowRealTimeEndpoint(sagemaker_subheading_endpoint, batch_size=batch_size)
+        subheading_endpoint = TensorflowRealTimeEndpoint(sagemaker_subheading_endpoint, batch_size=batch_size, max_in_flight=max_in_flight, observer=observer, endpoint_name="subheading_endpoint", retry_policy=retry_policy, batch_controller=batch_controller_lookup.get("subheading_endpoint"))
     
     subheading_name_lookup = create_lookup(subheading_name_lookup_path)
     subheading_predictor = SubheadingPredictor(input_data_parser, sanitizer, subheading_endpoint, subheading_name_lookup)
 
     return subheading_predictor
 
+
+def check_batch_controller_lookup(batch_controller_lookup, is_async):
+    # Batch controllers are keyed by "cnn_endpoint", "pointwise_endpoint", 
+    # "listwise_endpoint" and "subheading_endpoint".
+    if batch_controller_lookup is None:
+        return {}
+    if is_async and len(batch_controller_lookup) > 0:
+        raise ValueError("Adaptive batching is only supported for real-time endpoints.")
+    return batch_controller_lookup
+
+
+def get_pointwise_padding(pointwise_token_budget):
+    # With token budget batching, similar length inputs are batched together 
+    # and are only padded to the longest input.
+    return "max_length" if pointwise_token_budget is None else "longest"
+
+
+def get_prediction_settings(pointwise_token_budget, listwise_token_budget, listwise_cascade_max_score):
+    # Factory settings that can change the predictions, so they are part of 
+    # the model version of cached predictions.
+    return [f"pointwise_token_budget={pointwise_token_budget}", f"listwise_token_budget={listwise_token_budget}", f"pointwise_padding={get_pointwise_padding(pointwise_token_budget)}", f"listwise_cascade_max_score={listwise_cascade_max_score}"]
+
+
+def create_model_version(pipeline_name, *identifiers):
+    # Identifies the models, lookups and settings behind cached predictions. 
+    # Endpoint names carry the model versions.
+    identifiers = [os.path.basename(str(identifier)) for identifier in identifiers]
+    return ":".join([pipeline_name, *identifiers, f"top_n={POINTWISE_TOP_N},{LISTWISE_TOP_N}", f"threshold={THRESHOLD}", f"max_year={MAX_YEAR}"])
+
+
+class SageMakerBackend:
+
+    # Creates the SageMaker predictors behind the endpoints. A stand-in 
+    # backend with the same methods, such as LocalSageMakerBackend, can be 
+    # passed to the factories instead. An s3 client of None means that the 
+    # async endpoints create a boto3 client.
+    def __init__(self, vpc_endpoint=None):
+        self.sagemaker_session = create_sagemaker_session(vpc_endpoint)
+        self.s3 = None
+
+    def create_tensorflow_predictor(self, endpoint_name):
+        return TensorFlowPredictor(endpoint_name, sagemaker_session=self.sagemaker_session)
+
+    def create_huggingface_predictor(self, endpoint_name):
+        return HuggingFacePredictor(endpoint_name, sagemaker_session=self.sagemaker_session)
+
+    def create_async_predictor(self, predictor, bucket_name, prefix, endpoint_name):
+        # The async inference output location is part of the SageMaker 
+        # endpoint config.
+        return AsyncPredictor(predictor)
+
+
 def create_sagemaker_session(vpc_endpoint):
     boto_session = boto3.Session()
     sagemaker_runtime_client = boto_session.client("sagemaker-runtime", endpoint_url=vpc_endpoint)
@@ -0,0 +1,38 @@
+import gzip
+import json
+import random
+from .utils import Base64Helper, ENCODING
+
+
+WORDS = ["cell", "patient", "study", "protein", "expression", "treatment", "risk", "clinical", "gene", "analysis", "response", "model", "disease", "cancer", "children", "group", "effect", "level", "receptor", "outcome"]
+CITATION_XML_TEMPLATE = ('<MedlineCitation Owner="NLM" Status="MEDLINE"><PMID Version="1">{pmid}</PMID><DateCompleted><Year>2022</Year><Month>01</Month><Day>01</Day></DateCompleted>'
+                         '<Article PubModel="Print"><Journal><JournalIssue CitedMedium="Internet"><PubDate><Year>{pub_year}</Year></PubDate></JournalIssue><Title>{journal_title}</Title></Journal>'
+                         '<ArticleTitle>{title}</ArticleTitle><Abstract><AbstractText>{abstract}</AbstractText></Abstract></Article>'
+                         '<MedlineJournalInfo><NlmUniqueID>{journal_nlmid}</NlmUniqueID></MedlineJournalInfo></MedlineCitation>')
+
+
+def create_synthetic_input_data(citation_count, seed=0):
+    # MedlineCitation records with PubMed-like title and abstract lengths, 
+    # for the benchmark scripts. They are not drawn from the validation test 
+    # set, so their structure is simpler than real citations.
+    rng = random.Random(seed)
+    base64_helper = Base64Helper()
+    input_data = []
+    for idx in range(citation_count):
+        pmid = 30000000 + idx
+        citation_xml = CITATION_XML_TEMPLATE.format(pmid=pmid, pub_year=rng.randint(2017, 2023), journal_title=" ".join(rng.choices(WORDS, k=4)).title(),
+                                                    title=" ".join(rng.choices(WORDS, k=rng.randint(8, 20))).capitalize() + ".",
+                                                    abstract=" ".join(rng.choices(WORDS, k=rng.randint(150, 300))).capitalize() + ".",
+                                                    journal_nlmid=str(rng.randint(1000000, 9999999)))
+        input_data.append({ "uid": pmid, "data": base64_helper.encode(citation_xml) })
+    return input_data
+
+
+def load_input_data(input_path, citation_count):
+    # Reads the first citation_count records of a test set data file 
+    # (.json.gz), or creates synthetic records if no path is given.
+    if input_path is None:
+        return create_synthetic_input_data(citation_count)
+    with gzip.open(input_path, "rt", encoding=ENCODING) as read_file:
+        input_data = json.load(read_file)
+    return input_data[:citation_count]
@@ -1,3 +1,7 @@
+import os.path
+import tempfile
+
+
 CITATION_XML_WITH_MEDLINE_DATE = '<MedlineCitation Owner="NLM" Status="MEDLINE"><PMID Version="1">33449580</PMID><DateCompleted><Year>2021</Year><Month>08</Month><Day>16</Day></DateCompleted><DateRevised><Year>2022</Year><Month>02</Month><Day>09</Day></DateRevised><Article PubModel="Print"><Journal><ISSN IssnType="Electronic">1552-6917</ISSN><JournalIssue CitedMedium="Internet"><Volume>32</Volume><Issue>2</Issue><PubDate><MedlineDate>2021 Mar-Apr 01</MedlineDate></PubDate></JournalIssue><Title>The Journal of the Association of Nurses in AIDS Care : JANAC</Title><ISOAbbreviation>J Assoc Nurses AIDS Care</ISOAbbreviation></Journal><ArticleTitle>"HIV and Aging in Special Populations: From the Mitochondria to the Metropolis"-Proceedings From the 2019 Conference.</ArticleTitle><Pagination><StartPage>214</StartPage><EndPage>221</EndPage><MedlinePgn>214-221</MedlinePgn></Pagination><ELocationID EIdType="doi" ValidYN="Y">10.1097/JNC.0000000000000236</ELocationID><AuthorList CompleteYN="Y"><Author ValidYN="Y"><LastName>Nguyen</LastName><ForeName>Annie</ForeName><Initials>A</Initials><AffiliationInfo><Affiliation>Annie Nguyen, PhD, MPH, is an Assistant Professor, Department of Family Medicine, Keck School of Medicine, University of Southern California, San Diego, California, USA. Stefano Rinaldi, PhD, is a Postdoctoral Fellow, Department of Microbiology and Immunology, University of Miami Miller School of Medicine, Miami, Florida, USA. Claudia Martinez, MD, is an Associate Professor of Clinical Medicine, Department of Medicine, Division of Cardiology, University of Miami Miller School of Medicine, Miami, Florida, USA. Molly Perkins, PhD, is an Associate Professor, Emory University School of Medicine; a Member of the Graduate Faculty, Emory Department of Sociology and the Atlanta Site Lead (joint appointment with the Atlanta VA Medical Center), Birmingham/Atlanta Geriatric Research, Education, and Clinical Center (GRECC); and Co-chair, Scientific Working Group on HIV and Aging, Center for AIDS Research at Emory University, Atlanta, Georgia, USA. Marcia McDonnell Holstad, PhD, FNP-BC, FAANP, FAAN, is Research Professor, Professor Emerita, and Marcia Stanhope Professor in Public Health, Nell Hodgson Woodruff School of Nursing; and Co-chair, Scientific Working Group on HIV and Aging, Center for AIDS Research at Emory University, Atlanta, Georgia, USA.</Affiliation></AffiliationInfo></Author><Author ValidYN="Y"><LastName>Rinaldi</LastName><ForeName>Stefano</ForeName><Initials>S</Initials></Author><Author ValidYN="Y"><LastName>Martinez</LastName><ForeName>Claudia</ForeName><Initials>C</Initials></Author><Author ValidYN="Y"><LastName>Perkins</LastName><ForeName>Molly</ForeName><Initials>M</Initials></Author><Author ValidYN="Y"><LastName>Holstad</LastName><ForeName>Marcia McDonnell</ForeName><Initials>MM</Initials></Author></AuthorList><Language>eng</Language><GrantList CompleteYN="Y"><Grant><GrantID>R13 AG047064</GrantID><Acronym>AG</Acronym><Agency>NIA NIH HHS</Agency><Country>United States</Country></Grant><Grant><GrantID>P30 AI050409</GrantID><Acronym>AI</Acronym><Agency>NIAID NIH HHS</Agency><Country>United States</Country></Grant></GrantList><PublicationTypeList><PublicationType UI="D016428">Journal Article</PublicationType><PublicationType UI="D052061">Research Support, N.I.H., Extramural</PublicationType><PublicationType UI="D013485">Research Support, Non-U.S. Gov\'t</PublicationType></PublicationTypeList></Article><MedlineJournalInfo><Country>United States</Country><MedlineTA>J Assoc Nurses AIDS Care</MedlineTA><NlmUniqueID>9111870</NlmUniqueID><ISSNLinking>1055-3290</ISSNLinking></MedlineJournalInfo><CitationSubset>IM</CitationSubset><MeshHeadingList><MeshHeading><DescriptorName MajorTopicYN="N" UI="D000375">Aging</DescriptorName><QualifierName MajorTopicYN="Y" UI="Q000502">physiology</QualifierName></MeshHeading><MeshHeading><DescriptorName MajorTopicYN="N" UI="D003071">Cognition</DescriptorName></MeshHeading><MeshHeading><DescriptorName MajorTopicYN="N" UI="D003226">Congresses as Topic</DescriptorName></MeshHeading><MeshHeading><DescriptorName MajorTopicYN="Y" UI="D055030">Drug Users</DescriptorName></MeshHeading><MeshHeading><DescriptorName MajorTopicYN="N" UI="D015658">HIV Infections</DescriptorName></MeshHeading><MeshHeading><DescriptorName MajorTopicYN="N" UI="D006801">Humans</DescriptorName></MeshHeading><MeshHeading><DescriptorName MajorTopicYN="Y" UI="D000072339">Sexual and Gender Minorities</DescriptorName></MeshHeading><MeshHeading><DescriptorName MajorTopicYN="Y" UI="D014930">Women</DescriptorName></MeshHeading></MeshHeadingList></MedlineCitation>'
 MEDLINE_DATE_EXPECTED_CITATION_DATA = {
     "pmid": 33449580,
@@ -926,6 +930,8 @@ HUGGINGFACE_ENDPOINT_POINTWISE_RESULTS = [
     ]
 
 
+LABEL_IDS = list(range(1, 201))
+
 LISTWISE_AVG_RESULTS = {
     "32770536": {
         "9291": 0.9997632205486298,
@@ -1957,6 +1963,8 @@ PUBMED_XML_INPUT_DATA = [
 ]
 
 
+QUALIFIER_UIS = ["Q000379", "Q000502", "Q000503"]
+
 REPLACE_BRACKETS_INPUT = [
     {
         "pmid": 33998125,
@@ -2302,4 +2310,34 @@ UNORDERED_LISTWISE_AVG_RESULTS = {
         "17934": 0.07150864275172353,
         "13006": 0.08050789113622159
     }
-}
\ No newline at end of file
+}
+
+
+def write_lookup(path, lookup):
+    with open(path, "wt", encoding="utf-8") as write_file:
+        for key, value in lookup.items():
+            write_file.write(f"{key}\t{value}\n")
+    return path
+
+
+class LocalLookupFilesMixin:
+
+    # Writes the lookup files for the synthetic models of 
+    # mtix.local_sagemaker (LABEL_IDS and QUALIFIER_UIS) to a temporary 
+    # directory, in the argument order of the factories.
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        def path(name):
+            return os.path.join(self.temp_dir.name, name)
+        self.lookup_paths = [
+            write_lookup(path("names.tsv"), { label_id: f"Term {label_id}" for label_id in LABEL_IDS }),
+            write_lookup(path("uis.tsv"), { label_id: f"D{label_id:06d}" for label_id in LABEL_IDS }),
+            write_lookup(path("types.tsv"), { label_id: "Descriptor" for label_id in LABEL_IDS }),
+            write_lookup(path("pointwise_passages.tsv"), { label_id: f"MH: Term {label_id}" for label_id in LABEL_IDS }),
+            write_lookup(path("listwise_passages.tsv"), { label_id: f"MH: Term {label_id}" for label_id in LABEL_IDS }),
+            write_lookup(path("subheading_names.tsv"), { qui: f"qualifier {qui}" for qui in QUALIFIER_UIS }),
+        ]
+        self.endpoint_names = ["cnn", "pointwise", "listwise", "subheading"]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
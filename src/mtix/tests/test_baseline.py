@@ -0,0 +1,121 @@
+from .data import *
+import base64
+import gzip
+import json
+from mtix.baseline import MedlineXmlFileReader, MedlineXmlFileSetReader
+from mtix.utils import Base64Helper, PubMedXmlInputDataParser
+import os.path
+import pytest
+import tempfile
+from unittest import TestCase
+import xml.etree.ElementTree as ET
+import zlib
+
+
+def create_baseline_xml(input_data):
+    base64_helper = Base64Helper()
+    baseline_xml = '<?xml version="1.0" encoding="utf-8"?>\n<PubmedArticleSet>\n'
+    for item in input_data:
+        citation_xml = base64_helper.decode(item["data"])
+        baseline_xml += f"<PubmedArticle>\n{citation_xml}\n<PubmedData><PublicationStatus>ppublish</PublicationStatus></PubmedData>\n</PubmedArticle>\n"
+    baseline_xml += '<DeleteCitation>\n<PMID Version="1">12345</PMID>\n</DeleteCitation>\n</PubmedArticleSet>\n'
+    return baseline_xml
+
+
+def read_records_with_element_tree(path):
+    # The records written by the ElementTree based create_test_set_data.py 
+    # script that MedlineXmlFileReader replaced.
+    records = []
+    with gzip.open(path, "rt", encoding="utf-8") as read_file:
+        root_node = ET.parse(read_file)
+        for medline_citation_node in root_node.findall("PubmedArticle/MedlineCitation"):
+            pmid = int(medline_citation_node.find("PMID").text.strip())
+            medline_citation_node_xml = ET.tostring(medline_citation_node, encoding="utf-8", method="xml").decode("utf-8")
+            medline_citation_node_xml = base64.b64encode(zlib.compress(medline_citation_node_xml.encode("utf-8"), level=-1)).decode("utf-8")
+            records.append(json.dumps({ "uid": pmid, "data": medline_citation_node_xml }, ensure_ascii=False))
+    return records
+
+@pytest.mark.unit
+class TestMedlineXmlFileReader(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "pubmed23n0001.xml.gz")
+        with gzip.open(self.path, "wt", encoding="utf-8") as write_file:
+            write_file.write(create_baseline_xml(PUBMED_XML_INPUT_DATA))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_read_records(self):
+        records = list(MedlineXmlFileReader().read(self.path))
+        self.assertEqual([record["uid"] for record in records], [32770536, 30455223])
+        citation_data_list = PubMedXmlInputDataParser().parse(records)
+        self.assertEqual(citation_data_list, list(EXPECTED_CITATION_DATA_LOOKUP.values()), "Citation data list different from expected citation data list.")
+
+    def test_read_citation_data(self):
+        reader = MedlineXmlFileReader(output="citation_data", xml_parser_backend="single_pass")
+        citation_data_list = list(reader.read(self.path))
+        self.assertEqual(citation_data_list, list(EXPECTED_CITATION_DATA_LOOKUP.values()), "Citation data list different from expected citation data list.")
+
+    def test_read_uncompressed_file(self):
+        path = os.path.join(self.temp_dir.name, "pubmed23n0002.xml")
+        with open(path, "wt", encoding="utf-8") as write_file:
+            write_file.write(create_baseline_xml(PUBMED_XML_INPUT_DATA))
+        citation_data_list = list(MedlineXmlFileReader(output="citation_data").read(path))
+        self.assertEqual(citation_data_list, list(EXPECTED_CITATION_DATA_LOOKUP.values()), "Citation data list different from expected citation data list.")
+
+    def test_read_pmid_subset(self):
+        reader = MedlineXmlFileReader(pmids=["30455223"], output="citation_data")
+        citation_data_list = list(reader.read(self.path))
+        self.assertEqual(citation_data_list, [EXPECTED_CITATION_DATA_LOOKUP[30455223]], "Citation data list different from expected citation data list.")
+
+    def test_read_records_match_element_tree_script(self):
+        # Tails and whitespace are kept, and MedlineCitation elements that 
+        # are not directly under a PubmedArticle are skipped.
+        citation_xml_list = [Base64Helper().decode(item["data"]) for item in PUBMED_XML_INPUT_DATA]
+        baseline_xml = (
+            '<?xml version="1.0" encoding="utf-8"?>\n<PubmedArticleSet>\n'
+            f'<PubmedArticle>\n  {citation_xml_list[0]}  \t\n  <PubmedData><Nested><MedlineCitation><PMID>1</PMID></MedlineCitation></Nested></PubmedData>\n</PubmedArticle>'
+            f'<PubmedArticle>{citation_xml_list[1]}</PubmedArticle>\n'
+            '<BookDocumentSet><MedlineCitation><PMID>2</PMID></MedlineCitation></BookDocumentSet>\n'
+            '</PubmedArticleSet>\n'
+        )
+        path = os.path.join(self.temp_dir.name, "pubmed23n0003.xml.gz")
+        with gzip.open(path, "wt", encoding="utf-8") as write_file:
+            write_file.write(baseline_xml)
+        records = [json.dumps(record, ensure_ascii=False) for record in MedlineXmlFileReader().read(path)]
+        expected_records = read_records_with_element_tree(path)
+        self.assertEqual(len(expected_records), 2)
+        self.assertEqual(records, expected_records)
+
+    def test_exception_if_unknown_output(self):
+        with self.assertRaises(ValueError) as context:
+            MedlineXmlFileReader(output="unknown")
+        self.assertEqual("Output must be one of ['records', 'citation_data'].", str(context.exception))
+
+
+@pytest.mark.unit
+class TestMedlineXmlFileSetReader(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for file_num, input_data in enumerate([PUBMED_XML_INPUT_DATA, PUBMED_XML_INPUT_DATA[::-1], PUBMED_XML_INPUT_DATA[:1]], 1):
+            path = os.path.join(self.temp_dir.name, f"pubmed23n{file_num:04d}.xml.gz")
+            with gzip.open(path, "wt", encoding="utf-8") as write_file:
+                write_file.write(create_baseline_xml(input_data))
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_read_serial(self):
+        reader = MedlineXmlFileSetReader(MedlineXmlFileReader(output="citation_data"))
+        pmids = [citation_data["pmid"] for citation_data in reader.read(self.paths)]
+        self.assertEqual(pmids, [32770536, 30455223, 30455223, 32770536, 32770536])
+
+    def test_read_parallel(self):
+        reader = MedlineXmlFileSetReader(MedlineXmlFileReader(), max_workers=2)
+        uids = [record["uid"] for record in reader.read(self.paths)]
+        self.assertEqual(uids, [32770536, 30455223, 30455223, 32770536, 32770536])
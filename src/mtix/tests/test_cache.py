@@ -0,0 +1,152 @@
+from .data import *
+from mtix.cache import CnnResultsCache, LruCacheBackend, PredictionCache, SqliteCacheBackend
+from mtix.utils import TopNResults
+import numpy as np
+import os.path
+import pytest
+import sqlite3
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.unit
+class TestPredictionCache(TestCase):
+
+    def setUp(self):
+        self.cache = PredictionCache(LruCacheBackend(), "model-v1")
+
+    def test_round_trip(self):
+        indexing_lookup = { pmid: [{ "Term": f"term{pmid}" }] for pmid in EXPECTED_CITATION_DATA_LOOKUP }
+        self.cache.set_many(EXPECTED_CITATION_DATA_LOOKUP, indexing_lookup)
+        self.assertEqual(self.cache.get_many(EXPECTED_CITATION_DATA_LOOKUP), indexing_lookup)
+
+    def test_key_depends_on_citation_data_and_model_version(self):
+        citation_data = EXPECTED_CITATION_DATA_LOOKUP[32770536]
+        key = self.cache.create_key(citation_data)
+        self.assertEqual(key, self.cache.create_key(dict(reversed(list(citation_data.items())))))
+        self.assertNotEqual(key, self.cache.create_key(dict(citation_data, title="Revised title.")))
+        self.assertNotEqual(key, PredictionCache(LruCacheBackend(), "model-v2").create_key(citation_data))
+
+
+@pytest.mark.unit
+class TestCnnResultsCache(TestCase):
+
+    def setUp(self):
+        self.top_results = TopNResults.from_dict({ "32770536": { "1": 0.75, "2": 0.5 }, "30455223": { "3": 0.25 } })
+
+    def test_round_trip(self):
+        cache = CnnResultsCache(LruCacheBackend(), "cnn-v1")
+        cache.set_many(EXPECTED_CITATION_DATA_LOOKUP, self.top_results)
+        cached_results = cache.get_many(EXPECTED_CITATION_DATA_LOOKUP)
+        self.assertEqual(cached_results, self.top_results)
+        self.assertEqual(cached_results.label_ids.dtype, np.int32)
+
+    def test_float16_scores(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        backend = SqliteCacheBackend(os.path.join(temp_dir.name, "cnn.sqlite"))
+        cache = CnnResultsCache(backend, "cnn-v1", score_dtype="float16")
+        cache.set_many(EXPECTED_CITATION_DATA_LOOKUP, self.top_results)
+        cached_results = cache.get_many(EXPECTED_CITATION_DATA_LOOKUP).align(self.top_results.pmids)
+        np.testing.assert_array_equal(cached_results.label_ids, self.top_results.label_ids)
+        np.testing.assert_allclose(cached_results.scores, self.top_results.scores, rtol=1e-3)
+        backend.close()
+        temp_dir.cleanup()
+
+    def test_key_ignores_fields_not_sent_to_cnn(self):
+        cache = CnnResultsCache(LruCacheBackend(), "cnn-v1")
+        citation_data = EXPECTED_CITATION_DATA_LOOKUP[32770536]
+        key = cache.create_key(citation_data)
+        self.assertTrue(key.startswith("32770536:"))
+        self.assertEqual(key, cache.create_key(dict(citation_data, journal_title="Other title")))
+        self.assertNotEqual(key, cache.create_key(dict(citation_data, abstract="Revised abstract.")))
+
+    def test_exception_if_unknown_score_dtype(self):
+        with self.assertRaises(ValueError) as context:
+            CnnResultsCache(LruCacheBackend(), "cnn-v1", score_dtype="float64")
+        self.assertEqual("Score dtype must be one of ['float16', 'float32'].", str(context.exception))
+
+
+@pytest.mark.unit
+class TestLruCacheBackend(TestCase):
+
+    def test_size_eviction(self):
+        backend = LruCacheBackend(max_size=2)
+        backend.set_many({ "a": "1", "b": "2" })
+        backend.get_many(["a"])
+        backend.set_many({ "c": "3" })
+        self.assertEqual(backend.get_many(["a", "b", "c"]), { "a": "1", "c": "3" })
+
+    def test_ttl_expiry(self):
+        clock = FakeClock()
+        backend = LruCacheBackend(ttl=10, clock=clock)
+        backend.set_many({ "a": "1" })
+        clock.now = 5
+        self.assertEqual(backend.get_many(["a"]), { "a": "1" })
+        clock.now = 11
+        self.assertEqual(backend.get_many(["a"]), {})
+        self.assertEqual(len(backend), 0)
+
+
+@pytest.mark.unit
+class TestSqliteCacheBackend(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_persistence(self):
+        backend = SqliteCacheBackend(self.path)
+        backend.set_many({ str(idx): f"value{idx}" for idx in range(1500) })
+        backend.close()
+        backend = SqliteCacheBackend(self.path)
+        values = backend.get_many([str(idx) for idx in range(1600)])
+        self.assertEqual(values, { str(idx): f"value{idx}" for idx in range(1500) })
+        backend.close()
+
+    def test_size_eviction(self):
+        clock = FakeClock()
+        backend = SqliteCacheBackend(self.path, max_size=2, clock=clock)
+        backend.set_many({ "a": "1", "b": "2" })
+        clock.now = 1
+        backend.get_many(["a"])
+        clock.now = 2
+        backend.set_many({ "c": "3" })
+        self.assertEqual(backend.get_many(["a", "b", "c"]), { "a": "1", "c": "3" })
+        self.assertEqual(len(backend), 2)
+        backend.close()
+
+    def test_ttl_expiry(self):
+        clock = FakeClock()
+        backend = SqliteCacheBackend(self.path, ttl=10, clock=clock)
+        backend.set_many({ "a": "1" })
+        clock.now = 11
+        self.assertEqual(backend.get_many(["a"]), {})
+        self.assertEqual(len(backend), 0)
+        backend.close()
+
+    def test_expired_entries_are_deleted_on_set(self):
+        clock = FakeClock()
+        backend = SqliteCacheBackend(self.path, ttl=10, clock=clock)
+        backend.set_many({ "a": "1", "b": "2" })
+        clock.now = 11
+        self.assertEqual(backend.get_many(["a", "b"]), {})
+        connection = sqlite3.connect(self.path)
+        self.assertEqual(connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0], 2)
+        backend.set_many({ "c": "3" })
+        self.assertEqual(connection.execute("SELECT key FROM cache").fetchall(), [("c",)])
+        index_names = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'cache'")]
+        self.assertIn("cache_created", index_names)
+        connection.close()
+        backend.close()
@@ -0,0 +1,507 @@
+from mtix.endpoints import AdaptiveBatchController, AsyncResultTracker, create_batch_index_list, HuggingFaceEndpointHelper, HuggingFaceRealTimeEndpoint, is_retryable_error, is_throttling_error, RetryPolicy, TensorflowAsyncEndpoint, TensorflowRealTimeEndpoint
+from mtix.local_sagemaker import LocalS3Client
+import asyncio
+from botocore.exceptions import ClientError, EndpointConnectionError
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import random
+from sagemaker.exceptions import PollingTimeoutError
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+
+def echo_tf_predict(batch_data):
+    time.sleep(random.uniform(0, 0.01))
+    return { "predictions": [instance * 10 for instance in batch_data["instances"]] }
+
+
+def create_client_error(error_code, status_code):
+    return ClientError({ "Error": { "Code": error_code, "Message": "error" }, "ResponseMetadata": { "HTTPStatusCode": status_code } }, "InvokeEndpoint")
+
+
+def create_flaky_predict(failing_instances):
+    # Fails the first attempt of each batch that holds one of the failing 
+    # instances.
+    lock = threading.Lock()
+    failed_instances = set()
+    def predict(batch_data):
+        with lock:
+            to_fail = [instance for instance in batch_data["instances"] if instance in failing_instances and instance not in failed_instances]
+            failed_instances.update(to_fail)
+        if len(to_fail) > 0:
+            raise create_client_error("ThrottlingException", 400)
+        return echo_tf_predict(batch_data)
+    return predict
+
+
+@pytest.mark.unit
+class TestRealTimeEndpoint(TestCase):
+
+    def test_predict_sequential(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=echo_tf_predict)
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_size=3)
+        predictions = endpoint.predict({ "instances": list(range(10)) })
+        self.assertEqual(predictions, { "predictions": [idx * 10 for idx in range(10)] })
+        self.assertEqual(sagemaker_endpoint.predict.call_count, 4)
+
+    def test_predict_concurrent_preserves_order(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=echo_tf_predict)
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_size=2, max_in_flight=4)
+        predictions = endpoint.predict({ "instances": list(range(51)) })
+        self.assertEqual(predictions, { "predictions": [idx * 10 for idx in range(51)] })
+        self.assertEqual(sagemaker_endpoint.predict.call_count, 26)
+
+    def test_predict_multiple_results_per_input(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=lambda batch_data: { "predictions": [result for idx in batch_data["instances"] for result in [idx] * (idx % 3)] })
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_size=2, max_in_flight=2)
+        predictions = endpoint.predict({ "instances": list(range(7)) })
+        self.assertEqual(predictions, { "predictions": [1, 2, 2, 4, 5, 5] })
+
+    def test_predict_concurrent_is_bounded(self):
+        lock = threading.Lock()
+        in_flight = [0]
+        max_seen = [0]
+
+        def predict(batch_data):
+            with lock:
+                in_flight[0] += 1
+                max_seen[0] = max(max_seen[0], in_flight[0])
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+            return [[{ "label": "LABEL_1", "score": 0.5 }] for _ in batch_data["inputs"]]
+
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=predict)
+        endpoint = HuggingFaceRealTimeEndpoint(sagemaker_endpoint, batch_size=1, max_in_flight=3)
+        predictions = endpoint.predict({ "inputs": list(range(20)), "parameters": {} })
+        self.assertEqual(len(predictions), 20)
+        self.assertLessEqual(max_seen[0], 3)
+
+    def test_predict_concurrent_raises_batch_error(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=RuntimeError("endpoint error"))
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_size=1, max_in_flight=2)
+        with self.assertRaises(RuntimeError):
+            endpoint.predict({ "instances": list(range(5)) })
+
+    def test_predict_retries_failed_batch_only(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=create_flaky_predict({ 3, 7 }))
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_size=2, max_in_flight=2, retry_policy=RetryPolicy(base_delay=0))
+        with self.assertLogs("mtix.endpoints", level="WARNING"):
+            predictions = endpoint.predict({ "instances": list(range(10)) })
+        self.assertEqual(predictions, { "predictions": [idx * 10 for idx in range(10)] })
+        self.assertEqual(sagemaker_endpoint.predict.call_count, 7)
+
+    def test_predict_raises_after_max_attempts(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=create_client_error("ThrottlingException", 400))
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_size=2, retry_policy=RetryPolicy(max_attempts=3, base_delay=0))
+        with self.assertLogs("mtix.endpoints", level="WARNING"), self.assertRaises(ClientError):
+            endpoint.predict({ "instances": [1] })
+        self.assertEqual(sagemaker_endpoint.predict.call_count, 3)
+
+    def test_predict_does_not_retry_other_errors(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=create_client_error("ModelError", 424))
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_size=2, retry_policy=RetryPolicy(base_delay=0))
+        with self.assertRaises(ClientError):
+            endpoint.predict({ "instances": [1] })
+        self.assertEqual(sagemaker_endpoint.predict.call_count, 1)
+
+    def test_apredict_retries_failed_batch(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=create_flaky_predict({ 4 }))
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_size=2, max_in_flight=2, retry_policy=RetryPolicy(base_delay=0))
+        with self.assertLogs("mtix.endpoints", level="WARNING"):
+            predictions = asyncio.run(endpoint.apredict({ "instances": list(range(6)) }))
+        self.assertEqual(predictions, { "predictions": [idx * 10 for idx in range(6)] })
+        self.assertEqual(sagemaker_endpoint.predict.call_count, 4)
+
+    def test_predict_with_batch_controller(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=echo_tf_predict)
+        batch_controller = AdaptiveBatchController(min_batch_size=4, max_batch_size=64, max_in_flight=4, target_latency=10., batch_size_step=4, window_size=5)
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_size=128, batch_controller=batch_controller)
+        predictions = endpoint.predict({ "instances": list(range(20)) })
+        self.assertEqual(predictions, { "predictions": [idx * 10 for idx in range(20)] })
+        self.assertEqual(sagemaker_endpoint.predict.call_count, 5)
+        self.assertEqual(batch_controller.get_limits(), (8, 2))
+        predictions = endpoint.predict({ "instances": list(range(20)) })
+        self.assertEqual(predictions, { "predictions": [idx * 10 for idx in range(20)] })
+        self.assertEqual(sagemaker_endpoint.predict.call_count, 8)
+
+    def test_apredict_with_batch_controller(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=echo_tf_predict)
+        batch_controller = AdaptiveBatchController(min_batch_size=2, max_batch_size=16, max_in_flight=4, target_latency=10., batch_size_step=2, window_size=3)
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_controller=batch_controller)
+        predictions = asyncio.run(endpoint.apredict({ "instances": list(range(51)) }))
+        self.assertEqual(predictions, { "predictions": [idx * 10 for idx in range(51)] })
+        self.assertLess(sagemaker_endpoint.predict.call_count, 26)
+
+    def test_batch_controller_raises_batch_error(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=RuntimeError("endpoint error"))
+        batch_controller = AdaptiveBatchController(min_batch_size=1, max_batch_size=4, max_in_flight=2, initial_in_flight=2)
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_controller=batch_controller)
+        with self.assertRaises(RuntimeError):
+            endpoint.predict({ "instances": list(range(5)) })
+        with self.assertRaises(RuntimeError):
+            asyncio.run(endpoint.apredict({ "instances": list(range(5)) }))
+
+    def test_apredict_preserves_order(self):
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=echo_tf_predict)
+        endpoint = TensorflowRealTimeEndpoint(sagemaker_endpoint, batch_size=2, max_in_flight=4)
+        predictions = asyncio.run(endpoint.apredict({ "instances": list(range(51)) }))
+        self.assertEqual(predictions, { "predictions": [idx * 10 for idx in range(51)] })
+        self.assertEqual(sagemaker_endpoint.predict.call_count, 26)
+
+    def test_apredict_is_bounded(self):
+        in_flight = [0]
+        max_seen = [0]
+
+        async def apredict(batch_data):
+            in_flight[0] += 1
+            max_seen[0] = max(max_seen[0], in_flight[0])
+            await asyncio.sleep(0.01)
+            in_flight[0] -= 1
+            return { "predictions": batch_data["instances"] }
+
+        async_endpoint = TensorflowAsyncEndpoint.__new__(TensorflowAsyncEndpoint)
+        async_endpoint.apredict = apredict
+        endpoint = TensorflowRealTimeEndpoint(async_endpoint, batch_size=1, max_in_flight=3)
+        predictions = asyncio.run(endpoint.apredict({ "instances": list(range(20)) }))
+        self.assertEqual(predictions, { "predictions": list(range(20)) })
+        self.assertEqual(max_seen[0], 3)
+
+
+@pytest.mark.unit
+class TestTokenBudgetBatching(TestCase):
+
+    def test_create_batch_index_list_by_count(self):
+        batch_index_list = create_batch_index_list(list(range(7)), None, None, 3)
+        self.assertEqual(batch_index_list, [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_create_batch_index_list_by_token_budget(self):
+        parameters = { "max_length": 512 }
+        inputs = [[["q" * 400, "p" * 4]], [["q" * 4, "p" * 4]], [["q" * 8000, "p"]], [["q" * 12, "p" * 4]]]
+        batch_index_list = create_batch_index_list(inputs, parameters, HuggingFaceEndpointHelper(), batch_size=128, token_budget=512)
+        # Estimated token counts: 104, 5, 512 (truncated) and 7.
+        self.assertEqual(batch_index_list, [[1, 3, 0], [2]])
+
+    def test_create_batch_index_list_respects_batch_size(self):
+        inputs = ["text"] * 5
+        batch_index_list = create_batch_index_list(inputs, {}, HuggingFaceEndpointHelper(), batch_size=2, token_budget=1000)
+        self.assertEqual(batch_index_list, [[0, 1], [2, 3], [4]])
+
+    def test_predict_with_token_budget_preserves_order(self):
+        def predict(batch_data):
+            return [[{ "label": "LABEL_1", "score": len(item[0][0]) }] for item in batch_data["inputs"]]
+
+        sagemaker_endpoint = Mock()
+        sagemaker_endpoint.predict = Mock(side_effect=predict)
+        endpoint = HuggingFaceRealTimeEndpoint(sagemaker_endpoint, batch_size=4, token_budget=200)
+        lengths = [random.randint(1, 400) for _ in range(30)]
+        predictions = endpoint.predict({ "inputs": [[["q" * length, "p"]] for length in lengths], "parameters": { "max_length": 512 } })
+        self.assertEqual([prediction[0]["score"] for prediction in predictions], lengths)
+
+
+@pytest.mark.unit
+class TestRetryPolicy(TestCase):
+
+    def test_retryable_errors(self):
+        self.assertTrue(is_retryable_error(create_client_error("ThrottlingException", 400)))
+        self.assertTrue(is_retryable_error(create_client_error("ServiceUnavailable", 503)))
+        self.assertTrue(is_retryable_error(create_client_error("InternalServerError", 500)))
+        self.assertTrue(is_retryable_error(EndpointConnectionError(endpoint_url="https://runtime.sagemaker")))
+        self.assertTrue(is_retryable_error(TimeoutError()))
+        self.assertFalse(is_retryable_error(create_client_error("ModelError", 424)))
+        self.assertFalse(is_retryable_error(create_client_error("ValidationError", 400)))
+        self.assertFalse(is_retryable_error(RuntimeError("error")))
+
+    def test_throttling_errors(self):
+        self.assertTrue(is_throttling_error(create_client_error("ThrottlingException", 400)))
+        self.assertTrue(is_throttling_error(create_client_error("TooManyRequestsException", 400)))
+        self.assertTrue(is_throttling_error(create_client_error("SlowDown", 429)))
+        self.assertFalse(is_throttling_error(create_client_error("ServiceUnavailable", 503)))
+        self.assertFalse(is_throttling_error(create_client_error("InternalServerError", 500)))
+        self.assertFalse(is_throttling_error(EndpointConnectionError(endpoint_url="https://runtime.sagemaker")))
+        self.assertFalse(is_throttling_error(TimeoutError()))
+
+    def test_backoff_with_jitter(self):
+        retry_policy = RetryPolicy(max_attempts=6, base_delay=1, max_delay=5, seed=0)
+        error = create_client_error("ThrottlingException", 400)
+        delays = [retry_policy.get_retry_delay(error, attempt_count) for attempt_count in range(1, 6)]
+        for delay, max_delay in zip(delays, [1, 2, 4, 5, 5]):
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, max_delay)
+        same_seed_retry_policy = RetryPolicy(max_attempts=6, base_delay=1, max_delay=5, seed=0)
+        self.assertEqual(delays, [same_seed_retry_policy.get_retry_delay(error, attempt_count) for attempt_count in range(1, 6)])
+        self.assertIsNone(retry_policy.get_retry_delay(error, 6))
+
+    def test_exception_if_no_attempts(self):
+        with self.assertRaises(ValueError) as context:
+            RetryPolicy(max_attempts=0)
+        self.assertEqual("Max attempts must be at least 1.", str(context.exception))
+
+
+@pytest.mark.unit
+class TestAdaptiveBatchController(TestCase):
+
+    def _run_window(self, batch_controller, latency_per_item=0.01, max_unthrottled_in_flight=None):
+        batch_size, in_flight = batch_controller.get_limits()
+        for _ in range(batch_controller.window_size):
+            if max_unthrottled_in_flight is not None and in_flight > max_unthrottled_in_flight:
+                batch_controller.record_error(create_client_error("ThrottlingException", 400))
+            else:
+                batch_controller.record_batch(batch_size, latency_per_item * batch_size)
+        return batch_controller.get_limits()
+
+    def test_additive_increase_within_bounds(self):
+        batch_controller = AdaptiveBatchController(min_batch_size=8, max_batch_size=40, max_in_flight=3, target_latency=10., window_size=4)
+        limits = [self._run_window(batch_controller) for _ in range(4)]
+        self.assertEqual(limits, [(24, 2), (40, 3), (40, 3), (40, 3)])
+
+    def test_batch_size_converges_to_target_latency(self):
+        batch_controller = AdaptiveBatchController(min_batch_size=8, max_batch_size=512, target_latency=1., batch_size_step=8, window_size=4)
+        batch_sizes = [self._run_window(batch_controller)[0] for _ in range(100)]
+        self.assertLessEqual(max(batch_sizes), 108)
+        self.assertGreaterEqual(min(batch_sizes[20:]), 50)
+
+    def test_throttling_decreases_in_flight(self):
+        batch_controller = AdaptiveBatchController(min_batch_size=8, max_batch_size=8, max_in_flight=16, initial_in_flight=16, window_size=4)
+        self.assertEqual(self._run_window(batch_controller, max_unthrottled_in_flight=4), (8, 8))
+        self.assertEqual(self._run_window(batch_controller, max_unthrottled_in_flight=4), (8, 4))
+        in_flight_list = [self._run_window(batch_controller, max_unthrottled_in_flight=4)[1] for _ in range(20)]
+        self.assertLessEqual(max(in_flight_list), 5)
+        self.assertGreaterEqual(min(in_flight_list), 2)
+
+    def test_other_errors_do_not_decrease_in_flight(self):
+        batch_controller = AdaptiveBatchController(min_batch_size=8, max_batch_size=8, max_in_flight=4, initial_in_flight=4, window_size=2)
+        batch_controller.record_error(RuntimeError("error"))
+        batch_controller.record_error(RuntimeError("error"))
+        self.assertEqual(batch_controller.get_limits(), (8, 4))
+
+    def test_server_errors_do_not_decrease_in_flight(self):
+        batch_controller = AdaptiveBatchController(min_batch_size=8, max_batch_size=8, max_in_flight=4, initial_in_flight=4, window_size=2)
+        batch_controller.record_error(create_client_error("ServiceUnavailable", 503))
+        batch_controller.record_error(EndpointConnectionError(endpoint_url="https://runtime.sagemaker"))
+        self.assertEqual(batch_controller.get_limits(), (8, 4))
+
+    def test_exception_if_invalid_bounds(self):
+        with self.assertRaises(ValueError) as context:
+            AdaptiveBatchController(min_batch_size=64, max_batch_size=32)
+        self.assertEqual("Batch size bounds must satisfy 1 <= min <= max.", str(context.exception))
+        with self.assertRaises(ValueError) as context:
+            AdaptiveBatchController(min_batch_size=1, max_batch_size=32, min_in_flight=0)
+        self.assertEqual("In flight bounds must satisfy 1 <= min <= max.", str(context.exception))
+
+
+def create_batch_response(idx):
+    batch_response = Mock()
+    batch_response.output_path = f"s3://bucket/prefix/cnn_endpoint/outputs/{idx}.out"
+    batch_response.failure_path = None
+    batch_response.get_result = Mock(return_value=[idx])
+    return batch_response
+
+
+@pytest.mark.unit
+class TestAsyncResultTracker(TestCase):
+
+    def setUp(self):
+        # The output folder already holds objects from other requests.
+        self.s3 = LocalS3Client()
+        for idx in range(2500):
+            self.s3.put_object(Bucket="bucket", Key=f"prefix/cnn_endpoint/outputs/other-{idx}.out", Body=b"")
+        self.s3.list_objects_v2 = Mock(wraps=self.s3.list_objects_v2)
+
+    def land(self, idx):
+        self.s3.put_object(Bucket="bucket", Key=f"prefix/cnn_endpoint/outputs/{idx}.out", Body=b"")
+
+    def test_wait_returns_results_in_order(self):
+        # Batches land in reverse order, one per polling round.
+        landing_order = list(reversed(range(5)))
+        round_call_counts = []
+
+        def sleep(delay):
+            round_call_counts.append(self.s3.list_objects_v2.call_count - sum(round_call_counts))
+            self.land(landing_order[len(round_call_counts) - 1])
+
+        response_list = [create_batch_response(idx) for idx in range(5)]
+        tracker = AsyncResultTracker(self.s3, min_delay=0.001, max_delay=0.01, timeout=10)
+        with patch("mtix.endpoints.time.sleep", side_effect=sleep):
+            result_list = tracker.wait(response_list, lambda result: result * 2)
+        round_call_counts.append(self.s3.list_objects_v2.call_count - sum(round_call_counts))
+
+        self.assertEqual(result_list, [[idx, idx] for idx in range(5)])
+        # One single key query per outstanding batch and round.
+        self.assertEqual(round_call_counts, [5, 5, 4, 3, 2, 1])
+        for call in self.s3.list_objects_v2.call_args_list:
+            self.assertEqual(call.kwargs["MaxKeys"], 1)
+            self.assertRegex(call.kwargs["Prefix"], r"^prefix/cnn_endpoint/outputs/\d\.out$")
+        for batch_response in response_list:
+            batch_response.get_result.assert_called_once_with()
+
+    def test_wait_checks_failure_key(self):
+        batch_response = create_batch_response(0)
+        batch_response.failure_path = "s3://bucket/prefix/cnn_endpoint/failures/0-error.out"
+        self.s3.put_object(Bucket="bucket", Key="prefix/cnn_endpoint/failures/0-error.out", Body=b"")
+        tracker = AsyncResultTracker(self.s3, min_delay=0.001, max_delay=0.01, timeout=10)
+        result_list = tracker.wait([batch_response])
+
+        self.assertEqual(result_list, [[0]])
+        self.assertEqual([call.kwargs["Prefix"] for call in self.s3.list_objects_v2.call_args_list], ["prefix/cnn_endpoint/outputs/0.out", "prefix/cnn_endpoint/failures/0-error.out"])
+
+    def test_wait_times_out(self):
+        tracker = AsyncResultTracker(self.s3, min_delay=0.001, max_delay=0.01, timeout=0.05)
+        with self.assertRaises(PollingTimeoutError):
+            tracker.wait([create_batch_response(0)])
+
+    def test_await_results_returns_results_in_order(self):
+        # Each batch lands once its key has been queried twice.
+        query_counts = {}
+        list_objects_v2 = self.s3.list_objects_v2
+
+        def query_and_land(Bucket, Prefix, MaxKeys):
+            query_counts[Prefix] = query_counts.get(Prefix, 0) + 1
+            if query_counts[Prefix] == 2:
+                self.s3.put_object(Bucket=Bucket, Key=Prefix, Body=b"")
+            return list_objects_v2(Bucket=Bucket, Prefix=Prefix, MaxKeys=MaxKeys)
+
+        self.s3.list_objects_v2 = Mock(side_effect=query_and_land)
+        tracker = AsyncResultTracker(self.s3, min_delay=0.001, max_delay=0.01, timeout=10)
+        result_list = asyncio.run(tracker.await_results([create_batch_response(idx) for idx in range(5)], lambda result: result * 2))
+
+        self.assertEqual(result_list, [[idx, idx] for idx in range(5)])
+        self.assertEqual(self.s3.list_objects_v2.call_count, 10)
+
+    def test_await_results_does_not_hold_a_thread(self):
+        # Nothing lands until every wait has polled twice, which needs the 
+        # waits to share the single worker thread.
+        wait_count = 4
+        list_objects_v2 = self.s3.list_objects_v2
+
+        def query_and_land(Bucket, Prefix, MaxKeys):
+            if self.s3.list_objects_v2.call_count == 2 * wait_count:
+                for idx in range(wait_count):
+                    self.land(idx)
+            return list_objects_v2(Bucket=Bucket, Prefix=Prefix, MaxKeys=MaxKeys)
+
+        self.s3.list_objects_v2 = Mock(side_effect=query_and_land)
+        tracker = AsyncResultTracker(self.s3, min_delay=0.001, max_delay=0.01, timeout=5)
+
+        async def await_all():
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=1))
+            return await asyncio.gather(*[tracker.await_results([create_batch_response(idx)]) for idx in range(wait_count)])
+        result_lists = asyncio.run(await_all())
+
+        self.assertEqual(result_lists, [[[idx]] for idx in range(wait_count)])
+
+    def test_await_results_times_out(self):
+        tracker = AsyncResultTracker(self.s3, min_delay=0.001, max_delay=0.01, timeout=0.05)
+        with self.assertRaises(PollingTimeoutError):
+            asyncio.run(tracker.await_results([create_batch_response(0)]))
+
+
+@pytest.mark.unit
+class TestAsyncEndpoint(TestCase):
+
+    def setUp(self):
+        with patch("boto3.client") as client:
+            self.s3 = client.return_value
+            self.endpoint = TensorflowAsyncEndpoint(Mock(), "cnn_endpoint", "bucket", "prefix", 1, wait_delay=1, wait_max_attempts=1)
+
+    def test_clean_up_uses_bulk_deletes(self):
+        self.s3.delete_objects = Mock(return_value={})
+        input_key_list = [f"prefix/cnn_endpoint/inputs/{idx}.in" for idx in range(1200)]
+        output_key_list = [f"prefix/cnn_endpoint/outputs/{idx}.out" for idx in range(1200)]
+        failed_key_list = self.endpoint.clean_up(input_key_list, output_key_list)
+
+        self.assertEqual(failed_key_list, [])
+        self.assertEqual(self.s3.delete_objects.call_count, 3)
+        deleted_keys = [item["Key"] for call in self.s3.delete_objects.call_args_list for item in call.kwargs["Delete"]["Objects"]]
+        self.assertEqual(deleted_keys, input_key_list + output_key_list)
+
+    def test_clean_up_reports_failed_keys(self):
+        self.s3.delete_objects = Mock(side_effect=[{ "Errors": [{ "Key": "a", "Code": "AccessDenied" }] }, RuntimeError("s3 error")])
+        key_list = [str(idx) for idx in range(1500)]
+        with self.assertLogs("mtix.endpoints", level="WARNING"):
+            failed_key_list = self.endpoint.clean_up(["a"] + key_list, [])
+
+        self.assertEqual(failed_key_list, ["a"] + key_list[999:])
+        self.assertEqual(list(self.endpoint.failed_clean_up_keys), failed_key_list)
+
+    def test_failed_clean_up_keys_are_capped(self):
+        self.s3.delete_objects = Mock(side_effect=RuntimeError("s3 error"))
+        key_list = [str(idx) for idx in range(10500)]
+        with self.assertLogs("mtix.endpoints", level="WARNING"):
+            self.endpoint.clean_up(key_list, [])
+
+        self.assertEqual(list(self.endpoint.failed_clean_up_keys), key_list[500:])
+
+    def test_cancelled_apredict_cleans_up_running_submission(self):
+        submitted = threading.Event()
+        released = threading.Event()
+        batch_response = Mock()
+        batch_response.output_path = "s3://bucket/prefix/cnn_endpoint/outputs/0.out"
+
+        def predict_async(data, input_path):
+            submitted.set()
+            released.wait(5)
+            return batch_response
+
+        self.endpoint.sagemaker_async_endpoint.predict_async = Mock(side_effect=predict_async)
+        self.s3.delete_objects = Mock(return_value={})
+
+        async def cancel_apredict():
+            task = asyncio.create_task(self.endpoint.apredict({ "instances": [1] }))
+            await asyncio.to_thread(submitted.wait, 5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            released.set()
+        asyncio.run(cancel_apredict())
+        self.endpoint.wait_for_clean_up()
+
+        deleted_keys = [item["Key"] for item in self.s3.delete_objects.call_args.kwargs["Delete"]["Objects"]]
+        self.assertEqual(len(deleted_keys), 2)
+        self.assertEqual(deleted_keys[1], "prefix/cnn_endpoint/outputs/0.out")
+
+    def test_predict_retries_throttled_submission(self):
+        batch_response = Mock()
+        batch_response.output_path = "s3://bucket/prefix/cnn_endpoint/outputs/0.out"
+        self.endpoint.sagemaker_async_endpoint.predict_async = Mock(side_effect=[create_client_error("ThrottlingException", 400), batch_response])
+        self.endpoint.retry_policy = RetryPolicy(base_delay=0)
+        self.endpoint.tracker.wait = Mock(return_value=[[10]])
+        self.s3.delete_objects = Mock(return_value={})
+        with self.assertLogs("mtix.endpoints", level="WARNING"):
+            predictions = self.endpoint.predict({ "instances": [1] })
+        self.endpoint.wait_for_clean_up()
+
+        self.assertEqual(predictions, { "predictions": [10] })
+        self.assertEqual(self.endpoint.sagemaker_async_endpoint.predict_async.call_count, 2)
+        deleted_keys = [item["Key"] for item in self.s3.delete_objects.call_args.kwargs["Delete"]["Objects"]]
+        self.assertEqual(len(deleted_keys), 2)
+
+    def test_predict_cleans_up_in_background(self):
+        batch_response = Mock()
+        batch_response.output_path = "s3://bucket/prefix/cnn_endpoint/outputs/0.out"
+        self.endpoint.sagemaker_async_endpoint.predict_async = Mock(return_value=batch_response)
+        self.endpoint.tracker.wait = Mock(return_value=[[10]])
+        self.s3.delete_objects = Mock(return_value={})
+        predictions = self.endpoint.predict({ "instances": [1] })
+        self.endpoint.wait_for_clean_up()
+
+        self.assertEqual(predictions, { "predictions": [10] })
+        deleted_keys = [item["Key"] for item in self.s3.delete_objects.call_args.kwargs["Delete"]["Objects"]]
+        self.assertEqual(len(deleted_keys), 2)
+        self.assertTrue(deleted_keys[0].startswith("prefix/cnn_endpoint/inputs/"))
+        self.assertEqual(deleted_keys[1], "prefix/cnn_endpoint/outputs/0.out")
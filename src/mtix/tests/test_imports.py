@@ -0,0 +1,42 @@
+import json
+import os
+import pytest
+import subprocess
+import sys
+from unittest import TestCase
+
+
+HEAVY_MODULES = ["boto3", "pandas", "sagemaker"]
+IMPORT_TIME_BUDGET = 1.0
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import mtix, mtix.baseline, mtix.endpoints, mtix.pipelines, mtix.predictors, mtix.utils
+elapsed = time.perf_counter() - start
+print(json.dumps({ "elapsed": elapsed, "modules": sorted(name for name in sys.modules if name.split(".")[0] in %r) }))
+""" % (HEAVY_MODULES,)
+
+
+@pytest.mark.unit
+class TestImports(TestCase):
+
+    def run_import_script(self):
+        # Runs in a fresh interpreter, as the test process has already 
+        # imported most modules.
+        src_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([src_dir, os.environ.get("PYTHONPATH", "")]))
+        output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], check=True, capture_output=True, text=True, env=env).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+    def test_heavy_modules_not_imported(self):
+        result = self.run_import_script()
+        self.assertEqual(result["modules"], [], "Heavy modules imported with mtix.")
+
+    def test_import_time_budget(self):
+        result = self.run_import_script()
+        self.assertLess(result["elapsed"], IMPORT_TIME_BUDGET, f"Importing mtix took {result['elapsed']:.3f}s.")
+
+    def test_create_indexing_pipeline_is_importable(self):
+        from mtix import create_indexing_pipeline
+        from mtix.sagemaker_factory import create_indexing_pipeline as factory_create_indexing_pipeline
+        self.assertIs(create_indexing_pipeline, factory_create_indexing_pipeline)
@@ -0,0 +1,204 @@
+from .data import *
+import asyncio
+from functools import partial
+from mtix.cache import LruCacheBackend
+from mtix.endpoints import TensorflowAsyncEndpoint, TensorflowRealTimeEndpoint
+from mtix.instrumentation import get_payload_size, get_stage_name, observe_stages, OpenTelemetryObserver, PrometheusObserver, SummaryObserver
+from mtix.local_sagemaker import create_local_sagemaker_backend, LocalAsyncPredictor, LocalPredictor, LocalS3Client, SyntheticCnnModel
+from mtix.pipelines import arun_stages, PipelinedExecutor
+from mtix.sagemaker_factory import create_indexing_pipeline
+import pytest
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+
+@pytest.mark.unit
+class TestObserveStages(TestCase):
+
+    def test_stage_names(self):
+        def _cnn_stage(state):
+            return state
+        def store_cached_predictions(cache, state):
+            return state
+        self.assertEqual(get_stage_name(_cnn_stage), "cnn")
+        self.assertEqual(get_stage_name(partial(store_cached_predictions, None)), "store_cached_predictions")
+
+    def test_no_observer(self):
+        stages = [lambda state: state]
+        self.assertIs(observe_stages(stages, None), stages)
+
+    def test_observed_stage(self):
+        def _cnn_stage(state):
+            return dict(state, cnn_results=1)
+        observer = SummaryObserver()
+        stage, = observe_stages([_cnn_stage], observer)
+        output_state = stage({ "input_data": [1, 2, 3] })
+
+        self.assertEqual(output_state, { "input_data": [1, 2, 3], "cnn_results": 1 })
+        self.assertEqual(get_stage_name(stage), "cnn")
+        self.assertEqual(observer.stages["cnn"]["batches"], 1)
+        self.assertEqual(observer.stages["cnn"]["items"], 3)
+
+    def test_observed_coroutine_stage(self):
+        async def _cnn_astage(state):
+            await asyncio.sleep(0.01)
+            return dict(state, cnn_results=1)
+        observer = SummaryObserver()
+        stage, = observe_stages([_cnn_astage], observer)
+        output_state = asyncio.run(arun_stages([stage], { "input_data": [1, 2, 3] }))
+
+        self.assertEqual(output_state, { "input_data": [1, 2, 3], "cnn_results": 1 })
+        self.assertEqual(get_stage_name(stage), "cnn")
+        self.assertEqual(observer.stages["cnn"]["items"], 3)
+        self.assertGreaterEqual(observer.stages["cnn"]["wall_time"], 0.01)
+
+    def test_queue_wait(self):
+        def _first_stage(state):
+            return state
+        observer = SummaryObserver()
+        executor = PipelinedExecutor(observe_stages([_first_stage], observer), observer=observer)
+        results = list(executor.run({ "input_data": [idx] } for idx in range(3)))
+
+        self.assertEqual(results, [{ "input_data": [idx] } for idx in range(3)])
+        self.assertEqual(observer.stages["first"]["batches"], 3)
+        self.assertGreaterEqual(observer.stages["first"]["queue_wait"], 0.)
+
+
+@pytest.mark.unit
+class TestEndpointObserver(TestCase):
+
+    def setUp(self):
+        self.observer = Mock()
+        self.sagemaker_endpoint = Mock()
+        self.sagemaker_endpoint.predict = Mock(side_effect=lambda data: { "predictions": [2 * item for item in data["instances"]] })
+
+    def test_real_time_batches(self):
+        endpoint = TensorflowRealTimeEndpoint(self.sagemaker_endpoint, batch_size=2, max_in_flight=2, observer=self.observer, endpoint_name="cnn_endpoint")
+        predictions = endpoint.predict({ "instances": [1, 2, 3] })
+
+        self.assertEqual(predictions, { "predictions": [2, 4, 6] })
+        self.assertEqual(self.observer.on_endpoint_batch.call_count, 2)
+        item_counts = sorted(call.args[2] for call in self.observer.on_endpoint_batch.call_args_list)
+        self.assertEqual(item_counts, [1, 2])
+        for call in self.observer.on_endpoint_batch.call_args_list:
+            endpoint_name, wall_time, item_count, request_bytes, response_bytes, request_time, call_time, response_time, queue_wait, retries = call.args
+            self.assertEqual(endpoint_name, "cnn_endpoint")
+            self.assertEqual(retries, 0)
+            self.assertGreaterEqual(wall_time, request_time + call_time + response_time)
+            self.assertGreaterEqual(queue_wait, 0.)
+        expected_request_bytes = get_payload_size({ "instances": [1, 2] }) + get_payload_size({ "instances": [3] })
+        self.assertEqual(sum(call.args[3] for call in self.observer.on_endpoint_batch.call_args_list), expected_request_bytes)
+
+    def test_apredict_batches(self):
+        endpoint = TensorflowRealTimeEndpoint(self.sagemaker_endpoint, batch_size=1, max_in_flight=1, observer=self.observer, endpoint_name="cnn_endpoint")
+        predictions = asyncio.run(endpoint.apredict({ "instances": [1, 2, 3] }))
+
+        self.assertEqual(predictions, { "predictions": [2, 4, 6] })
+        self.assertEqual(self.observer.on_endpoint_batch.call_count, 3)
+
+    def test_payload_size_not_measured(self):
+        self.observer.measure_payload_size = False
+        endpoint = TensorflowRealTimeEndpoint(self.sagemaker_endpoint, batch_size=2, observer=self.observer, endpoint_name="cnn_endpoint")
+        with patch("mtix.endpoints.get_payload_size") as get_payload_size:
+            endpoint.predict({ "instances": [1, 2, 3] })
+
+        get_payload_size.assert_not_called()
+        for call in self.observer.on_endpoint_batch.call_args_list:
+            self.assertEqual(call.args[3:5], (None, None))
+
+    def test_async_payload_size_measured_on_submission(self):
+        s3 = LocalS3Client()
+        async_predictor = LocalAsyncPredictor(LocalPredictor(SyntheticCnnModel(LABEL_IDS)), s3, "s3://bucket/prefix/cnn_endpoint/outputs", "s3://bucket/prefix/cnn_endpoint/failures")
+        endpoint = TensorflowAsyncEndpoint(async_predictor, "cnn_endpoint", "bucket", "prefix", 2, wait_delay=0.01, wait_max_attempts=500, s3=s3, observer=self.observer)
+        endpoint.helper.construct_batch_data = Mock(wraps=endpoint.helper.construct_batch_data)
+        endpoint.predict({ "instances": [MESH_HEADING_CNN_ENDPOINT_EXPECTED_INPUT_DATA["instances"][0]] * 3 })
+        async_predictor.shutdown()
+
+        self.assertEqual(endpoint.helper.construct_batch_data.call_count, 2)
+        self.assertEqual(sum(call.args[3] for call in self.observer.on_endpoint_batch.call_args_list), get_payload_size({ "instances": [MESH_HEADING_CNN_ENDPOINT_EXPECTED_INPUT_DATA["instances"][0]] * 2 }) + get_payload_size({ "instances": [MESH_HEADING_CNN_ENDPOINT_EXPECTED_INPUT_DATA["instances"][0]] }))
+
+
+@pytest.mark.unit
+class TestLocalIndexingPipelineObserver(LocalLookupFilesMixin, TestCase):
+
+    def _predict(self, observer, async_bucket_name=None, async_prefix=None, use_apredict=False):
+        backend = create_local_sagemaker_backend(LABEL_IDS, QUALIFIER_UIS, *self.endpoint_names)
+        pipeline = create_indexing_pipeline(*self.lookup_paths, *self.endpoint_names, pointwise_batch_size=64, async_bucket_name=async_bucket_name, async_prefix=async_prefix, sagemaker_backend=backend, observer=observer)
+        if use_apredict:
+            predictions = asyncio.run(pipeline.apredict(PUBMED_XML_INPUT_DATA))
+        else:
+            predictions = pipeline.predict(PUBMED_XML_INPUT_DATA)
+        backend.shutdown()
+        return predictions
+
+    def test_real_time(self):
+        observer = SummaryObserver(measure_payload_size=True)
+        predictions = self._predict(observer)
+
+        self.assertEqual(predictions, self._predict(None))
+        self.assertEqual(list(observer.stages), ["parse", "cnn", "pointwise", "listwise", "format", "subheading"])
+        self.assertTrue(all(summary["items"] == 2 for summary in observer.stages.values()))
+        self.assertEqual(set(observer.endpoints), { "cnn_endpoint", "pointwise_endpoint", "listwise_endpoint", "subheading_endpoint" })
+        self.assertEqual(observer.endpoints["pointwise_endpoint"]["batches"], 4)
+        self.assertEqual(observer.endpoints["pointwise_endpoint"]["items"], 200)
+        self.assertGreater(observer.endpoints["cnn_endpoint"]["request_bytes"], 0)
+        self.assertGreater(observer.endpoints["cnn_endpoint"]["response_bytes"], 0)
+
+    def test_apredict(self):
+        observer = SummaryObserver()
+        predictions = self._predict(observer, use_apredict=True)
+
+        self.assertEqual(predictions, self._predict(None))
+        self.assertEqual(list(observer.stages), ["parse", "cnn", "pointwise", "listwise", "format", "subheading"])
+        self.assertTrue(all(summary["batches"] == 1 and summary["items"] == 2 for summary in observer.stages.values()))
+        self.assertGreater(observer.stages["pointwise"]["wall_time"], 0.)
+        self.assertEqual(observer.endpoints["pointwise_endpoint"]["items"], 200)
+
+    def test_apredict_with_cache(self):
+        observer = SummaryObserver()
+        backend = create_local_sagemaker_backend(LABEL_IDS, QUALIFIER_UIS, *self.endpoint_names)
+        pipeline = create_indexing_pipeline(*self.lookup_paths, *self.endpoint_names, sagemaker_backend=backend, prediction_cache_backend=LruCacheBackend(), observer=observer)
+        predictions = asyncio.run(pipeline.apredict(PUBMED_XML_INPUT_DATA))
+        cached_predictions = asyncio.run(pipeline.apredict(PUBMED_XML_INPUT_DATA))
+        backend.shutdown()
+
+        self.assertEqual(cached_predictions, predictions)
+        self.assertEqual(list(observer.stages), ["parse", "lookup_cached_predictions", "cnn", "pointwise", "listwise", "format", "subheading", "store_cached_predictions"])
+        self.assertEqual(observer.stages["cnn"]["batches"], 2)
+        self.assertEqual(observer.endpoints["cnn_endpoint"]["batches"], 1)
+
+    def test_async(self):
+        observer = SummaryObserver()
+        predictions = self._predict(observer, "bucket", "prefix")
+
+        self.assertEqual(predictions, self._predict(None))
+        self.assertNotIn("request_bytes", observer.endpoints["pointwise_endpoint"])
+        self.assertEqual(observer.endpoints["pointwise_endpoint"]["batches"], 4)
+        self.assertEqual(observer.endpoints["pointwise_endpoint"]["items"], 200)
+        self.assertGreater(observer.endpoints["listwise_endpoint"]["call_time"], 0.)
+
+
+@pytest.mark.unit
+class TestMetricsObservers(TestCase):
+
+    def test_open_telemetry(self):
+        meter = Mock()
+        meter.create_histogram = Mock(side_effect=lambda *args, **kwargs: Mock())
+        meter.create_counter = Mock(side_effect=lambda *args, **kwargs: Mock())
+        observer = OpenTelemetryObserver(meter)
+        observer.on_stage("cnn", 0.5, 10)
+        observer.on_endpoint_batch("cnn_endpoint", 0.4, 10, 100, 200, 0.1, 0.2, 0.1, retries=1)
+
+        observer.stage_duration.record.assert_any_call(0.5, { "stage": "cnn" })
+        observer.endpoint_bytes.add.assert_any_call(200, { "endpoint": "cnn_endpoint", "direction": "response" })
+        observer.endpoint_retries.add.assert_called_once_with(1, { "endpoint": "cnn_endpoint" })
+
+    def test_prometheus(self):
+        prometheus_client = pytest.importorskip("prometheus_client")
+        registry = prometheus_client.CollectorRegistry()
+        observer = PrometheusObserver(registry)
+        observer.on_stage("cnn", 0.5, 10)
+        observer.on_endpoint_batch("cnn_endpoint", 0.4, 10, 100, 200, 0.1, 0.2, 0.1)
+
+        self.assertEqual(registry.get_sample_value("mtix_stage_items_total", { "stage": "cnn" }), 10)
+        self.assertEqual(registry.get_sample_value("mtix_endpoint_bytes_total", { "endpoint": "cnn_endpoint", "direction": "request" }), 100)
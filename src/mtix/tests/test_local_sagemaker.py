@@ -0,0 +1,151 @@
+from .data import *
+from botocore.exceptions import ClientError
+from mtix.cache import LruCacheBackend
+from mtix.endpoints import AdaptiveBatchController, HuggingFaceAsyncEndpoint, RetryPolicy, TensorflowRealTimeEndpoint
+from mtix.local_sagemaker import create_local_sagemaker_backend, LatencyModel, LocalAsyncPredictor, LocalEndpointError, LocalPredictor, LocalS3Client, SyntheticCnnModel, SyntheticListwiseModel, SyntheticPointwiseModel
+from mtix.sagemaker_factory import create_indexing_pipeline
+import pytest
+from unittest import TestCase
+from unittest.mock import Mock
+
+
+@pytest.mark.unit
+class TestLatencyModel(TestCase):
+
+    def test_seeded_samples(self):
+        samples = [LatencyModel(latency=0.1, latency_per_item=0.01, jitter=0.05, seed=1).sample(10) for _ in range(2)]
+        self.assertEqual(samples[0], samples[1])
+        delay, failed = samples[0]
+        self.assertGreater(delay, 0.2)
+        self.assertFalse(failed)
+
+    def test_wait(self):
+        sleep = Mock()
+        LatencyModel(latency=0.5, latency_per_item=0.1, sleep=sleep).wait(3)
+        sleep.assert_called_once_with(0.8)
+        with self.assertRaises(LocalEndpointError):
+            LatencyModel(failure_rate=1., sleep=sleep).wait(1)
+
+
+@pytest.mark.unit
+class TestLocalS3Client(TestCase):
+
+    def test_list_and_delete(self):
+        s3 = LocalS3Client()
+        for idx in range(2500):
+            s3.put_object(Bucket="bucket", Key=f"prefix/{idx:04d}.out", Body=b"")
+        s3.put_object(Bucket="bucket", Key="other/0000.out", Body=b"")
+        keys = []
+        kwargs = { "Bucket": "bucket", "Prefix": "prefix/" }
+        while True:
+            response = s3.list_objects_v2(**kwargs)
+            keys.extend(item["Key"] for item in response["Contents"])
+            if not response["IsTruncated"]:
+                break
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+        self.assertEqual(keys, [f"prefix/{idx:04d}.out" for idx in range(2500)])
+        s3.delete_objects(Bucket="bucket", Delete={ "Objects": [{ "Key": key } for key in keys] })
+        self.assertEqual(len(s3), 1)
+
+    def test_get_missing_object(self):
+        s3 = LocalS3Client()
+        s3.put_object(Bucket="bucket", Key="prefix/0000.out", Body="output")
+        self.assertEqual(s3.get_object(Bucket="bucket", Key="prefix/0000.out")["Body"].read(), b"output")
+        with self.assertRaises(ClientError) as context:
+            s3.get_object(Bucket="bucket", Key="prefix/0001.out")
+        self.assertEqual(context.exception.response["Error"]["Code"], "NoSuchKey")
+        self.assertEqual(context.exception.response["ResponseMetadata"]["HTTPStatusCode"], 404)
+        self.assertEqual(context.exception.operation_name, "GetObject")
+
+
+@pytest.mark.unit
+class TestLocalPredictors(TestCase):
+
+    def test_synthetic_scores_are_deterministic(self):
+        cnn_model = SyntheticCnnModel(LABEL_IDS)
+        response = cnn_model(MESH_HEADING_CNN_ENDPOINT_EXPECTED_INPUT_DATA)
+        self.assertEqual(response, SyntheticCnnModel(LABEL_IDS)(MESH_HEADING_CNN_ENDPOINT_EXPECTED_INPUT_DATA))
+        self.assertEqual([len(predictions) for predictions in response["predictions"]], [100, 100])
+        scores = [score for _, score in response["predictions"][0]]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        listwise_response = SyntheticListwiseModel()(HUGGINGFACE_ENDPOINT_EXPECTED_LISTWISE_INPUT_DATA)
+        self.assertEqual([len(scores) for scores in listwise_response], [50, 50])
+
+    def test_real_time_endpoint(self):
+        predictor = LocalPredictor(SyntheticCnnModel(LABEL_IDS))
+        endpoint = TensorflowRealTimeEndpoint(predictor, batch_size=1, max_in_flight=2)
+        response = endpoint.predict(MESH_HEADING_CNN_ENDPOINT_EXPECTED_INPUT_DATA)
+        self.assertEqual(response, SyntheticCnnModel(LABEL_IDS)(MESH_HEADING_CNN_ENDPOINT_EXPECTED_INPUT_DATA))
+        self.assertEqual((predictor.request_count, predictor.item_count), (2, 2))
+
+    def test_async_endpoint(self):
+        s3 = LocalS3Client()
+        async_predictor = LocalAsyncPredictor(LocalPredictor(SyntheticPointwiseModel()), s3, "s3://bucket/prefix/pointwise_endpoint/outputs", "s3://bucket/prefix/pointwise_endpoint/failures")
+        endpoint = HuggingFaceAsyncEndpoint(async_predictor, "pointwise_endpoint", "bucket", "prefix", 4, wait_delay=0.01, wait_max_attempts=500, s3=s3)
+        response = endpoint.predict(HUGGINGFACE_ENDPOINT_EXPECTED_POINTWISE_INPUT_DATA)
+        self.assertEqual(response, SyntheticPointwiseModel()(HUGGINGFACE_ENDPOINT_EXPECTED_POINTWISE_INPUT_DATA))
+        endpoint.wait_for_clean_up()
+        self.assertEqual(len(s3), 0)
+        async_predictor.shutdown()
+
+    def test_async_endpoint_failure(self):
+        s3 = LocalS3Client()
+        predictor = LocalPredictor(SyntheticPointwiseModel(), LatencyModel(failure_rate=1.))
+        async_predictor = LocalAsyncPredictor(predictor, s3, "s3://bucket/prefix/pointwise_endpoint/outputs", "s3://bucket/prefix/pointwise_endpoint/failures")
+        endpoint = HuggingFaceAsyncEndpoint(async_predictor, "pointwise_endpoint", "bucket", "prefix", 4, wait_delay=0.01, wait_max_attempts=500, s3=s3)
+        with self.assertRaises(LocalEndpointError):
+            endpoint.predict(HUGGINGFACE_ENDPOINT_EXPECTED_POINTWISE_INPUT_DATA)
+        async_predictor.shutdown()
+
+
+@pytest.mark.unit
+class TestLocalIndexingPipeline(LocalLookupFilesMixin, TestCase):
+
+    def _predict(self, async_bucket_name=None, async_prefix=None, latency_model_lookup=None, retry_policy=None, batch_controller_lookup=None):
+        backend = create_local_sagemaker_backend(LABEL_IDS, QUALIFIER_UIS, *self.endpoint_names, latency_model_lookup=latency_model_lookup)
+        pipeline = create_indexing_pipeline(*self.lookup_paths, *self.endpoint_names, pointwise_batch_size=16, async_bucket_name=async_bucket_name, async_prefix=async_prefix, sagemaker_backend=backend, retry_policy=retry_policy, batch_controller_lookup=batch_controller_lookup)
+        predictions = pipeline.predict(PUBMED_XML_INPUT_DATA)
+        backend.shutdown()
+        return predictions, backend
+
+    def test_real_time(self):
+        predictions, backend = self._predict()
+        self.assertEqual([citation_predictions["PMID"] for citation_predictions in predictions], [32770536, 30455223])
+        self.assertGreater(sum(len(citation_predictions["Indexing"]) for citation_predictions in predictions), 0)
+        self.assertEqual(predictions, self._predict()[0])
+        self.assertEqual(backend.predictor_lookup["cnn"].item_count, 2)
+
+    def test_async_same_as_real_time(self):
+        predictions, backend = self._predict("bucket", "prefix")
+        self.assertEqual(predictions, self._predict()[0])
+        self.assertEqual(backend.predictor_lookup["pointwise"].item_count, 200)
+
+    def test_retries_simulated_failures(self):
+        latency_model_lookup = { "pointwise": LatencyModel(failure_rate=0.3, seed=1) }
+        with self.assertLogs("mtix.endpoints", level="WARNING"):
+            predictions, backend = self._predict(latency_model_lookup=latency_model_lookup, retry_policy=RetryPolicy(max_attempts=20, base_delay=0))
+        self.assertEqual(predictions, self._predict()[0])
+        self.assertGreater(backend.predictor_lookup["pointwise"].request_count, 13)
+
+    def test_adaptive_batching(self):
+        batch_controller = AdaptiveBatchController(min_batch_size=8, max_batch_size=64, max_in_flight=4, window_size=4)
+        predictions, backend = self._predict(batch_controller_lookup={ "pointwise_endpoint": batch_controller })
+        self.assertEqual(predictions, self._predict()[0])
+        self.assertLess(backend.predictor_lookup["pointwise"].request_count, 25)
+        self.assertGreater(batch_controller.get_limits()[0], 8)
+
+    def test_model_version_depends_on_settings(self):
+        backend = create_local_sagemaker_backend(LABEL_IDS, QUALIFIER_UIS, *self.endpoint_names)
+        model_versions = set()
+        for kwargs in [{}, { "listwise_cascade_max_score": 0.1 }, { "listwise_token_budget": 4096 }, { "pointwise_token_budget": 4096 }]:
+            pipeline = create_indexing_pipeline(*self.lookup_paths, *self.endpoint_names, sagemaker_backend=backend, prediction_cache_backend=LruCacheBackend(), **kwargs)
+            model_versions.add(pipeline.prediction_cache.model_version)
+        backend.shutdown()
+        self.assertEqual(len(model_versions), 4)
+        self.assertIn("pointwise_padding=longest", pipeline.prediction_cache.model_version)
+
+    def test_exception_if_adaptive_batching_async(self):
+        batch_controller = AdaptiveBatchController(min_batch_size=8, max_batch_size=64)
+        with self.assertRaises(ValueError) as context:
+            self._predict("bucket", "prefix", batch_controller_lookup={ "pointwise_endpoint": batch_controller })
+        self.assertEqual("Adaptive batching is only supported for real-time endpoints.", str(context.exception))
@@ -1,13 +1,21 @@
 from .data import *
-from mtix.pipelines import IndexingPipeline, MeshHeadingPredictionPipeline, MtiJsonResultsFormatter
+from mtix.cache import LruCacheBackend, PredictionCache
+from mtix.pipelines import IndexingPipeline, MeshHeadingPredictionPipeline, MtiJsonResultsFormatter, PipelinedExecutor
 from mtix.predictors import CnnModelTop100Predictor, PointwiseModelTopNPredictor, ListwiseModelTopNPredictor, SubheadingPredictor
-from mtix.utils import CitationDataSanitizer, PubMedXmlInputDataParser
+from mtix.utils import CitationDataSanitizer, PubMedXmlInputDataParser, TopNResults
+import asyncio
 import pytest
+import threading
 from unittest import skip, TestCase
-from unittest.mock import MagicMock, Mock
+from unittest.mock import AsyncMock, MagicMock, Mock
 
 
 THRESHOLD = 0.475
+CNN_TOP_N_RESULTS = TopNResults.from_dict(CNN_RESULTS)
+LISTWISE_TOP_N_RESULTS = TopNResults.from_dict(LISTWISE_RESULTS)
+POINTWISE_TOP_N_RESULTS = TopNResults.from_dict(POINTWISE_RESULTS)
+POINTWISE_AVG_TOP_N_RESULTS = TopNResults.from_dict(POINTWISE_AVG_RESULTS)
+UNORDERED_LISTWISE_AVG_TOP_N_RESULTS = TopNResults.from_dict(UNORDERED_LISTWISE_AVG_RESULTS)
 
 
 @pytest.mark.unit
@@ -19,11 +27,11 @@ class TestMeshHeadingPredictionPipeline(TestCase):
         self.sanitizer = CitationDataSanitizer(max_year)
         self.sanitizer.sanitize_list = Mock(wraps=self.sanitizer.sanitize_list)
         self.cnn_predictor = CnnModelTop100Predictor(None)
-        self.cnn_predictor.predict = MagicMock(return_value=CNN_RESULTS)
+        self.cnn_predictor.predict = MagicMock(return_value=CNN_TOP_N_RESULTS)
         self.pointwise_predictor = PointwiseModelTopNPredictor(None, {}, 100)
-        self.pointwise_predictor.predict = MagicMock(return_value=POINTWISE_RESULTS)
+        self.pointwise_predictor.predict = MagicMock(return_value=POINTWISE_TOP_N_RESULTS)
         self.listwise_predictor = ListwiseModelTopNPredictor(None, {}, 50)
-        self.listwise_predictor.predict = MagicMock(return_value=LISTWISE_RESULTS)
+        self.listwise_predictor.predict = MagicMock(return_value=LISTWISE_TOP_N_RESULTS)
         self.results_formatter = MtiJsonResultsFormatter(NAME_LOOKUP, TYPE_LOOKUP, UI_LOOKUP, THRESHOLD)
         self.results_formatter.format = Mock(wraps=self.results_formatter.format)
         self.pipeline = MeshHeadingPredictionPipeline(input_data_parser, self.sanitizer, self.cnn_predictor, self.pointwise_predictor, self.listwise_predictor, self.results_formatter)
@@ -35,10 +43,78 @@ class TestMeshHeadingPredictionPipeline(TestCase):
 
         self.sanitizer.sanitize_list.assert_called_once_with(list(EXPECTED_CITATION_DATA_LOOKUP.values()))
         self.cnn_predictor.predict.assert_called_once_with(EXPECTED_CITATION_DATA_LOOKUP)
-        self.pointwise_predictor.predict.assert_called_once_with(EXPECTED_CITATION_DATA_LOOKUP, CNN_RESULTS)
-        self.listwise_predictor.predict.assert_called_once_with(EXPECTED_CITATION_DATA_LOOKUP, POINTWISE_AVG_RESULTS)
+        self.pointwise_predictor.predict.assert_called_once_with(EXPECTED_CITATION_DATA_LOOKUP, CNN_TOP_N_RESULTS)
+        self.listwise_predictor.predict.assert_called_once_with(EXPECTED_CITATION_DATA_LOOKUP, POINTWISE_AVG_TOP_N_RESULTS)
         input_data_lookup = { item["uid"]: item["data"] for item in PUBMED_XML_INPUT_DATA}
-        self.results_formatter.format.assert_called_once_with(input_data_lookup, UNORDERED_LISTWISE_AVG_RESULTS)
+        self.results_formatter.format.assert_called_once_with(input_data_lookup, UNORDERED_LISTWISE_AVG_TOP_N_RESULTS)
+
+    def test_predict_with_citation_data(self):
+        predictions, citation_data_lookup = self.pipeline.predict_with_citation_data(PUBMED_XML_INPUT_DATA)
+
+        self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS, "Predictions do not match expected result.")
+        self.assertEqual(citation_data_lookup, EXPECTED_CITATION_DATA_LOOKUP, "Citation data not as expected.")
+
+    def test_predict_batches(self):
+        input_batches = [PUBMED_XML_INPUT_DATA, PUBMED_XML_INPUT_DATA]
+        predictions_list = list(self.pipeline.predict_batches(iter(input_batches)))
+
+        self.assertEqual(predictions_list, [EXPECTED_MESH_HEADING_PREDICTIONS, EXPECTED_MESH_HEADING_PREDICTIONS], "Predictions do not match expected result.")
+        self.assertEqual(self.cnn_predictor.predict.call_count, 2)
+        self.assertEqual(self.listwise_predictor.predict.call_count, 2)
+
+    def test_predict_stream(self):
+        input_data = (item for item in PUBMED_XML_INPUT_DATA * 3)
+        predictions = list(self.pipeline.predict_stream(input_data, batch_size=2))
+
+        self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS * 3, "Predictions do not match expected result.")
+        self.assertEqual(self.cnn_predictor.predict.call_count, 3)
+
+    def test_predict_stream_is_lazy(self):
+        consumed = []
+        def input_data():
+            for idx in range(1000):
+                consumed.append(idx)
+                yield PUBMED_XML_INPUT_DATA[idx % 2]
+        stream = self.pipeline.predict_stream(input_data(), batch_size=2)
+        next(stream)
+        stream.close()
+        self.assertLess(len(consumed), 100, "Input consumed eagerly.")
+
+    def test_predict_cache_hits_skip_endpoints(self):
+        self.pipeline.prediction_cache = PredictionCache(LruCacheBackend(), "model-v1")
+        self.pipeline.predict(PUBMED_XML_INPUT_DATA)
+        predictions = self.pipeline.predict(PUBMED_XML_INPUT_DATA)
+
+        self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS, "Predictions do not match expected result.")
+        self.cnn_predictor.predict.assert_called_once()
+        self.pointwise_predictor.predict.assert_called_once()
+        self.listwise_predictor.predict.assert_called_once()
+
+    def test_predict_cache_partial_hits_predict_misses(self):
+        self.pipeline.prediction_cache = PredictionCache(LruCacheBackend(), "model-v1")
+        expected_indexing_lookup = { prediction["PMID"]: prediction["Indexing"] for prediction in EXPECTED_MESH_HEADING_PREDICTIONS }
+        self.pipeline.prediction_cache.set_many(EXPECTED_CITATION_DATA_LOOKUP, { 32770536: expected_indexing_lookup[32770536] })
+        predictions = self.pipeline.predict(PUBMED_XML_INPUT_DATA)
+
+        self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS, "Predictions do not match expected result.")
+        self.cnn_predictor.predict.assert_called_once_with({ 30455223: EXPECTED_CITATION_DATA_LOOKUP[30455223] })
+
+    def test_apredict(self):
+        self.cnn_predictor.apredict = AsyncMock(return_value=CNN_TOP_N_RESULTS)
+        self.pointwise_predictor.apredict = AsyncMock(return_value=POINTWISE_TOP_N_RESULTS)
+        self.listwise_predictor.apredict = AsyncMock(return_value=LISTWISE_TOP_N_RESULTS)
+        predictions = asyncio.run(self.pipeline.apredict(PUBMED_XML_INPUT_DATA))
+
+        self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS, "Predictions do not match expected result.")
+        self.cnn_predictor.apredict.assert_awaited_once_with(EXPECTED_CITATION_DATA_LOOKUP)
+        self.pointwise_predictor.apredict.assert_awaited_once_with(EXPECTED_CITATION_DATA_LOOKUP, CNN_TOP_N_RESULTS)
+        self.listwise_predictor.apredict.assert_awaited_once_with(EXPECTED_CITATION_DATA_LOOKUP, POINTWISE_AVG_TOP_N_RESULTS)
+
+    def test_close(self):
+        self.pipeline.input_data_parser = Mock()
+        with self.pipeline as pipeline:
+            self.assertIs(pipeline, self.pipeline)
+        self.pipeline.input_data_parser.close.assert_called_once_with()
 
 
 @pytest.mark.unit
@@ -46,7 +122,7 @@ class TestIndexingPipeline(TestCase):
 
     def setUp(self):
         self.meshHeadingPredictionPipeline = MeshHeadingPredictionPipeline(None, None, None, None, None, None)
-        self.meshHeadingPredictionPipeline.predict = MagicMock(return_value=MESH_HEADING_PREDICTIONS_WITH_PT_SCR)
+        self.meshHeadingPredictionPipeline.predict_with_citation_data = MagicMock(return_value=(MESH_HEADING_PREDICTIONS_WITH_PT_SCR, EXPECTED_CITATION_DATA_LOOKUP))
         self.subheading_predictor = SubheadingPredictor(None, None, None, None)
         self.subheading_predictor.predict = MagicMock(return_value=EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING)
         self.pipeline = IndexingPipeline(self.meshHeadingPredictionPipeline, self.subheading_predictor)
@@ -55,8 +131,97 @@ class TestIndexingPipeline(TestCase):
         predictions = self.pipeline.predict(PUBMED_XML_INPUT_DATA)
     
         self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING, "Predictions do not match expected result.")
-        self.meshHeadingPredictionPipeline.predict.assert_called_once_with(PUBMED_XML_INPUT_DATA)
-        self.subheading_predictor.predict.assert_called_once_with(MESH_HEADING_PREDICTIONS_WITH_PT_SCR)
+        self.meshHeadingPredictionPipeline.predict_with_citation_data.assert_called_once_with(PUBMED_XML_INPUT_DATA)
+        self.subheading_predictor.predict.assert_called_once_with(MESH_HEADING_PREDICTIONS_WITH_PT_SCR, EXPECTED_CITATION_DATA_LOOKUP)
+
+    def test_predict_batches(self):
+        mesh_heading_stage = lambda state: dict(state, predictions=MESH_HEADING_PREDICTIONS_WITH_PT_SCR, citation_data_lookup=EXPECTED_CITATION_DATA_LOOKUP)
+        self.meshHeadingPredictionPipeline.create_stages = MagicMock(side_effect=lambda prediction_cache=None, extra_stages=(): [mesh_heading_stage] + list(extra_stages))
+        predictions_list = list(self.pipeline.predict_batches([PUBMED_XML_INPUT_DATA]))
+
+        self.assertEqual(predictions_list, [EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING], "Predictions do not match expected result.")
+        self.subheading_predictor.predict.assert_called_once_with(MESH_HEADING_PREDICTIONS_WITH_PT_SCR, EXPECTED_CITATION_DATA_LOOKUP)
+
+    def test_predict_stream(self):
+        mesh_heading_stage = lambda state: dict(state, predictions=MESH_HEADING_PREDICTIONS_WITH_PT_SCR, citation_data_lookup=EXPECTED_CITATION_DATA_LOOKUP)
+        self.meshHeadingPredictionPipeline.create_stages = MagicMock(side_effect=lambda prediction_cache=None, extra_stages=(): [mesh_heading_stage] + list(extra_stages))
+        predictions = list(self.pipeline.predict_stream(iter(PUBMED_XML_INPUT_DATA), batch_size=2))
+
+        self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING, "Predictions do not match expected result.")
+
+    def test_predict_cache_hits_skip_endpoints(self):
+        mesh_heading_stage = Mock(side_effect=lambda state: dict(state, predictions=[prediction for prediction in MESH_HEADING_PREDICTIONS_WITH_PT_SCR if prediction["PMID"] in state["predict_lookup"]]))
+        self.meshHeadingPredictionPipeline = MeshHeadingPredictionPipeline(PubMedXmlInputDataParser(), CitationDataSanitizer(2021), None, None, None, None)
+        self.meshHeadingPredictionPipeline._cnn_stage = mesh_heading_stage
+        self.meshHeadingPredictionPipeline._pointwise_stage = lambda state: state
+        self.meshHeadingPredictionPipeline._listwise_stage = lambda state: state
+        self.meshHeadingPredictionPipeline._format_stage = lambda state: state
+        self.pipeline = IndexingPipeline(self.meshHeadingPredictionPipeline, self.subheading_predictor, PredictionCache(LruCacheBackend(), "model-v1"))
+
+        first_predictions = self.pipeline.predict(PUBMED_XML_INPUT_DATA)
+        second_predictions = self.pipeline.predict(PUBMED_XML_INPUT_DATA)
+
+        self.assertEqual(first_predictions, EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING, "Predictions do not match expected result.")
+        self.assertEqual(second_predictions, EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING, "Predictions do not match expected result.")
+        self.assertEqual(mesh_heading_stage.call_args_list[-1].args[0]["predict_lookup"], {}, "Cached citations predicted again.")
+        self.subheading_predictor.predict.assert_called_once()
+
+    def test_apredict(self):
+        self.meshHeadingPredictionPipeline.apredict_with_citation_data = AsyncMock(return_value=(MESH_HEADING_PREDICTIONS_WITH_PT_SCR, EXPECTED_CITATION_DATA_LOOKUP))
+        self.subheading_predictor.apredict = AsyncMock(return_value=EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING)
+        predictions = asyncio.run(self.pipeline.apredict(PUBMED_XML_INPUT_DATA))
+
+        self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING, "Predictions do not match expected result.")
+        self.meshHeadingPredictionPipeline.apredict_with_citation_data.assert_awaited_once_with(PUBMED_XML_INPUT_DATA)
+        self.subheading_predictor.apredict.assert_awaited_once_with(MESH_HEADING_PREDICTIONS_WITH_PT_SCR, EXPECTED_CITATION_DATA_LOOKUP)
+
+    def test_close(self):
+        self.meshHeadingPredictionPipeline.input_data_parser = Mock()
+        with self.pipeline as pipeline:
+            self.assertIs(pipeline, self.pipeline)
+        self.meshHeadingPredictionPipeline.input_data_parser.close.assert_called_once_with()
+
+
+@pytest.mark.unit
+class TestPipelinedExecutor(TestCase):
+
+    def test_run_preserves_order(self):
+        executor = PipelinedExecutor([lambda x: x + 1, lambda x: x * 10], max_queue_size=2)
+        results = list(executor.run(range(20)))
+        self.assertEqual(results, [(x + 1) * 10 for x in range(20)])
+
+    def test_run_overlaps_stages(self):
+        # The second stage only finishes the first item once the first stage 
+        # has started on the second item, which requires the stages to run 
+        # concurrently.
+        second_item_started = threading.Event()
+        def first_stage(item):
+            if item == 1:
+                second_item_started.set()
+            return item
+        def second_stage(item):
+            if item == 0:
+                self.assertTrue(second_item_started.wait(timeout=5), "Stages did not overlap.")
+            return item
+        executor = PipelinedExecutor([first_stage, second_stage])
+        self.assertEqual(list(executor.run([0, 1, 2])), [0, 1, 2])
+
+    def test_run_raises_stage_exception(self):
+        def failing_stage(item):
+            if item == 2:
+                raise ValueError("Stage failed.")
+            return item
+        executor = PipelinedExecutor([failing_stage, lambda x: x])
+        results = []
+        with self.assertRaises(ValueError) as context:
+            for item in executor.run(range(5)):
+                results.append(item)
+        self.assertEqual(str(context.exception), "Stage failed.")
+        self.assertEqual(results, [0, 1])
+
+    def test_run_no_items(self):
+        executor = PipelinedExecutor([lambda x: x])
+        self.assertEqual(list(executor.run([])), [])
 
 
 @pytest.mark.unit
@@ -67,5 +232,5 @@ class TestMtiJsonResultsFormatter(TestCase):
 
     def test_format(self):
         input_data_lookup = { item["uid"]: item["data"] for item in PUBMED_XML_INPUT_DATA}
-        predictions = self.formatter.format(input_data_lookup, UNORDERED_LISTWISE_AVG_RESULTS)
+        predictions = self.formatter.format(input_data_lookup, UNORDERED_LISTWISE_AVG_TOP_N_RESULTS)
         self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS, "Predictions are not as expected.")
\ No newline at end of file
@@ -1,10 +1,13 @@
 from .data import *
-from mtix.predictors import CnnModelTop100Predictor, ListwiseModelTopNPredictor, PointwiseModelTopNPredictor, replace_brackets, SubheadingPredictor
-from mtix.utils import CitationDataSanitizer, PubMedXmlInputDataParser
+from mtix.cache import CnnResultsCache, LruCacheBackend
+from mtix.predictors import CachedCnnModelTop100Predictor, CascadeListwiseModelTopNPredictor, CnnModelTop100Predictor, ListwiseModelTopNPredictor, PointwiseModelTopNPredictor, replace_brackets, SubheadingPredictor
+from mtix.utils import average_top_results, CitationDataSanitizer, PubMedXmlInputDataParser, TopNResults
+import asyncio
+import copy
 import pytest
 import random
 from unittest import TestCase
-from unittest.mock import call, MagicMock, Mock
+from unittest.mock import AsyncMock, call, MagicMock, Mock
 
 
 def round_top_results(top_results, ndigits):
@@ -25,16 +28,62 @@ class TestCnnModelTop100Predictor(TestCase):
         tensorflow_endpoint.predict = MagicMock(return_value=MESH_HEADING_CNN_ENDPOINT_RESULTS)
         cnn_predictor = CnnModelTop100Predictor(tensorflow_endpoint)
         top_results = cnn_predictor.predict(EXPECTED_CITATION_DATA_LOOKUP)
-        top_results = round_top_results(top_results, 4)
+        top_results = round_top_results(top_results.to_dict(), 4)
         cnn_results = round_top_results(CNN_RESULTS, 4)
         self.assertEqual(top_results, cnn_results, "top results not as expected.")
         tensorflow_endpoint.predict.assert_called_once_with(MESH_HEADING_CNN_ENDPOINT_EXPECTED_INPUT_DATA)
 
+    def test_apredict(self):
+        tensorflow_endpoint = Mock()
+        tensorflow_endpoint.apredict = AsyncMock(return_value=MESH_HEADING_CNN_ENDPOINT_RESULTS)
+        cnn_predictor = CnnModelTop100Predictor(tensorflow_endpoint)
+        top_results = asyncio.run(cnn_predictor.apredict(EXPECTED_CITATION_DATA_LOOKUP))
+        top_results = round_top_results(top_results.to_dict(), 4)
+        cnn_results = round_top_results(CNN_RESULTS, 4)
+        self.assertEqual(top_results, cnn_results, "top results not as expected.")
+        tensorflow_endpoint.apredict.assert_awaited_once_with(MESH_HEADING_CNN_ENDPOINT_EXPECTED_INPUT_DATA)
+
     def test_replace_brackets(self):
         results = replace_brackets(REPLACE_BRACKETS_INPUT)
         self.assertEqual(results, REPLACE_BRACKETS_OUTPUT)
 
 
+@pytest.mark.unit
+class TestCachedCnnModelTop100Predictor(TestCase):
+
+    def setUp(self):
+        self.cnn_results = TopNResults.from_dict(CNN_RESULTS)
+        self.cnn_results_cache = CnnResultsCache(LruCacheBackend(), "cnn-v1")
+
+    def test_predict_partial_hit(self):
+        self.cnn_results_cache.set_many(EXPECTED_CITATION_DATA_LOOKUP, self.cnn_results.align([30455223]))
+        cnn_predictor = Mock()
+        cnn_predictor.predict = MagicMock(return_value=self.cnn_results.align([32770536]))
+        cached_predictor = CachedCnnModelTop100Predictor(cnn_predictor, self.cnn_results_cache)
+        top_results = cached_predictor.predict(EXPECTED_CITATION_DATA_LOOKUP)
+        cnn_predictor.predict.assert_called_once_with({ 32770536: EXPECTED_CITATION_DATA_LOOKUP[32770536] })
+        self.assertEqual(top_results.pmids.tolist(), [32770536, 30455223])
+        self.assertEqual(top_results, self.cnn_results)
+        self.assertEqual(len(self.cnn_results_cache.get_many(EXPECTED_CITATION_DATA_LOOKUP)), 2)
+
+    def test_predict_all_hits(self):
+        self.cnn_results_cache.set_many(EXPECTED_CITATION_DATA_LOOKUP, self.cnn_results)
+        cnn_predictor = Mock()
+        cached_predictor = CachedCnnModelTop100Predictor(cnn_predictor, self.cnn_results_cache)
+        top_results = cached_predictor.predict(EXPECTED_CITATION_DATA_LOOKUP)
+        cnn_predictor.predict.assert_not_called()
+        self.assertEqual(top_results, self.cnn_results)
+
+    def test_apredict_all_misses(self):
+        cnn_predictor = Mock()
+        cnn_predictor.apredict = AsyncMock(return_value=self.cnn_results)
+        cached_predictor = CachedCnnModelTop100Predictor(cnn_predictor, self.cnn_results_cache)
+        top_results = asyncio.run(cached_predictor.apredict(EXPECTED_CITATION_DATA_LOOKUP))
+        cnn_predictor.apredict.assert_awaited_once_with(EXPECTED_CITATION_DATA_LOOKUP)
+        self.assertEqual(top_results, self.cnn_results)
+        self.assertEqual(self.cnn_results_cache.get_many(EXPECTED_CITATION_DATA_LOOKUP), self.cnn_results)
+
+
 @pytest.mark.unit
 class TestPointwiseModelTopNPredictor(TestCase):
 
@@ -44,9 +93,9 @@ class TestPointwiseModelTopNPredictor(TestCase):
         
         top_n = 5
         pointwise_predictor = PointwiseModelTopNPredictor(huggingface_endpoint, NAME_W_TYPES_LOOKUP, top_n)
-        top_results = pointwise_predictor.predict(EXPECTED_CITATION_DATA_LOOKUP, CNN_RESULTS_SHUFFLED)
+        top_results = pointwise_predictor.predict(EXPECTED_CITATION_DATA_LOOKUP, TopNResults.from_dict(CNN_RESULTS_SHUFFLED))
 
-        top_results = round_top_results(top_results, 6)
+        top_results = round_top_results(top_results.to_dict(), 6)
         expected_top_results = round_top_results(EXPECTED_POINTWISE_TOP_5_RESULTS, 6)
         
         self.assertEqual(top_results, expected_top_results, "top results not as expected.")
@@ -55,6 +104,16 @@ class TestPointwiseModelTopNPredictor(TestCase):
         
         huggingface_endpoint.predict.assert_called_once_with(HUGGINGFACE_ENDPOINT_EXPECTED_POINTWISE_INPUT_DATA)
 
+    def test_query_is_shared_by_citation_inputs(self):
+        top_n = 5
+        pointwise_predictor = PointwiseModelTopNPredictor(None, NAME_W_TYPES_LOOKUP, top_n)
+        citation_data = EXPECTED_CITATION_DATA_LOOKUP[32770536]
+        citation_label_ids = TopNResults.from_dict(CNN_RESULTS_SHUFFLED).top_k(top_n).label_ids[0].tolist()
+        input_list = pointwise_predictor._create_citation_inputs(citation_data, citation_label_ids)
+        query_ids = { id(citation_input[0][0]) for citation_input in input_list }
+        self.assertEqual(len(input_list), top_n)
+        self.assertEqual(len(query_ids), 1)
+
 
 @pytest.mark.unit
 class TestListwiseModelTopNPredictor(TestCase):
@@ -66,9 +125,9 @@ class TestListwiseModelTopNPredictor(TestCase):
         top_n = 50
         listwise_predictor = ListwiseModelTopNPredictor(huggingface_endpoint, NAME_W_TYPES_LOOKUP, top_n)
         pointwise_avg_results_shuffled = shuffle_top_results(POINTWISE_AVG_RESULTS)
-        top_results = listwise_predictor.predict(EXPECTED_CITATION_DATA_LOOKUP, pointwise_avg_results_shuffled)
+        top_results = listwise_predictor.predict(EXPECTED_CITATION_DATA_LOOKUP, TopNResults.from_dict(pointwise_avg_results_shuffled))
 
-        top_results = round_top_results(top_results, 4)
+        top_results = round_top_results(top_results.to_dict(), 4)
         expected_top_results =  {q_id: {p_id: LISTWISE_RESULTS[q_id][p_id] for p_id in top_results[q_id]} for q_id in top_results}
         expected_top_results = round_top_results(expected_top_results, 4)
         
@@ -79,6 +138,45 @@ class TestListwiseModelTopNPredictor(TestCase):
         huggingface_endpoint.predict.assert_called_once_with(HUGGINGFACE_ENDPOINT_EXPECTED_LISTWISE_INPUT_DATA)
 
 
+@pytest.mark.unit
+class TestCascadeListwiseModelTopNPredictor(TestCase):
+
+    def setUp(self):
+        self.pointwise_avg_results = TopNResults.from_dict({ "32770536": { "1": 0.9, "2": 0.1 }, "30455223": { "3": 0.2, "4": 0.1 } })
+        self.listwise_predictor = Mock()
+        self.listwise_predictor.top_n = 40
+
+    def test_predict_same_as_listwise_predictor(self):
+        huggingface_endpoint = Mock()
+        huggingface_endpoint.predict = MagicMock(return_value=HUGGINGFACE_ENDPOINT_LISTWISE_RESULTS)
+        listwise_predictor = ListwiseModelTopNPredictor(huggingface_endpoint, NAME_W_TYPES_LOOKUP, 50)
+        cascade_predictor = CascadeListwiseModelTopNPredictor(listwise_predictor, 0.49)
+        pointwise_avg_results = TopNResults.from_dict(POINTWISE_AVG_RESULTS)
+        top_results = cascade_predictor.predict(EXPECTED_CITATION_DATA_LOOKUP, pointwise_avg_results)
+        self.assertEqual(top_results, listwise_predictor.predict(EXPECTED_CITATION_DATA_LOOKUP, pointwise_avg_results))
+        huggingface_endpoint.predict.assert_called_with(HUGGINGFACE_ENDPOINT_EXPECTED_LISTWISE_INPUT_DATA)
+
+    def test_predict_skips_decided_citations(self):
+        self.listwise_predictor.predict = MagicMock(return_value=TopNResults.from_dict({ "32770536": { "1": 0.7, "2": 0.3 } }))
+        cascade_predictor = CascadeListwiseModelTopNPredictor(self.listwise_predictor, 0.49, max_listwise_score=0.7)
+        top_results = cascade_predictor.predict(EXPECTED_CITATION_DATA_LOOKUP, self.pointwise_avg_results)
+
+        send_lookup, send_results = self.listwise_predictor.predict.call_args.args
+        self.assertEqual(send_lookup, { 32770536: EXPECTED_CITATION_DATA_LOOKUP[32770536] })
+        self.assertEqual(send_results, TopNResults.from_dict({ "32770536": { "1": 0.9, "2": 0.1 } }))
+        self.assertEqual(top_results.pmids.tolist(), [32770536, 30455223])
+        self.assertEqual(top_results.to_dict(), { "32770536": { "1": 0.7, "2": 0.3 }, "30455223": { "3": 0.0, "4": 0.0 } })
+        listwise_avg_results = average_top_results(self.pointwise_avg_results, top_results).threshold(0.49)
+        self.assertEqual(listwise_avg_results.to_dict(), { "32770536": { "1": 0.8 }, "30455223": {} })
+
+    def test_apredict_all_citations_decided(self):
+        self.listwise_predictor.apredict = AsyncMock()
+        cascade_predictor = CascadeListwiseModelTopNPredictor(self.listwise_predictor, 0.96)
+        top_results = asyncio.run(cascade_predictor.apredict(EXPECTED_CITATION_DATA_LOOKUP, self.pointwise_avg_results))
+        self.listwise_predictor.apredict.assert_not_awaited()
+        self.assertEqual(top_results.to_dict(), { "32770536": { "1": 0.0, "2": 0.0 }, "30455223": { "3": 0.0, "4": 0.0 } })
+
+
 @pytest.mark.unit
 class TestSubheadingPredictor(TestCase):
 
@@ -95,4 +193,43 @@ class TestSubheadingPredictor(TestCase):
         self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING, "subheading predictions not as expected.")
         santizer_call_list = [call(citation_data) for citation_data in EXPECTED_CITATION_DATA_LOOKUP.values()]
         data_sanitizer.sanitize.assert_has_calls(santizer_call_list, any_order=False)
-        subheading_endpoint.predict.assert_called_once_with(SUBHEADING_ENDPOINT_EXPECTED_INPUT_DATA)
\ No newline at end of file
+        subheading_endpoint.predict.assert_called_once_with(SUBHEADING_ENDPOINT_EXPECTED_INPUT_DATA)
+    def test_predict_does_not_modify_input(self):
+        input_parser = PubMedXmlInputDataParser()
+        data_sanitizer = CitationDataSanitizer(2021)
+        subheading_endpoint = Mock()
+        subheading_endpoint.predict = MagicMock(return_value=SUBHEADING_ENDPOINT_RESULTS)
+        subheading_predictor = SubheadingPredictor(input_parser, data_sanitizer, subheading_endpoint, SUBHEADING_NAME_LOOKUP)
+        mesh_heading_predictions = copy.deepcopy(MESH_HEADING_PREDICTIONS_WITH_PT_SCR)
+        predictions = subheading_predictor.predict(mesh_heading_predictions)
+
+        self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING, "subheading predictions not as expected.")
+        self.assertEqual(mesh_heading_predictions, MESH_HEADING_PREDICTIONS_WITH_PT_SCR, "input predictions were modified.")
+
+    def test_predict_reuses_citation_data(self):
+        input_parser = PubMedXmlInputDataParser()
+        input_parser.parse_data = Mock(wraps=input_parser.parse_data)
+        max_year = 2021
+        data_sanitizer = CitationDataSanitizer(max_year)
+        data_sanitizer.sanitize = Mock(wraps=data_sanitizer.sanitize)
+        subheading_endpoint = Mock()
+        subheading_endpoint.predict = MagicMock(return_value=SUBHEADING_ENDPOINT_RESULTS)
+        subheading_predictor = SubheadingPredictor(input_parser, data_sanitizer, subheading_endpoint, SUBHEADING_NAME_LOOKUP)
+        predictions = subheading_predictor.predict(MESH_HEADING_PREDICTIONS_WITH_PT_SCR, EXPECTED_CITATION_DATA_LOOKUP)
+
+        self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING, "subheading predictions not as expected.")
+        input_parser.parse_data.assert_not_called()
+        data_sanitizer.sanitize.assert_not_called()
+        subheading_endpoint.predict.assert_called_once_with(SUBHEADING_ENDPOINT_EXPECTED_INPUT_DATA)
+
+    def test_apredict(self):
+        input_parser = PubMedXmlInputDataParser()
+        max_year = 2021
+        data_sanitizer = CitationDataSanitizer(max_year)
+        subheading_endpoint = Mock()
+        subheading_endpoint.apredict = AsyncMock(return_value=SUBHEADING_ENDPOINT_RESULTS)
+        subheading_predictor = SubheadingPredictor(input_parser, data_sanitizer, subheading_endpoint, SUBHEADING_NAME_LOOKUP)
+        predictions = asyncio.run(subheading_predictor.apredict(MESH_HEADING_PREDICTIONS_WITH_PT_SCR))
+     
+        self.assertEqual(predictions, EXPECTED_MESH_HEADING_PREDICTIONS_WITH_PT_SCR_SUBHEADING, "subheading predictions not as expected.")
+        subheading_endpoint.apredict.assert_awaited_once_with(SUBHEADING_ENDPOINT_EXPECTED_INPUT_DATA)
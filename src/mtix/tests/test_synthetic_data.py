@@ -0,0 +1,28 @@
+import gzip
+import json
+from mtix.synthetic_data import create_synthetic_input_data, load_input_data
+from mtix.utils import PubMedXmlInputDataParser
+import os.path
+import pytest
+import tempfile
+from unittest import TestCase
+
+
+@pytest.mark.unit
+class TestSyntheticData(TestCase):
+
+    def test_create_synthetic_input_data(self):
+        input_data = create_synthetic_input_data(3)
+        self.assertEqual(input_data, create_synthetic_input_data(3))
+        self.assertNotEqual(input_data, create_synthetic_input_data(3, seed=1))
+        citation_data_list = PubMedXmlInputDataParser().parse(input_data)
+        self.assertEqual([citation_data["pmid"] for citation_data in citation_data_list], [30000000, 30000001, 30000002])
+
+    def test_load_input_data(self):
+        input_data = create_synthetic_input_data(3)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "test_set_data.json.gz")
+            with gzip.open(path, "wt", encoding="utf-8") as write_file:
+                json.dump(input_data, write_file)
+            self.assertEqual(load_input_data(path, 2), input_data[:2])
+        self.assertEqual(load_input_data(None, 2), create_synthetic_input_data(2))
@@ -1,11 +1,19 @@
 from .data import * 
-from mtix.utils import average_top_results, Base64Helper, CitationDataSanitizer, create_lookup, MedlineDateParser, PubMedXmlInputDataParser, PubMedXmlParser
+from concurrent.futures import ThreadPoolExecutor
+from mtix.utils import average_top_results, Base64Helper, build_compact_lookup, CitationDataSanitizer, CompactLookup, create_lookup, MedlineDateParser, PAD_LABEL_ID, LxmlPubMedXmlParser, PubMedXmlInputDataParser, PubMedXmlParser, SinglePassPubMedXmlParser, TopNResults
+import numpy as np
+import os.path
+import pickle
 import pytest
+import tempfile
+import threading
+import time
 from io import StringIO
 from unittest import TestCase
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 
+SHIPPED_LOOKUP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "integration_tests", "data")
 LOOKUP_TSV = """1\tD000001
 2\tD000002
 3\tD000003
@@ -352,6 +360,72 @@ class TestPubMedXmlInputDataParser(TestCase):
         expected_citation_data_list = list(EXPECTED_CITATION_DATA_LOOKUP.values())
         self.assertEqual(citaton_data_list, expected_citation_data_list, "Citation data list different from expected citation data list.")
 
+    def test_parse_parallel(self):
+        parser = PubMedXmlInputDataParser(max_workers=2, min_parallel_items=1, chunks_per_worker=1)
+        input_data = PUBMED_XML_INPUT_DATA * 5
+        try:
+            citaton_data_list = parser.parse(input_data)
+        finally:
+            parser.close()
+        expected_citation_data_list = list(EXPECTED_CITATION_DATA_LOOKUP.values()) * 5
+        self.assertEqual(citaton_data_list, expected_citation_data_list, "Citation data list different from expected citation data list.")
+
+    def test_parse_parallel_from_thread(self):
+        parser = PubMedXmlInputDataParser(max_workers=2, min_parallel_items=1)
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                citaton_data_list = executor.submit(parser.parse, PUBMED_XML_INPUT_DATA).result()
+            self.assertEqual(parser._executor._mp_context.get_start_method(), "spawn")
+        finally:
+            parser.close()
+        self.assertEqual(citaton_data_list, list(EXPECTED_CITATION_DATA_LOOKUP.values()))
+
+    def test_parse_parallel_from_threads_shares_pool(self):
+        def slow_create_process_pool(max_workers):
+            time.sleep(0.05)
+            return ThreadPoolExecutor(max_workers=max_workers)
+
+        parser = PubMedXmlInputDataParser(max_workers=2, min_parallel_items=1)
+        results = []
+        with patch("mtix.utils.create_process_pool", side_effect=slow_create_process_pool) as create_process_pool:
+            threads = [threading.Thread(target=lambda: results.append(parser.parse(PUBMED_XML_INPUT_DATA))) for _ in range(4)]
+            try:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            finally:
+                parser.close()
+        create_process_pool.assert_called_once_with(2)
+        self.assertIsNone(parser._executor)
+        self.assertEqual(results, [list(EXPECTED_CITATION_DATA_LOOKUP.values())] * 4)
+
+    def test_pickle_drops_pool(self):
+        parser = PubMedXmlInputDataParser(max_workers=2, min_parallel_items=1)
+        parser._executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            unpickled_parser = pickle.loads(pickle.dumps(parser))
+        finally:
+            parser.close()
+        self.assertIsNone(unpickled_parser._executor)
+        self.assertEqual(unpickled_parser.parse(PUBMED_XML_INPUT_DATA[:1]), list(EXPECTED_CITATION_DATA_LOOKUP.values())[:1])
+
+    def test_parse_small_batch_is_serial(self):
+        parser = PubMedXmlInputDataParser(max_workers=2, min_parallel_items=10)
+        parser.parse(PUBMED_XML_INPUT_DATA)
+        self.assertIsNone(parser._executor)
+
+    def test_parse_single_pass_backend(self):
+        parser = PubMedXmlInputDataParser(xml_parser_backend="single_pass")
+        citaton_data_list = parser.parse(PUBMED_XML_INPUT_DATA)
+        expected_citation_data_list = list(EXPECTED_CITATION_DATA_LOOKUP.values())
+        self.assertEqual(citaton_data_list, expected_citation_data_list, "Citation data list different from expected citation data list.")
+
+    def test_exception_if_unknown_xml_parser_backend(self):
+        with self.assertRaises(ValueError) as context:
+            PubMedXmlInputDataParser(xml_parser_backend="unknown")
+        self.assertEqual("XML parser backend must be one of ['elementtree', 'single_pass', 'lxml'].", str(context.exception))
+
     def test_parse_data(self):
         data = PUBMED_XML_INPUT_DATA[0]["data"]
         citaton_data = self.parser.parse_data(data)
@@ -378,6 +452,25 @@ class TestPubMedXmlParser(TestCase):
         self.medline_date_parser.extract_pub_year.assert_not_called()
 
 
+@pytest.mark.unit
+class TestSinglePassPubMedXmlParser(TestPubMedXmlParser):
+
+    def setUp(self):
+        self.medline_date_parser = MedlineDateParser()
+        self.medline_date_parser.extract_pub_year = MagicMock(return_value=2021)
+        self.parser = SinglePassPubMedXmlParser(self.medline_date_parser)
+
+
+@pytest.mark.unit
+class TestLxmlPubMedXmlParser(TestPubMedXmlParser):
+
+    def setUp(self):
+        pytest.importorskip("lxml")
+        self.medline_date_parser = MedlineDateParser()
+        self.medline_date_parser.extract_pub_year = MagicMock(return_value=2021)
+        self.parser = LxmlPubMedXmlParser(self.medline_date_parser)
+
+
 @pytest.mark.unit
 class TestUtils(TestCase):
 
@@ -386,6 +479,123 @@ class TestUtils(TestCase):
         lookup = create_lookup(buffer)
         self.assertEqual(lookup, EXPECTED_LOOKUP, "Created lookup not as expected.")
 
+    def test_create_compact_lookup(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "lookup.lkp")
+            build_compact_lookup(create_lookup(StringIO(LOOKUP_TSV)), path)
+            lookup = create_lookup(path)
+            self.assertIsInstance(lookup, CompactLookup)
+            self.assertEqual(lookup, EXPECTED_LOOKUP, "Created lookup not as expected.")
+            self.assertEqual(list(lookup), list(EXPECTED_LOOKUP))
+            self.assertEqual(lookup[np.int64(2)], "D000002")
+            self.assertEqual(pickle.loads(pickle.dumps(lookup)), EXPECTED_LOOKUP)
+            self.assertNotIn(0, lookup)
+            self.assertNotIn("1", lookup)
+
+    def test_create_compact_lookup_sparse_and_str_keys(self):
+        sparse_lookup = { 1: "a", 1000: "\u00e9", 5: "" }
+        str_lookup = { "Q000002": "abnormalities", "Q000008": "administration & dosage" }
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for expected_lookup in [sparse_lookup, str_lookup, {}]:
+                path = os.path.join(temp_dir, "lookup.lkp")
+                build_compact_lookup(expected_lookup, path)
+                lookup = CompactLookup(path)
+                self.assertEqual(lookup, expected_lookup, "Created lookup not as expected.")
+                self.assertEqual(len(lookup), len(expected_lookup))
+                with self.assertRaises(KeyError):
+                    lookup[2]
+
+    def test_exception_if_compact_lookup_values_are_not_strings(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "lookup.lkp")
+            for lookup in [{ 1: 1 }, { 1: "a", 2: float("nan") }]:
+                with self.assertRaises(ValueError) as context:
+                    build_compact_lookup(lookup, path)
+                self.assertEqual("Compact lookup values must be strings.", str(context.exception))
+
+    def test_compact_lookup_matches_tsv_lookup(self):
+        # Every lookup shipped with the repo reads back identically from its 
+        # compact file, including the key and value types.
+        tsv_paths = [os.path.join(SHIPPED_LOOKUP_DIR, file_name) for file_name in sorted(os.listdir(SHIPPED_LOOKUP_DIR)) if file_name.endswith(".tsv")]
+        self.assertGreater(len(tsv_paths), 0)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for tsv_path in tsv_paths:
+                with self.subTest(tsv_path=tsv_path):
+                    expected_lookup = create_lookup(tsv_path)
+                    compact_path = os.path.join(temp_dir, os.path.basename(tsv_path) + ".lkp")
+                    build_compact_lookup(expected_lookup, compact_path)
+                    lookup = create_lookup(compact_path)
+                    self.assertEqual(dict(lookup), expected_lookup)
+                    self.assertEqual([type(key) for key in lookup], [type(key) for key in expected_lookup])
+                    self.assertEqual({ type(value) for value in lookup.values() }, { type(value) for value in expected_lookup.values() })
+
     def test_average_top_results(self):
         results = average_top_results(POINTWISE_AVG_RESULTS, LISTWISE_RESULTS)
-        self.assertEqual(results, LISTWISE_AVG_RESULTS, "Average results not as expected.")
\ No newline at end of file
+        self.assertEqual(results, LISTWISE_AVG_RESULTS, "Average results not as expected.")
+
+    def test_average_top_n_results(self):
+        results = average_top_results(TopNResults.from_dict(POINTWISE_AVG_RESULTS), TopNResults.from_dict(LISTWISE_RESULTS))
+        self.assertEqual(results.to_dict(), LISTWISE_AVG_RESULTS, "Average results not as expected.")
+
+    def test_average_top_results_weighted_stages(self):
+        cnn_results = { "1": { "10": 0.1, "11": 0.9, "12": 0.3 } }
+        pointwise_results = { "1": { "11": 0.5, "10": 0.4 } }
+        listwise_results = { "1": { "10": 0.7, "11": 0.3 } }
+        results = average_top_results(cnn_results, pointwise_results, listwise_results, weights=[1, 1, 2])
+        self.assertEqual(results.keys(), { "1" })
+        self.assertAlmostEqual(results["1"]["10"], (0.1 + 0.4 + 2 * 0.7) / 4)
+        self.assertAlmostEqual(results["1"]["11"], (0.9 + 0.5 + 2 * 0.3) / 4)
+
+    def test_average_top_results_missing_label_policies(self):
+        input_results = { "1": { "10": 0.2 }, "2": { "20": 0.4 } }
+        output_results = { "1": { "10": 0.6, "11": 0.8 }, "3": { "30": 0.5 } }
+        with self.assertRaises(KeyError):
+            average_top_results(input_results, output_results)
+        self.assertEqual(average_top_results(input_results, output_results, missing="skip"), { "1": { "10": 0.4, "11": 0.8 }, "3": { "30": 0.5 } })
+        self.assertEqual(average_top_results(input_results, output_results, missing="zero"), { "1": { "10": 0.4, "11": 0.4 }, "3": { "30": 0.25 } })
+        with self.assertRaises(ValueError):
+            average_top_results(input_results, output_results, missing="ignore")
+        with self.assertRaises(ValueError):
+            average_top_results(input_results, output_results, weights=[1])
+
+
+@pytest.mark.unit
+class TestTopNResults(TestCase):
+
+    def setUp(self):
+        self.results = TopNResults.from_dict({ "2": { "10": 0.2, "11": 0.9, "12": 0.5 }, "1": { "20": 0.7, "21": 0.1 } })
+
+    def test_from_dict_pads_rows(self):
+        self.assertEqual(self.results.pmids.tolist(), [2, 1])
+        self.assertEqual(self.results.label_ids.tolist(), [[10, 11, 12], [20, 21, PAD_LABEL_ID]])
+        self.assertEqual(self.results.scores[1, 2], -np.inf)
+        self.assertEqual(self.results.to_dict(), { "2": { "10": 0.2, "11": 0.9, "12": 0.5 }, "1": { "20": 0.7, "21": 0.1 } })
+
+    def test_top_k(self):
+        top_results = self.results.top_k(2)
+        self.assertEqual(top_results.label_ids.tolist(), [[11, 12], [20, 21]])
+        self.assertEqual(top_results.scores.tolist(), [[0.9, 0.5], [0.7, 0.1]])
+
+    def test_threshold(self):
+        top_results = self.results.threshold(0.5)
+        self.assertEqual(top_results.label_ids.tolist(), [[11, 12, PAD_LABEL_ID], [20, PAD_LABEL_ID, PAD_LABEL_ID]])
+        self.assertEqual(top_results.to_dict(), { "2": { "11": 0.9, "12": 0.5 }, "1": { "20": 0.7 } })
+
+    def test_concatenate_pads_to_widest(self):
+        other = TopNResults.from_dict({ "3": { "30": 0.4 } })
+        results = TopNResults.concatenate([other, self.results])
+        self.assertEqual(results.pmids.tolist(), [3, 2, 1])
+        self.assertEqual(results.label_ids.tolist(), [[30, PAD_LABEL_ID, PAD_LABEL_ID], [10, 11, 12], [20, 21, PAD_LABEL_ID]])
+        self.assertEqual(results.to_dict(), { "3": { "30": 0.4 }, "2": { "10": 0.2, "11": 0.9, "12": 0.5 }, "1": { "20": 0.7, "21": 0.1 } })
+
+    def test_average_aligns_pmids_and_labels(self):
+        other = TopNResults.from_dict({ "1": { "21": 0.3, "20": 0.1, "22": 0.0 }, "2": { "12": 0.1, "11": 0.1, "10": 0.4 } })
+        results = self.results.average(other)
+        self.assertEqual(results.pmids.tolist(), [2, 1])
+        self.assertEqual(results.label_ids.tolist(), self.results.label_ids.tolist())
+        np.testing.assert_allclose(results.scores, [[0.3, 0.5, 0.3], [0.4, 0.2, -np.inf]])
+
+    def test_average_missing_label(self):
+        other = TopNResults.from_dict({ "2": { "10": 0.2, "11": 0.9 }, "1": { "20": 0.7, "21": 0.1 } })
+        with self.assertRaises(KeyError):
+            self.results.average(other)
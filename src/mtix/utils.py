@@ -1,34 +1,346 @@
 import base64
-import dateutil.parser
-import pandas as pd
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import math
+import mmap
+import multiprocessing
+import numpy as np
+import os
 import re
+import threading
 import xml.etree.ElementTree as ET
 import zlib
 
 
 ENCODING = "utf-8"
+PAD_LABEL_ID = -1
+PROCESS_START_METHOD = "spawn"
+
+
+MISSING_LABEL_POLICIES = ["raise", "skip", "zero"]
+
+
+def average_top_results(*top_results_list, weights=None, missing="raise"):
+    # Scores are averaged over the labels of the last top results (the 
+    # output of the most recent stage). A label that is missing from another 
+    # stage raises a KeyError ("raise"), is averaged over the stages that 
+    # have it ("skip"), or is given a score of zero ("zero"). Dict top 
+    # results are converted to TopNResults and back.
+    if missing not in MISSING_LABEL_POLICIES:
+        raise ValueError(f"Missing label policy must be one of {MISSING_LABEL_POLICIES}.")
+    if weights is None:
+        weights = [1] * len(top_results_list)
+    if len(weights) != len(top_results_list):
+        raise ValueError("There must be one weight per top results.")
+
+    is_dict = not isinstance(top_results_list[-1], TopNResults)
+    if is_dict:
+        top_results_list = [TopNResults.from_dict(top_results) for top_results in top_results_list]
+
+    output_top_results = top_results_list[-1]
+    label_ids = output_top_results.label_ids
+    valid = label_ids != PAD_LABEL_ID
+    score_sum = np.zeros(label_ids.shape)
+    weight_sum = np.zeros(label_ids.shape)
+    stage_list = [(output_top_results, weights[-1])] + list(zip(top_results_list[:-1], weights[:-1]))
+    for top_results, weight in stage_list:
+        if top_results is output_top_results:
+            scores, found = top_results.scores, valid
+        else:
+            top_results = top_results.align(output_top_results.pmids, strict=(missing == "raise"))
+            scores, found = top_results.lookup_scores(label_ids)
+        missing_labels = valid & ~found
+        if missing_labels.any():
+            if missing == "raise":
+                row, col = np.argwhere(missing_labels)[0]
+                raise KeyError(str(int(label_ids[row, col])))
+            elif missing == "zero":
+                scores = np.where(found, scores, 0.)
+                found = valid
+        score_sum += np.where(found, weight * scores, 0.)
+        weight_sum += np.where(found, weight, 0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scores = np.where(valid & (weight_sum > 0), score_sum / weight_sum, -np.inf)
+    average_results = TopNResults(output_top_results.pmids, label_ids, scores)
+    if is_dict:
+        average_results = average_results.to_dict()
+    return average_results
 
 
-def average_top_results(input_top_results, output_top_results):
-    result_list = [output_top_results, input_top_results]
-    results_count = len(result_list)
-    
-    average_results = {}
-    for q_id in result_list[0]:
-        average_results[q_id] = {}
-        for p_id in result_list[0][q_id]:
-            scores = [results[q_id][p_id] for results in result_list]
-            avg = sum(scores) / results_count
-            average_results[q_id][p_id] = avg
-    return average_results
+class TopNResults:
+
+    # Top-N results for a batch of citations: a pmid vector and aligned 
+    # (citation count, N) label id and score matrices. Rows with fewer than N 
+    # results are padded with PAD_LABEL_ID and a score of -inf. Columns are 
+    # not necessarily sorted by score.
+    def __init__(self, pmids, label_ids, scores):
+        self.pmids = np.asarray(pmids, dtype=np.int64)
+        self.label_ids = self._as_matrix(label_ids, np.int32)
+        self.scores = self._as_matrix(scores, np.float64)
+
+    def _as_matrix(self, values, dtype):
+        values = np.asarray(values, dtype=dtype)
+        if values.ndim != 2:
+            values = values.reshape(len(self.pmids), -1 if values.size > 0 else 0)
+        return values
+
+    @classmethod
+    def from_dict(cls, top_results):
+        pmids = [int(q_id) for q_id in top_results]
+        n = max([len(citation_top_results) for citation_top_results in top_results.values()], default=0)
+        label_ids = np.full((len(pmids), n), PAD_LABEL_ID, dtype=np.int32)
+        scores = np.full((len(pmids), n), -np.inf, dtype=np.float64)
+        for row, citation_top_results in enumerate(top_results.values()):
+            label_ids[row, :len(citation_top_results)] = [int(p_id) for p_id in citation_top_results]
+            scores[row, :len(citation_top_results)] = list(citation_top_results.values())
+        return cls(pmids, label_ids, scores)
+
+    @classmethod
+    def concatenate(cls, top_results_list):
+        # Stacks the rows of several results, padding them to the widest one.
+        n = max([top_results.label_ids.shape[1] for top_results in top_results_list], default=0)
+        pmids = np.concatenate([top_results.pmids for top_results in top_results_list] + [np.zeros(0, dtype=np.int64)])
+        label_ids = np.full((len(pmids), n), PAD_LABEL_ID, dtype=np.int32)
+        scores = np.full((len(pmids), n), -np.inf, dtype=np.float64)
+        row = 0
+        for top_results in top_results_list:
+            label_ids[row:row + len(top_results), :top_results.label_ids.shape[1]] = top_results.label_ids
+            scores[row:row + len(top_results), :top_results.scores.shape[1]] = top_results.scores
+            row += len(top_results)
+        return cls(pmids, label_ids, scores)
+
+    def to_dict(self):
+        top_results = {}
+        for pmid, citation_label_ids, citation_scores in zip(self.pmids.tolist(), self.label_ids.tolist(), self.scores.tolist()):
+            top_results[str(pmid)] = { str(label_id): score for label_id, score in zip(citation_label_ids, citation_scores) if label_id != PAD_LABEL_ID }
+        return top_results
+
+    def __len__(self):
+        return len(self.pmids)
+
+    def __eq__(self, other):
+        if not isinstance(other, TopNResults):
+            return NotImplemented
+        # As for the dict representation, the column order does not matter.
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"TopNResults(pmids={self.pmids!r}, label_ids={self.label_ids!r}, scores={self.scores!r})"
+
+    def sort(self):
+        # A stable sort keeps tied labels in their original column order.
+        order = np.argsort(-self.scores, axis=1, kind="stable")
+        label_ids = np.take_along_axis(self.label_ids, order, axis=1)
+        scores = np.take_along_axis(self.scores, order, axis=1)
+        return TopNResults(self.pmids, label_ids, scores)
+
+    def top_k(self, k):
+        sorted_results = self.sort()
+        return TopNResults(self.pmids, sorted_results.label_ids[:, :k], sorted_results.scores[:, :k])
+
+    def threshold(self, threshold):
+        # Results below the threshold are replaced by padding, and the 
+        # remaining results are sorted by score.
+        mask = self.scores >= threshold
+        label_ids = np.where(mask, self.label_ids, PAD_LABEL_ID)
+        scores = np.where(mask, self.scores, -np.inf)
+        return TopNResults(self.pmids, label_ids, scores).sort()
+
+    def align(self, pmids, strict=True):
+        # Reorders rows to match the given pmids. A pmid without results 
+        # raises a KeyError, or gets a padded row if strict is False.
+        if np.array_equal(self.pmids, pmids):
+            return self
+        row_lookup = { pmid: row for row, pmid in enumerate(self.pmids.tolist()) }
+        pmids = np.asarray(pmids).tolist()
+        if strict:
+            rows = [row_lookup[pmid] for pmid in pmids]
+        else:
+            rows = [row_lookup.get(pmid, -1) for pmid in pmids]
+        padded_label_ids = np.vstack([self.label_ids, np.full((1, self.label_ids.shape[1]), PAD_LABEL_ID, dtype=np.int32)])
+        padded_scores = np.vstack([self.scores, np.full((1, self.scores.shape[1]), -np.inf)])
+        return TopNResults(pmids, padded_label_ids[rows], padded_scores[rows])
+
+    def lookup_scores(self, label_ids):
+        # Returns the scores of the given (citation count, M) label ids, and a 
+        # mask of the label ids that were found. Rows are offset so that a 
+        # single sorted search covers every citation.
+        citation_count = len(self.pmids)
+        offset = max(int(self.label_ids.max(initial=0)), int(np.max(label_ids, initial=0))) + 2
+        row_offsets = np.arange(citation_count, dtype=np.int64)[:, None] * offset
+        keys = (self.label_ids.astype(np.int64) + 1 + row_offsets).ravel()
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        query_keys = (np.asarray(label_ids, dtype=np.int64) + 1 + row_offsets).ravel()
+        positions = np.minimum(np.searchsorted(sorted_keys, query_keys), max(len(sorted_keys) - 1, 0))
+        if len(sorted_keys) == 0:
+            found = np.zeros(query_keys.shape, dtype=bool)
+            scores = np.full(query_keys.shape, np.nan)
+        else:
+            found = sorted_keys[positions] == query_keys
+            scores = np.where(found, self.scores.ravel()[order[positions]], np.nan)
+        shape = np.shape(label_ids)
+        return scores.reshape(shape), found.reshape(shape)
+
+    def average(self, other, weights=None, missing="raise"):
+        # Averages scores over the labels of this result.
+        return average_top_results(other, self, weights=weights, missing=missing)
+
+
+def create_input_batches(input_data, batch_size):
+    # Lazily splits an iterable of input data into lists of batch_size items.
+    iterator = iter(input_data)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if len(batch) == 0:
+            break
+        yield batch
 
 
 def create_lookup(path):
+    # Compact lookup files are memory-mapped, anything else is read as TSV.
+    if is_compact_lookup(path):
+        return CompactLookup(path)
+    # pandas is imported on first use to keep importing mtix fast.
+    import pandas as pd
     data = pd.read_csv(path, sep="\t", header=None)
     lookup = dict(zip(data.iloc[:,0], data.iloc[:,1]))
     return lookup
 
 
+COMPACT_LOOKUP_MAGIC = b"MTIXLKP1"
+COMPACT_LOOKUP_HEADER_SIZE = len(COMPACT_LOOKUP_MAGIC) + 6 * 8
+DENSE_INT_KEYS = 0
+INT_KEYS = 1
+STR_KEYS = 2
+
+
+def build_compact_lookup(lookup, path):
+    # File layout: magic, header (key kind, base key, number of slots, number 
+    # of keys, values size, keys size), value offsets, key offsets (only if 
+    # the keys are not dense integers), slot present flags, utf-8 values, 
+    # utf-8 keys. Integer keys are stored as dense slots base key + i when 
+    # at least half of the slots are used. Values are stored as text, so 
+    # only string values are accepted; anything else would come back as a 
+    # different type than the TSV lookup returns.
+    if not all(isinstance(value, str) for value in lookup.values()):
+        raise ValueError("Compact lookup values must be strings.")
+    keys = list(lookup)
+    is_int_keys = all(isinstance(key, (int, np.integer)) and not isinstance(key, bool) for key in keys)
+    if is_int_keys and len(keys) > 0 and (max(keys) - min(keys) + 1) <= 2 * len(keys):
+        key_kind = DENSE_INT_KEYS
+        base_key = int(min(keys))
+        num_slots = int(max(keys)) - base_key + 1
+        slot_keys = [base_key + idx for idx in range(num_slots)]
+    else:
+        key_kind = INT_KEYS if is_int_keys else STR_KEYS
+        base_key = 0
+        num_slots = len(keys)
+        slot_keys = sorted(keys)
+
+    values = [str(lookup[key]).encode(ENCODING) if key in lookup else b"" for key in slot_keys]
+    present = np.array([key in lookup for key in slot_keys], dtype=np.uint8)
+    value_offsets = np.zeros(num_slots + 1, dtype=np.int64)
+    value_offsets[1:] = np.cumsum([len(value) for value in values])
+
+    key_offsets = np.zeros(0, dtype=np.int64)
+    encoded_keys = []
+    if key_kind != DENSE_INT_KEYS:
+        encoded_keys = [str(key).encode(ENCODING) for key in slot_keys]
+        key_offsets = np.zeros(num_slots + 1, dtype=np.int64)
+        key_offsets[1:] = np.cumsum([len(key) for key in encoded_keys])
+
+    header = np.array([key_kind, base_key, num_slots, len(keys), value_offsets[-1], key_offsets[-1] if len(key_offsets) > 0 else 0], dtype=np.int64)
+    with open(path, "wb") as write_file:
+        write_file.write(COMPACT_LOOKUP_MAGIC)
+        write_file.write(header.tobytes())
+        write_file.write(value_offsets.tobytes())
+        write_file.write(key_offsets.tobytes())
+        write_file.write(present.tobytes())
+        write_file.write(b"".join(values))
+        write_file.write(b"".join(encoded_keys))
+
+
+def is_compact_lookup(path):
+    if not isinstance(path, (str, os.PathLike)) or not os.path.isfile(path):
+        return False
+    with open(path, "rb") as read_file:
+        return read_file.read(len(COMPACT_LOOKUP_MAGIC)) == COMPACT_LOOKUP_MAGIC
+
+
+class CompactLookup(Mapping):
+
+    # Read only mapping over a file written by build_compact_lookup. The file 
+    # is memory-mapped, so loading it is cheap and its pages are shared 
+    # between processes, and values are only decoded when they are looked up.
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as read_file:
+            self._buffer = mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._buffer[:len(COMPACT_LOOKUP_MAGIC)] != COMPACT_LOOKUP_MAGIC:
+            raise ValueError(f"{path} is not a compact lookup file.")
+
+        offset = len(COMPACT_LOOKUP_MAGIC)
+        header = np.frombuffer(self._buffer, dtype=np.int64, count=6, offset=offset)
+        self._key_kind, self._base_key, num_slots, self._num_keys, values_size, keys_size = (int(value) for value in header)
+        offset += header.nbytes
+
+        self._value_offsets = np.frombuffer(self._buffer, dtype=np.int64, count=num_slots + 1, offset=offset)
+        offset += self._value_offsets.nbytes
+        key_offsets = None
+        if self._key_kind != DENSE_INT_KEYS:
+            key_offsets = np.frombuffer(self._buffer, dtype=np.int64, count=num_slots + 1, offset=offset)
+            offset += key_offsets.nbytes
+        self._present = np.frombuffer(self._buffer, dtype=np.uint8, count=num_slots, offset=offset)
+        offset += self._present.nbytes
+        self._values_offset = offset
+
+        # Non dense keys are loaded into a key to slot dict.
+        self._key_index = None
+        if self._key_kind != DENSE_INT_KEYS:
+            keys_offset = offset + values_size
+            keys = self._buffer[keys_offset:keys_offset + keys_size]
+            key_offsets = key_offsets.tolist()
+            key_type = int if self._key_kind == INT_KEYS else str
+            self._key_index = { key_type(keys[start:end].decode(ENCODING)): idx for idx, (start, end) in enumerate(zip(key_offsets[:-1], key_offsets[1:])) }
+
+    def __getstate__(self):
+        # Unpickled copies map the same file.
+        return { "path": self.path }
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __getitem__(self, key):
+        slot = self._get_slot(key)
+        start = self._values_offset + int(self._value_offsets[slot])
+        end = self._values_offset + int(self._value_offsets[slot + 1])
+        return self._buffer[start:end].decode(ENCODING)
+
+    def __iter__(self):
+        if self._key_index is not None:
+            return iter(self._key_index)
+        return iter((np.flatnonzero(self._present) + self._base_key).tolist())
+
+    def __len__(self):
+        return self._num_keys
+
+    def _get_slot(self, key):
+        if self._key_index is not None:
+            try:
+                return self._key_index[key]
+            except TypeError:
+                raise KeyError(key)
+        if isinstance(key, bool) or not isinstance(key, (int, np.integer)):
+            raise KeyError(key)
+        slot = int(key) - self._base_key
+        if slot < 0 or slot >= len(self._present) or not self._present[slot]:
+            raise KeyError(key)
+        return slot
+
+
 class Base64Helper:
 
     def encode(self, text, level=-1):
@@ -75,21 +387,64 @@ class CitationDataSanitizer:
             self.sanitize(citation_data)
 
 
+def create_process_pool(max_workers):
+    # Worker processes are spawned rather than forked. The pools can be 
+    # created from a pipeline or endpoint thread, and a child forked while 
+    # other threads hold locks can deadlock.
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(PROCESS_START_METHOD))
+
+
 class PubMedXmlInputDataParser:
-    def __init__(self):
+    def __init__(self, max_workers=1, min_parallel_items=256, chunks_per_worker=4, xml_parser_backend="elementtree"):
+        if xml_parser_backend not in XML_PARSER_BACKENDS:
+            raise ValueError(f"XML parser backend must be one of {list(XML_PARSER_BACKENDS)}.")
         self.base64_helper = Base64Helper()
         medline_date_parser = MedlineDateParser()
-        self.xml_parser = PubMedXmlParser(medline_date_parser)
+        self.xml_parser = XML_PARSER_BACKENDS[xml_parser_backend](medline_date_parser)
+        self.max_workers = max_workers
+        self.min_parallel_items = min_parallel_items
+        self.chunks_per_worker = chunks_per_worker
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def __getstate__(self):
+        # The process pool and its lock stay in the parent process.
+        state = self.__dict__.copy()
+        del state["_executor"], state["_executor_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._executor = None
+        self._executor_lock = threading.Lock()
        
     def parse(self, input_data):
         if type(input_data) is not list:
             raise ValueError("Input data must be a list.")
 
-        citation_data_list = []
-        for item in input_data:
-            data = item["data"]
-            citation_data = self.parse_data(data)
-            citation_data_list.append(citation_data)
+        data_list = [item["data"] for item in input_data]
+        if self.max_workers > 1 and len(data_list) >= self.min_parallel_items:
+            citation_data_list = self._parse_parallel(data_list)
+        else:
+            citation_data_list = [self.parse_data(data) for data in data_list]
+        return citation_data_list
+
+    def close(self):
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def _parse_parallel(self, data_list):
+        # Citations are sent to the worker processes in chunks, and 
+        # Executor.map returns the results in input order. Concurrent calls 
+        # share a single pool.
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = create_process_pool(self.max_workers)
+            executor = self._executor
+        chunksize = max(1, int(math.ceil(len(data_list) / (self.max_workers * self.chunks_per_worker))))
+        citation_data_list = list(executor.map(self.parse_data, data_list, chunksize=chunksize))
         return citation_data_list
 
     def parse_data(self, data):
@@ -104,7 +459,9 @@ class PubMedXmlParser:
 
     def parse(self, citation_xml):
         medline_citation_node = ET.fromstring(citation_xml)
+        return self.parse_node(medline_citation_node)
 
+    def parse_node(self, medline_citation_node):
         pmid_node = medline_citation_node.find("PMID")
         pmid = pmid_node.text.strip()
         pmid = int(pmid)
@@ -172,6 +529,167 @@ class PubMedXmlParser:
         return citation_data
 
 
+class SinglePassPubMedXmlParser:
+
+    # Produces the same citation data as PubMedXmlParser, but collects every 
+    # field in one walk over the relevant elements instead of separate find 
+    # calls, and joins text nodes instead of serializing subtrees.
+    def __init__(self, medline_date_parser):
+        self.medline_date_parser = medline_date_parser
+
+    def parse(self, citation_xml):
+        medline_citation_node = self._fromstring(citation_xml)
+        return self.parse_node(medline_citation_node)
+
+    def parse_node(self, medline_citation_node):
+        pmid_node = None
+        article_node = None
+        journal_nlmid_node = None
+        date_completed_node = None
+        for node in medline_citation_node:
+            tag = node.tag
+            if tag == "PMID":
+                if pmid_node is None:
+                    pmid_node = node
+            elif tag == "Article":
+                if article_node is None:
+                    article_node = node
+            elif tag == "MedlineJournalInfo":
+                if journal_nlmid_node is None:
+                    journal_nlmid_node = self._find_child(node, "NlmUniqueID")
+            elif tag == "DateCompleted":
+                if date_completed_node is None:
+                    date_completed_node = node
+
+        pmid = int(pmid_node.text.strip())
+
+        title_node = None
+        abstract_node = None
+        journal_node = None
+        if article_node is not None:
+            for node in article_node:
+                tag = node.tag
+                if tag == "ArticleTitle":
+                    if title_node is None:
+                        title_node = node
+                elif tag == "Abstract":
+                    if abstract_node is None:
+                        abstract_node = node
+                elif tag == "Journal":
+                    if journal_node is None:
+                        journal_node = node
+
+        title = ""
+        if title_node is not None:
+            title = self._text_content(title_node).strip()
+
+        abstract = ""
+        if abstract_node is not None:
+            for abstract_text_node in abstract_node:
+                if abstract_text_node.tag != "AbstractText":
+                    continue
+                if "Label" in abstract_text_node.attrib:
+                    if len(abstract) > 0:
+                        abstract += " "
+                    abstract += abstract_text_node.attrib["Label"].strip() + ": "
+                abstract += self._text_content(abstract_text_node).strip()
+
+        journal_nlmid = None
+        if journal_nlmid_node is not None:
+            journal_nlmid = journal_nlmid_node.text.strip()
+
+        journal_title = ""
+        pub_date_node = None
+        if journal_node is not None:
+            journal_title_node = None
+            journal_issue_node = None
+            for node in journal_node:
+                tag = node.tag
+                if tag == "Title":
+                    if journal_title_node is None:
+                        journal_title_node = node
+                elif tag == "JournalIssue":
+                    if journal_issue_node is None:
+                        journal_issue_node = node
+            if journal_title_node is not None:
+                journal_title = self._text_content(journal_title_node).strip()
+            if journal_issue_node is not None:
+                pub_date_node = self._find_child(journal_issue_node, "PubDate")
+
+        pub_year = None
+        medline_date_node = None
+        pub_year_node = None
+        if pub_date_node is not None:
+            medline_date_node = self._find_child(pub_date_node, "MedlineDate")
+            pub_year_node = self._find_child(pub_date_node, "Year")
+        if medline_date_node is not None:
+            medline_date_text = self._text_content(medline_date_node).strip()
+            pub_year = self.medline_date_parser.extract_pub_year(medline_date_text)
+        else:
+            pub_year = int(pub_year_node.text.strip())
+
+        year_completed = None
+        if date_completed_node is not None:
+            year_completed_node = self._find_child(date_completed_node, "Year")
+            year_completed = int(year_completed_node.text.strip())
+
+        citation_data = {
+                    "pmid": pmid,
+                    "title": title,
+                    "abstract": abstract,
+                    "journal_nlmid": journal_nlmid,
+                    "journal_title": journal_title,
+                    "pub_year": pub_year,
+                    "year_completed": year_completed,
+                    }
+
+        return citation_data
+
+    def _find_child(self, node, tag):
+        for child in node:
+            if child.tag == tag:
+                return child
+        return None
+
+    def _fromstring(self, citation_xml):
+        return ET.fromstring(citation_xml)
+
+    def _text_content(self, node):
+        # Equivalent to ET.tostring(node, method="text"), which includes the 
+        # node's tail.
+        return "".join(node.itertext()) + (node.tail or "")
+
+
+class LxmlPubMedXmlParser(SinglePassPubMedXmlParser):
+
+    # Single pass parser using lxml, which is an optional dependency. 
+    # Comments and processing instructions are dropped, as they are by 
+    # ElementTree.
+    def __init__(self, medline_date_parser):
+        super().__init__(medline_date_parser)
+        # Fails on construction if lxml is not installed.
+        import lxml.etree
+        self._lxml_parser = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_lxml_parser"] = None
+        return state
+
+    def _fromstring(self, citation_xml):
+        import lxml.etree
+        if self._lxml_parser is None:
+            self._lxml_parser = lxml.etree.XMLParser(remove_comments=True, remove_pis=True, resolve_entities=False, huge_tree=True)
+        return lxml.etree.fromstring(citation_xml.encode(ENCODING), self._lxml_parser)
+
+
+XML_PARSER_BACKENDS = {
+    "elementtree": PubMedXmlParser,
+    "single_pass": SinglePassPubMedXmlParser,
+    "lxml": LxmlPubMedXmlParser,
+}
+
+
 class MedlineDateParser:
     def extract_pub_year(self, text):
         pub_year = text[:4]
@@ -183,6 +701,7 @@ class MedlineDateParser:
                 pub_year = match.group(0)
                 pub_year = int(pub_year)
             else:
+                import dateutil.parser
                 try:
                     pub_year = dateutil.parser.parse(text, fuzzy=True).date().year
                 except: